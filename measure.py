@@ -1,24 +1,41 @@
-import os, logging
+import os, logging, datetime
 logging.getLogger().setLevel(logging.DEBUG)
 
 from google.appengine.ext import webapp, db
+from google.appengine.api import memcache
 from google.appengine.ext.webapp.util import run_wsgi_app
 
 from django.utils import simplejson
-from myapp.models import Campaign, Storage, Statistics
+from myapp.models import Campaign, Tombstone, Storage, Statistics, Histogram, Calendar, Rollup
+from myapp.sketch import RESOLUTIONS
 
 import util
 import myapp.stat as stat
+import myapp.persist as persist
 import myapp.renderer as renderer
+import myapp.cache as cache
+import myapp.writebehind as writebehind
+import myapp.commit as commit
+import myapp.recompute as recompute
  
-_Stats = {}
+_Stats = cache.EntityCache(max_size = 500)
+STREAM_CHUNK = 200
+DEDUPE_PREFIX = 'datum:'
+DEDUPE_TTL = 24 * 3600
+PENDING, DONE = 'pending', 'done' # the markers of a reserved id, before and after its Storage is written
+
+class InFlight(Exception):
+  '''Raised for a datum whose id is reserved by a request that is still writing it'''
+  pass
 
 class MainPage(webapp.RequestHandler):
   def get(self, key, path, format):
     if (not key):
       return self.error(500)
+    if Tombstone.exists(key):
+      return self.error(410)
     
-    self.campaign = Campaign.all(keys_only = True).filter('__key__ = ', db.Key(key)).get()
+    self.campaign = Campaign.lookup(key)
     if (not self.campaign):
       logging.warning('No campaign (%s) found.' % key)
       return self.error(404)
@@ -39,75 +56,381 @@ class MainPage(webapp.RequestHandler):
   def post(self, key, path, format):
     if (not key):
       return self.error(500)
+    if Tombstone.exists(key):
+      return self.error(410)
     
-    self.campaign = Campaign.all(keys_only = True).filter('__key__ = ', db.Key(key)).get()
+    self.campaign = Campaign.lookup(key)
     if (not self.campaign):
       logging.warning('No campaign (%s) found.' % key)
       return self.error(404)
       
     logging.debug("%s, %s, %s" % (key, path, format))
     
-    models = []
     error = False
-    if 'bulk' in self.request.get('type'):
+    if self.request.get('type') == 'ndjson' or self.request.headers.get('Content-Type', '').startswith('application/x-ndjson'):
+      return self.post_stream()
+    elif 'bulk' in self.request.get('type'):
       data = simplejson.loads(self.request.get('data') or '[]')  #todo remove need for loads
-      for datum in data:
-        ns = datum.get('namespace')
-        if ns:
-          models.append(create_datum(self.campaign, ns, datum))
     elif path:
-        models.append(create_datum(self.campaign, path, self.request))
+      data = [dict([(arg, self.request.get(arg)) for arg in self.request.arguments()], namespace = path)]
+    else:
+      data = []
+    
+    if self.request.get('mode') == 'async' and data and writebehind.append(self.campaign, data):
+      return self.response.set_status(202)
     
-    models += _Stats.values() + stat._Hists.values()
-    send_to_datastore(models)
+    try:
+      ingest(self.campaign, data)
+    except InFlight, error:
+      logging.info('Conflict for %s: %s' % (self.campaign, error))
+      return self.error(409) # the client retries once the other request is done
     self.response.set_status(error and 304 or 201)
+  
+  def post_stream(self):
+    '''Ingests a body of newline delimited JSON datums (optionally gzip encoded), one
+    chunk of STREAM_CHUNK datums at a time so that memory stays bounded. A line longer
+    than util.MAX_LINE fails the request with 413, and an id still being written by
+    another request with 409, after the chunks before it.'''
+    gzipped = 'gzip' in self.request.headers.get('Content-Encoding', '')
+    buffered = self.request.get('mode') == 'async'
+    status = buffered and 202 or 201
+    chunk = []
+    try:
+      for datum in read_ndjson(self.request.body_file, gzipped):
+        chunk.append(datum)
+        if len(chunk) == STREAM_CHUNK:
+          status = min(status, self.ingest_chunk(chunk, buffered))
+          chunk = []
+      if chunk:
+        status = min(status, self.ingest_chunk(chunk, buffered))
+    except util.LineTooLong, error:
+      logging.warning('Rejecting the stream of %s: %s' % (self.campaign, error))
+      return self.error(413)
+    except InFlight, error:
+      logging.info('Conflict for %s: %s' % (self.campaign, error))
+      return self.error(409)
+    self.response.set_status(status)
+  
+  def ingest_chunk(self, chunk, buffered):
+    if buffered and writebehind.append(self.campaign, chunk):
+      return 202
+    ingest(self.campaign, chunk)
+    return 201
+
+class FlushPage(webapp.RequestHandler):
+  '''Drains the write-behind buffer of a campaign (see myapp.writebehind) through the stat pipeline'''
+  def post(self):
+    campaign = self.request.get('campaign')
+    if Tombstone.exists(campaign):
+      logging.info('Dropping the buffer of deleted campaign %s' % campaign)
+      return
+    if (not writebehind.acquire(campaign)):
+      logging.info('Flush of %s already running' % campaign)
+      return self.error(503) # the task queue retries later
+    
+    try:
+      data, last, more = writebehind.peek(campaign)
+      ingest(db.Key(campaign), data)
+      writebehind.advance(campaign, last)
+    except InFlight, error:
+      logging.info('Flush of %s waits: %s' % (campaign, error))
+      return self.error(503) # the task queue retries later
+    finally:
+      writebehind.release(campaign)
+    
+    logging.info('::STATS:: flushed %s buffered datums of %s' % (len(data), campaign))
+    if more:
+      writebehind.schedule(campaign)
+
+def read_ndjson(stream, gzipped = False):
+  '''Yields the datums of a newline delimited JSON stream, skipping lines that are not JSON objects'''
+  for line in util.read_lines(stream, gzipped):
+    line = line.strip()
+    if not line:
+      continue
+    try:
+      datum = simplejson.loads(line)
+    except ValueError:
+      datum = None
+    if isinstance(datum, dict):
+      yield datum
+    else:
+      logging.warning('Skipping invalid line: %s' % line[:100])
+
+def ingest(campaign, data):
+  '''Runs the raw datums through the stat pipeline and writes the results. The ids reserved
+  for the datums are marked done once their Storage is written, and released when it
+  is not (see drop_duplicates).'''
+  data, reserved = drop_duplicates(campaign, data)
+  try:
+    if len(data) > 1 or (data and 'values' in data[0]):
+      prefetch(campaign, data)
+    
+    keys = allocate_keys(sum([isinstance(datum.get('values'), list) and len(datum['values']) or 1 for datum in data]))
+    models = []
+    for datum in data:
+      ns = datum.get('namespace')
+      if ns and isinstance(datum.get('values'), list):
+        models.extend(create_data(campaign, ns, datum, keys))
+      elif ns:
+        models.append(create_datum(campaign, ns, datum, keys))
+    
+    written, unwritten = persist.flush([model for model in models if model])
+  except:
+    forget_ids(reserved)
+    raise
+  remember_ids(written)
+  kept = set([model.key().name() for model in written + unwritten if isinstance(model, Storage)])
+  forget_ids([name for name in reserved if name not in kept]) # invalid, or failed for good
+
+def allocate_keys(count):
+  '''Complete keys for count new Storage, with one allocation. A put retried after a
+  timeout, which may have written the entities already, or from the retry queue then
+  writes the same entities again instead of new copies.'''
+  if not count:
+    return iter([])
+  start, end = db.allocate_ids(db.Key.from_path(Storage.kind(), 1), count)
+  return (db.Key.from_path(Storage.kind(), i) for i in xrange(start, end + 1))
+
+def has_id(datum_id):
+  '''Whether a client supplied id was given: any value but None and the empty string, 0 included'''
+  return datum_id is not None and datum_id != ''
 
-def send_to_datastore(models):
-  payload = [models]
+def storage_key(campaign, datum_id, keys):
+  '''The key of a new Storage: named after the client supplied id, else the next allocated key'''
+  if has_id(datum_id):
+    return db.Key.from_path(Storage.kind(), datum_key_name(campaign, datum_id))
+  return keys.next()
+
+def datum_key_name(campaign, datum_id):
+  '''Key name of the Storage of a datum with a client supplied id, which doubles as the
+  durable marker that the datum was ingested'''
+  return 'id:%s:%s' % (campaign, datum_id)
+
+def drop_duplicates(campaign, data):
+  '''Removes the datums, and values of columnar datums, whose client supplied id (`id`,
+  or `ids` for columnar datums) was already ingested. Every id is reserved in memcache
+  with an atomic add, marked PENDING until its Storage is written (see remember_ids);
+  older ids are found by their Storage key name. Raises InFlight, holding no
+  reservation, when another request is still writing one of the ids: that request may
+  yet fail. Returns the remaining datums and the names reserved for them.'''
+  names = []
+  for datum in data:
+    if isinstance(datum.get('values'), list):
+      names.extend([datum_key_name(campaign, i) for i in datum.get('ids') or [] if has_id(i)])
+    elif has_id(datum.get('id')):
+      names.append(datum_key_name(campaign, datum.get('id')))
+  if not names:
+    return data, []
   
-  while payload:
-    models = payload.pop(0)
-    l = len(models)
-    if l:
-      try:
-        db.put(models)
-        logging.info('::STATS:: db.put(%s)', l)
-      except:
-        logging.info('::STATS:: !db.put(%s)', l)
-        if l == 1:
-          logging.warning('Could not save: %s', models)
-          continue
-        payload.append(models[:l / 2])
-        payload.append(models[l / 2:])
-
-def create_datum(campaign, ns, obj = {}):
+  names = list(set(names))
+  failed = set(memcache.add_multi(dict((name, PENDING) for name in names), time = DEDUPE_TTL, key_prefix = DEDUPE_PREFIX))
+  # a failed add is a duplicate, unless memcache failed and does not have the id either
+  markers = failed and memcache.get_multi(list(failed), key_prefix = DEDUPE_PREFIX) or {}
+  pending = [name for name, marker in markers.iteritems() if marker == PENDING]
+  if pending:
+    forget_ids([name for name in names if name not in failed])
+    raise InFlight('%s ids are being written by another request, such as %s' % (len(pending), pending[0]))
+  duplicates = set(markers.keys())
+  unknown = [name for name in names if name not in duplicates]
+  if unknown:
+    duplicates.update([datum.key().name() for datum in Storage.get_by_key_name(unknown) if datum])
+  reserved = [name for name in unknown if name not in duplicates and name not in failed]
+  
+  dropped = []
+  def is_new(datum_id):
+    '''False for known ids and for ids repeated within the payload'''
+    if not has_id(datum_id):
+      return True
+    name = datum_key_name(campaign, datum_id)
+    if name in duplicates:
+      dropped.append(datum_id)
+      return False
+    duplicates.add(name)
+    return True
+  
+  unique = []
+  for datum in data:
+    if isinstance(datum.get('values'), list):
+      ids = datum.get('ids') or []
+      keep = [i for i in range(len(datum['values'])) if i >= len(ids) or is_new(ids[i])]
+      if len(keep) < len(datum['values']):
+        datum = dict(datum)
+        for column in ('values', 'timestamps', 'ids'):
+          values = datum.get(column) or []
+          datum[column] = [values[i] for i in keep if i < len(values)]
+      unique.append(datum)
+    elif is_new(datum.get('id')):
+      unique.append(datum)
+  if dropped:
+    logging.info('::STATS:: dropped %s duplicate datums of %s' % (len(dropped), campaign))
+  return unique, reserved
+
+def remember_ids(models):
+  '''Marks the ids of the written Storage DONE, so that later posts of them are dropped'''
+  names = [model.key().name() for model in models if isinstance(model, Storage) and model.key().name()]
+  if names:
+    memcache.set_multi(dict((name, DONE) for name in names), time = DEDUPE_TTL, key_prefix = DEDUPE_PREFIX)
+
+def forget_ids(names):
+  '''Releases the ids reserved by drop_duplicates for datums that could not be ingested,
+  so that the client can send them again. The Storage spilled to the task queue keeps
+  its reservation, since it is written later (see RetryPage).'''
+  if names:
+    memcache.delete_multi(names, key_prefix = DEDUPE_PREFIX)
+
+class RetryPage(webapp.RequestHandler):
+  '''Writes the Storage spilled by myapp.commit. Failing makes the task queue retry later.'''
+  def post(self):
+    written, unwritten = commit.put(commit.decode(self.request.body), spill = False)
+    remember_ids(written)
+    if unwritten:
+      return self.error(503)
+
+def get_statistics(campaign, ns, kind):
+  key = '%s.%s' % (campaign, ns)
+  stats = _Stats.get(key)
+  if stats is None:
+    stats = _Stats.set(key, Statistics.get_by_key_name_or_insert(key, campaign = campaign, namespace = ns))
+    stats.type = kind
+  return stats
+
+def create_datum(campaign, ns, obj, keys):
   ns = ns.strip('/').replace('/', '.')    
   value = obj.get('value')
   kind = obj.get('type', 'number')
     
-  datum = Storage(campaign = campaign, namespace = ns, type = kind, value = value)
-  
-  key = '%s.%s' % (campaign, ns)
-  if (not _Stats.has_key(key)):
-    datum.stats = _Stats[key] = Statistics.get_by_key_name_or_insert(key, campaign = campaign, namespace = ns)
-    datum.stats.type = kind
-  else:
-    datum.stats = _Stats[key]
+  datum = Storage(key = storage_key(campaign, obj.get('id'), keys), campaign = campaign, namespace = ns, type = kind, value = value, rolled_up = True)
+  datum.stats = get_statistics(campaign, ns, kind)
+  configure(datum.stats, obj)
   
   helper = stat.get(kind)
   helper.prepare(datum)
   if not hasattr(datum, '_invalid'):
-    helper.calculate(datum)
+    persist.calculate(helper, datum)
     return datum
   else:
     logging.warning('datum invalid %s/%s, %s, %s' % (campaign, ns, datum.value, datum.type))
 
+def create_data(campaign, ns, obj, keys):
+  '''Columnar version of create_datum for {namespace, type, values, timestamps}: the
+  statistics and histograms of the namespace are updated once for all the values.
+  The optional timestamps (seconds since the epoch, UTC) become the created_on of the values.'''
+  ns = ns.strip('/').replace('/', '.')
+  kind = obj.get('type', 'number')
+  stats = get_statistics(campaign, ns, kind)
+  configure(stats, obj)
+  
+  timestamps = obj.get('timestamps') or []
+  ids = obj.get('ids') or []
+  data = []
+  for i, value in enumerate(obj.get('values')):
+    datum = Storage(key = storage_key(campaign, ids[i] if i < len(ids) else None, keys), campaign = campaign, namespace = ns, type = kind, value = value, rolled_up = True)
+    datum.stats = stats
+    if i < len(timestamps):
+      try:
+        datum.created_on = datetime.datetime.utcfromtimestamp(float(timestamps[i]))
+      except (TypeError, ValueError, OverflowError):
+        logging.warning('Invalid timestamp %s for %s/%s' % (timestamps[i], campaign, ns))
+    data.append(datum)
+  
+  helper = stat.get(kind)
+  valid = helper.prepare_many(data)
+  if valid:
+    persist.calculate_many(helper, valid)
+  if len(valid) < len(data):
+    logging.warning('%s invalid datums in %s/%s' % (len(data) - len(valid), campaign, ns))
+  return valid
+
+def prefetch(campaign, data):
+  '''Loads every Statistics, Histogram, Calendar and Rollup that a bulk payload will touch into the caches.
+  Each kind costs one batch get, plus a get_or_insert for every entity that does not exist yet,
+  and the entities cached already cost one memcache call for all their versions.'''
+  kinds, series = {}, {}
+  now = datetime.datetime.now()
+  for datum in data:
+    ns = datum.get('namespace')
+    if ns:
+      ns = ns.strip('/').replace('/', '.')
+      kinds.setdefault(ns, datum.get('type', 'number'))
+      periods = series.setdefault(ns, set())
+      for when in created_on(datum, now):
+        t = when.timetuple()
+        for resolution, (period, bucket, seconds) in RESOLUTIONS.iteritems():
+          periods.add((resolution, period(t)))
+  
+  names = dict(('%s.%s' % (campaign, ns), ns) for ns in kinds)
+  found = _Stats.get_multi(names.keys())
+  missing = dict((key, dict(campaign = campaign, namespace = ns, type = kinds[ns]))
+    for key, ns in names.iteritems() if key not in found)
+  if missing:
+    for key, stats in Statistics.get_by_key_names_or_insert(missing).iteritems():
+      stats.type = kinds[names[key]] # like get_statistics
+      found[key] = _Stats.set(key, stats)
+  
+  wanted = {}
+  for key, stats in found.iteritems():
+    kind = kinds[names[key]]
+    if stats.shards: # counted in the shards
+      continue
+    if stat.get(kind).calendar:
+      wanted['%s.calendar' % stats.key()] = (Calendar, dict(statistic = stats))
+    for name in stat.get(kind).histogram_names:
+      if name == 'hits' and stats.topk: # kept in the top-k sketch instead
+        continue
+      wanted['%s.%s' % (stats.key(), name)] = (Histogram, dict(statistic = stats, name = name))
+    for resolution, period in series[names[key]]:
+      wanted[Rollup.key_name(stats.key(), resolution, period)] = (Rollup, dict(statistic = stats, resolution = resolution, period = period))
+  cached = persist._Hists.get_multi(wanted.keys())
+  for Kind in (Histogram, Calendar, Rollup):
+    missing = dict((key, kwds) for key, (Model, kwds) in wanted.iteritems() if Model is Kind and key not in cached)
+    if missing:
+      for key, entity in Kind.get_by_key_names_or_insert(missing).iteritems():
+        persist._Hists.set(key, entity)
+  logging.info('::STATS:: prefetched %s namespaces' % len(kinds))
+
+def created_on(datum, now):
+  '''The distinct datetimes the values of a raw datum will be created on (see create_data)'''
+  values = datum.get('values')
+  if not isinstance(values, list):
+    return [now]
+  timestamps = (datum.get('timestamps') or [])[:len(values)]
+  times = set(len(timestamps) < len(values) and [now] or [])
+  for timestamp in timestamps:
+    try:
+      times.add(datetime.datetime.utcfromtimestamp(float(timestamp)))
+    except (TypeError, ValueError, OverflowError):
+      times.add(now)
+  return times
+
+def configure(stats, obj):
+  '''Applies the per namespace options of a datum:
+    shards - how many shards the counters are spread over (0 turns sharding off)
+    topk - keep only the k most frequent hits, in a bounded sketch (0 keeps every hit)
+  '''
+  for option, limit in (('shards', Statistics.MAX_SHARDS), ('topk', Statistics.MAX_TOPK)):
+    value = obj.get(option)
+    if value is None or value == '':
+      continue
+    try:
+      value = min(max(int(value), 0), limit)
+    except ValueError:
+      logging.warning('Invalid %s (%s) for %s' % (option, value, stats.namespace))
+      continue
+    if value != getattr(stats, option):
+      setattr(stats, option, value)
+      persist.mark_dirty(stats)
+
 def cleanup_relations(sender, **kwargs):
   campaign = kwargs.get('instance')
   if (not TaskModel(object = campaign, task = 'delete campaign').put()):
     logging.critical('Could not schedule a DELETE Campaign Task for Campaign (%s)' % campaign)
       
 application = webapp.WSGIApplication(debug = os.environ['SERVER_SOFTWARE'].startswith('Dev'), url_mapping = [
+  ('/measure/_tasks/flush', FlushPage),
+  ('/measure/_tasks/retry', RetryPage),
+  ('/measure/_tasks/recompute/(\w+)', recompute.RecomputePage),
+  ('/measure/_tasks/mapper', util.MapperPage),
   ('/measure/([^/]+)/([^\.]+)?(?:\.(.+))?', MainPage)
 ])
  
@@ -0,0 +1,138 @@
+'''Instance caches for the measure hot path.
+
+Entities are kept in memory between the requests served by an instance, bounded
+in number (the least recently used entries are evicted first) and in age (ttl).
+Every write stamps the entity with a new version which is published to memcache,
+so that an instance notices, within a second or so, that its copy was superseded
+by another instance and reloads it. This only bounds how long an instance keeps
+writing over newer values: two instances holding the same version can still
+overwrite each other's updates in between. The cache does not prevent lost updates;
+namespaces that many instances write at once should be sharded (see
+models.StatisticsShard), whose deltas are committed in transactions.
+'''
+import time, random, logging
+from google.appengine.api import memcache
+
+VERSION_PREFIX = 'version:'
+
+class LRUCache(object):
+  '''Dictionary-like cache bounded in size, with least recently used eviction and an optional ttl (seconds)'''
+  PREV, NEXT, KEY, VALUE, STORED_ON = range(5)
+
+  def __init__(self, max_size = 1000, ttl = None):
+    self.max_size = max_size
+    self.ttl = ttl
+    self.entries = {}
+    self.root = root = []
+    root[:] = [root, root, None, None, None]
+
+  def __len__(self):
+    return len(self.entries)
+
+  def get(self, key, default = None):
+    link = self.entries.get(key)
+    if link is None:
+      return default
+    if self.ttl and time.time() - link[self.STORED_ON] > self.ttl:
+      self.discard(key)
+      return default
+    self._unlink(link)
+    self._append(link)
+    return link[self.VALUE]
+
+  def set(self, key, value):
+    if key in self.entries:
+      self._unlink(self.entries[key])
+    link = [None, None, key, value, time.time()]
+    self._append(link)
+    self.entries[key] = link
+    while len(self.entries) > self.max_size:
+      self.discard(self.root[self.NEXT][self.KEY])
+    return value
+
+  def discard(self, key):
+    link = self.entries.pop(key, None)
+    if link is not None:
+      self._unlink(link)
+
+  def clear(self):
+    self.entries.clear()
+    self.root[:] = [self.root, self.root, None, None, None]
+
+  def values(self):
+    return [link[self.VALUE] for link in self.entries.itervalues()]
+
+  def _append(self, link):
+    last = self.root[self.PREV]
+    link[self.PREV], link[self.NEXT] = last, self.root
+    last[self.NEXT] = self.root[self.PREV] = link
+
+  def _unlink(self, link):
+    link[self.PREV][self.NEXT] = link[self.NEXT]
+    link[self.NEXT][self.PREV] = link[self.PREV]
+
+class EntityCache(LRUCache):
+  '''LRU cache of versioned entities (see stamp and publish).
+
+  A cached entity is compared with the version published in memcache at most
+  once every `recheck` seconds. If another instance has written a newer version,
+  or the published version was evicted from memcache, the entry is dropped and
+  the caller reloads the entity from the datastore. Caching an entity publishes
+  its version unless a version is published already. get_multi checks the versions
+  of many entities with one memcache call.'''
+  def __init__(self, max_size = 1000, ttl = 600, recheck = 1):
+    super(EntityCache, self).__init__(max_size, ttl)
+    self.recheck = recheck
+    self.checked_on = {}
+
+  def get(self, key, default = None):
+    return self.get_multi([key]).get(key, default)
+
+  def get_multi(self, keys):
+    '''The entities cached under the keys, in a dict by key. Missing and stale entries
+    are left out.'''
+    now = time.time()
+    found, due = {}, {}
+    for key in keys:
+      entity = super(EntityCache, self).get(key)
+      if entity is None:
+        self.checked_on.pop(key, None)
+        continue
+      found[key] = entity
+      if now - self.checked_on.get(key, 0) > self.recheck:
+        due[VERSION_PREFIX + str(entity.key())] = key
+
+    versions = due and memcache.get_multi(due.keys()) or {}
+    for name, key in due.iteritems():
+      version = versions.get(name)
+      if version != found[key].version:
+        logging.info('Cached %s is stale (%s != %s)' % (key, found[key].version, version))
+        self.discard(key)
+        del found[key]
+      else:
+        self.checked_on[key] = now
+    return found
+
+  def set(self, key, value):
+    self.checked_on[key] = time.time()
+    memcache.add(VERSION_PREFIX + str(value.key()), value.version)
+    return super(EntityCache, self).set(key, value)
+
+  def discard(self, key):
+    self.checked_on.pop(key, None)
+    super(EntityCache, self).discard(key)
+
+def is_versioned(model):
+  return 'version' in model.properties()
+
+def stamp(models):
+  '''Gives every versioned model a new, unique version before it is written'''
+  for model in models:
+    if is_versioned(model):
+      model.version = int(time.time() * 1000) * 1000 + random.randint(0, 999)
+
+def publish(models):
+  '''Announces the versions of the written models to the other instances'''
+  versions = dict((VERSION_PREFIX + str(model.key()), model.version) for model in models if is_versioned(model))
+  if versions and memcache.set_multi(versions):
+    logging.warning('Could not publish the versions of %s models' % len(versions))
@@ -0,0 +1,111 @@
+'''Commit engine for the measure path: batched puts that tell transient datastore
+errors from permanent ones.
+
+A batch that fails with a transient error (timeout, contention, RPC deadline)
+is retried as a whole with exponential backoff. A batch that fails with a
+permanent error (a bad value, an entity or request that is too large) is split
+in half until the offending entities are isolated, and those are logged.
+Append-only models (Storage) that still cannot be written after the retries are
+spilled to the task queue (see measure.RetryPage), which keeps retrying them with
+its own backoff. Versioned aggregates (Statistics, Histogram, ...) are not spilled:
+a snapshot written later would overwrite whatever was committed in between, so
+they are handed back to the caller to be written with the next flush instead.
+
+A put that timed out may have been committed anyway, so the models must have complete
+keys before the first attempt (see measure.allocate_keys): a retry then writes the
+same entities again rather than new copies.
+'''
+import time, logging, pickle
+from google.appengine.ext import db
+from google.appengine.datastore import entity_pb
+from google.appengine.runtime import apiproxy_errors
+from google.appengine.api.labs import taskqueue
+from cache import is_versioned
+
+RETRIES = 3
+BACKOFF = 0.1 # seconds, doubled at every retry
+RETRY_URL = '/measure/_tasks/retry'
+MAX_SPILL = 90 * 1024 # bytes of encoded entities per task
+
+RETRYABLE = (
+  db.Timeout,
+  db.TransactionFailedError,
+  db.InternalError,
+  apiproxy_errors.DeadlineExceededError,
+  apiproxy_errors.CapabilityDisabledError,
+)
+
+def is_retryable(error):
+  return isinstance(error, RETRYABLE)
+
+def put(models, retries = RETRIES, backoff = BACKOFF, spill = True):
+  '''Writes the models with as few RPCs as possible.
+
+  Returns the models that were written and the ones that failed with a transient
+  error after all the retries. Unless spill is False, the append-only ones among
+  the latter are already handed to the task queue. Models that fail with a
+  permanent error are logged.'''
+  written, unwritten = [], []
+  payload = [models]
+  while payload:
+    batch = payload.pop(0)
+    l = len(batch)
+    if not l:
+      continue
+    error = attempt(batch, retries, backoff)
+    if error is None:
+      written.extend(batch)
+    elif is_retryable(error):
+      unwritten.extend(batch)
+    elif l == 1:
+      logging.critical('Could not save %s: %s' % (batch[0], error))
+    else:
+      payload.append(batch[:l / 2])
+      payload.append(batch[l / 2:])
+
+  if unwritten and spill:
+    enqueue([model for model in unwritten if not is_versioned(model)])
+  return written, unwritten
+
+def attempt(batch, retries, backoff):
+  '''Puts the batch, retrying transient errors. Returns the last error, or None on success.'''
+  for i in range(retries + 1):
+    try:
+      db.put(batch)
+      logging.info('::STATS:: db.put(%s)', len(batch))
+      return None
+    except RETRYABLE, error:
+      logging.info('::STATS:: !db.put(%s) %s, attempt %s', len(batch), error.__class__.__name__, i + 1)
+      if i < retries:
+        time.sleep(backoff * 2 ** i)
+    except Exception, error: # anything else is not going away by itself
+      logging.info('::STATS:: !db.put(%s) %s', len(batch), error.__class__.__name__)
+      return error
+  return error
+
+def enqueue(models):
+  '''Spills append-only models to the task queue, in tasks of at most MAX_SPILL bytes'''
+  chunk, size = [], 0
+  for model in models:
+    encoded = db.model_to_protobuf(model).Encode()
+    if len(encoded) > MAX_SPILL:
+      logging.critical('Too large to spill, could not save: %s' % model)
+      continue
+    if size + len(encoded) > MAX_SPILL:
+      add_task(chunk)
+      chunk, size = [], 0
+    chunk.append(encoded)
+    size += len(encoded)
+  if chunk:
+    add_task(chunk)
+
+def add_task(chunk):
+  try:
+    taskqueue.add(url = RETRY_URL, payload = pickle.dumps(chunk, 2))
+    logging.warning('::STATS:: spilled %s models to the task queue' % len(chunk))
+  except (taskqueue.Error, apiproxy_errors.Error), error:
+    logging.critical('Could not spill %s models: %s' % (len(chunk), error))
+
+def decode(payload):
+  '''Models of a task added by enqueue'''
+  return [db.model_from_protobuf(entity_pb.EntityProto(encoded)) for encoded in pickle.loads(payload)]
@@ -1,8 +1,23 @@
-import logging, util
+import logging, random, re, time, datetime, util, cache, stat
+from sketch import TDigest, Moments, HyperLogLog, SpaceSaving, Counts, CalendarCounts, SeriesBuckets, periods, merge_states
+
+SKETCHES = {'digest': TDigest, 'moments': Moments, 'hll': HyperLogLog, 'hits_sketch': SpaceSaving}
 
 from google.appengine.ext import db
+from google.appengine.api import memcache
 from django.utils import simplejson
 
+def get_by_key_names_or_insert(cls, kwds_by_key):
+  '''Batch version of get_by_key_name_or_insert: one get for all the key names, then
+  a transactional get_or_insert for each model that is missing, so that one created
+  meanwhile by another request is not overwritten. Returns a dict by key name.'''
+  keys = kwds_by_key.keys()
+  models = cls.get_by_key_name(keys)
+  for i, model in enumerate(models):
+    if (model is None):
+      models[i] = cls.get_or_insert(keys[i], **kwds_by_key[keys[i]])
+  return dict(zip(keys, models))
+
 class SerializableExpando(db.Expando):
   """Extends Expando to have json and possibly other serializations
   
@@ -32,8 +47,17 @@ class SerializableExpando(db.Expando):
     if (model is None):
         model = cls.get_or_insert(key, **kwds)
     return model
+  
+  get_by_key_names_or_insert = classmethod(get_by_key_names_or_insert)
+
+_Campaigns = cache.LRUCache(max_size = 1000, ttl = 60)
+_Tombstones = cache.LRUCache(max_size = 1000)
 
 class Campaign(db.Model):
+  CACHE_PREFIX = 'campaign:'
+  CACHE_TTL = 3600
+  NEGATIVE_TTL = 60
+  
   title = db.StringProperty(required = True)
   description = db.StringProperty(multiline = True)
   homepage = db.StringProperty()
@@ -43,28 +67,118 @@ class Campaign(db.Model):
   @classmethod
   def kind(cls):
     return 'Campaign'
+  
+  @classmethod
+  def lookup(cls, key):
+    '''Returns the db.Key of the campaign, or None if there is no such campaign.
+    The answer comes from the instance cache, then memcache, and only then from a
+    datastore query. Unknown keys are cached as well, for a shorter time.'''
+    exists = _Campaigns.get(key)
+    if exists is None:
+      exists = memcache.get(cls.CACHE_PREFIX + key)
+      if exists is None:
+        try:
+          exists = bool(cls.all(keys_only = True).filter('__key__ = ', db.Key(key)).get())
+        except db.BadKeyError:
+          exists = False
+        memcache.set(cls.CACHE_PREFIX + key, exists, time = exists and cls.CACHE_TTL or cls.NEGATIVE_TTL)
+      _Campaigns.set(key, exists)
+    return exists and db.Key(key) or None
+  
+  @classmethod
+  def invalidate(cls, key):
+    '''Forgets whether the campaign exists, in this instance and in memcache'''
+    _Campaigns.discard(key)
+    memcache.delete(cls.CACHE_PREFIX + key)
+
+class Tombstone(db.Model):
+  '''Marks a deleted campaign (the key name) while its data is purged in the background
+  (see tasks.DeleteCampaignTask). Every instance learns of it through memcache, so that
+  the campaign is rejected at once and without a datastore query.'''
+  CACHE_PREFIX = 'tombstone:'
+  RECHECK = 1 # seconds a campaign is taken to be alive before memcache is asked again
+  
+  deleted_on = db.DateTimeProperty(auto_now_add = 1)
+  
+  @classmethod
+  def kind(cls):
+    return 'Tombstone'
+  
+  @classmethod
+  def bury(cls, key):
+    '''Marks the campaign deleted, in the datastore, memcache and this instance'''
+    cls(key_name = key).put()
+    cls.publish(key)
+    Campaign.invalidate(key)
+  
+  @classmethod
+  def publish(cls, key):
+    '''Announces the tombstone again, in case memcache evicted it'''
+    memcache.set(cls.CACHE_PREFIX + key, True)
+    _Tombstones.set(key, True)
+  
+  @classmethod
+  def exists(cls, key):
+    '''Whether the campaign was deleted. A tombstone is remembered by the instance for
+    good, the absence of one for RECHECK seconds.'''
+    known = _Tombstones.get(key)
+    if known is True:
+      return True
+    if known is None or time.time() - known > cls.RECHECK:
+      buried = bool(memcache.get(cls.CACHE_PREFIX + key))
+      _Tombstones.set(key, buried or time.time())
+      return buried
+    return False
     
 class Storage(SerializableExpando):
-  json_does_not_include = ['campaign', 'namespace', 'type', 'prev', 'stats']
+  json_does_not_include = ['campaign', 'namespace', 'type', 'prev', 'stats', 'rolled_up']
   
   campaign = db.ReferenceProperty(Campaign)
   namespace = db.StringProperty(required = True)
   type = db.StringProperty(required = True)
   created_on = db.DateTimeProperty(auto_now_add = 1)
   stats = db.ReferenceProperty(collection_name = 'statistics')
+  rolled_up = db.BooleanProperty(default = False, indexed = False) # in the rollups since it was measured
   
   @classmethod
   def kind(cls):
     return 'Storage'
     
+def fold_counters(target, values):
+  '''Merges counter values into the target (see sketch.merge_states), decoding and
+  encoding the sketches, and derives the mean again from the merged sum and count'''
+  current, state = {}, {}
+  for name, value in values.iteritems():
+    if name in SKETCHES:
+      current[name] = SKETCHES[name].decode(getattr(target, name, None))
+      value = SKETCHES[name].decode(value)
+    else:
+      current[name] = getattr(target, name, None)
+    state[name] = value
+  for name, value in merge_states(current, state).iteritems():
+    if value is not None:
+      setattr(target, name, db.Blob(value.encode()) if name in SKETCHES else value)
+  if getattr(target, 'count', None) and getattr(target, 'sum', None) is not None:
+    target.mean = float(target.sum) / target.count
+
 class Statistics (SerializableExpando):
-  json_does_not_include = ['campaign', 'namespace', 'histograms']
+  json_does_not_include = ['campaign', 'namespace', 'histograms', 'shards', 'version', 'digest', 'moments', 'hll', 'topk', 'hits_sketch']
+  MAX_SHARDS = 20
+  MAX_TOPK = 1000
+  QUANTILES = stat.QUANTILES
+  MOMENTS = stat.MOMENTS
+  PERCENTILE = re.compile(r'^p(\d{1,2}(?:\.\d+)?)$')
   
   campaign = db.ReferenceProperty(Campaign)
   namespace = db.StringProperty(required = True)
   count = db.IntegerProperty(default = 0)
   histograms = db.StringListProperty()
   type = db.StringProperty()
+  shards = db.IntegerProperty(default = 0)
+  topk = db.IntegerProperty(default = 0)
+  version = db.IntegerProperty(default = 0)
+  
+  _shard_keys = None
   
   @classmethod
   def kind(cls):
@@ -72,37 +186,438 @@ class Statistics (SerializableExpando):
   
   @staticmethod
   def get_by_campaign_and_namespace(campaign, namespace):
-    return Statistics.get_by_key_name('%s.%s' % (campaign, namespace))
+    stats = Statistics.get_by_key_name('%s.%s' % (campaign, namespace))
+    if stats:
+      stats.merge_shards()
+    return stats
+    
+  def merge_shards(self):
+    '''Folds the counters of every shard into this statistic. Meant for reading only:
+    the merged statistic must not be put back, or the shards would be counted twice.
+    The shards are queried rather than named after the shard count, so that the shards
+    left over when the count was lowered (or sharding turned off) are still counted.'''
+    shards = StatisticsShard.all().filter('statistic =', self).fetch(1000)
+    for shard in shards:
+      fold_counters(self, shard.counters())
+    self._shard_keys = [shard.key() for shard in shards]
+  
+  def shard_keys(self):
+    '''The keys of the shards of the statistic, queried once per copy of it'''
+    if self._shard_keys is None:
+      self._shard_keys = StatisticsShard.all(keys_only = True).filter('statistic =', self).fetch(1000)
+    return self._shard_keys
+  
+  def get_sharded(self, Kind, key_names):
+    '''The entities of the key names together with the copies kept by the shards of the
+    statistic (see StatisticsShard.increment), in one batch get. Returns a list of the
+    entities that exist for each key name, the unsharded one first.'''
+    shards = self.shard_keys()
+    keys = []
+    for name in key_names:
+      keys.append(db.Key.from_path(Kind.kind(), name))
+      keys.extend([db.Key.from_path(Kind.kind(), name, parent = shard) for shard in shards])
+    entities = keys and db.get(keys) or []
+    n = len(shards) + 1
+    return [[entity for entity in entities[i * n:(i + 1) * n] if entity] for i in range(len(key_names))]
+  
+  def get_histograms(self, names):
+    '''The histograms of the names (None for those without any counts), with the counts
+    of the shards added. Meant for reading only, like merge_shards.'''
+    key = self.key()
+    hists = []
+    for name, entities in zip(names, self.get_sharded(Histogram, ['%s.%s' % (key, name) for name in names])):
+      if not entities:
+        hists.append(None)
+        continue
+      hist = entities[0]
+      if hist.parent_key():
+        hist = Histogram(key_name = '%s.%s' % (key, name), statistic = self, name = name)
+        hist.counts.merge(entities[0].counts)
+      for shard in entities[1:]:
+        hist.counts.merge(shard.counts)
+      hists.append(hist)
+    return hists
+  
+  def get_calendar_counts(self):
+    '''The calendar counts of the statistic, with those of its shards added'''
+    counts = CalendarCounts()
+    for calendar in self.get_sharded(Calendar, ['%s.calendar' % self.key()])[0]:
+      counts.merge(calendar.counts)
+    return counts
     
   def __getattr__(self, key):
-    if key in self.histograms:
-      return Histogram.get_by_key_name('%s.%s' % (self.key(), key))
+    if key in CalendarCounts.NAMES + ['calendar'] and 'calendar' in self.histograms:
+      return self.get_calendar(key)
+    elif key in ('hits', 'hitters') and self.topk and 'hits_sketch' in self.dynamic_properties():
+      hitters = SpaceSaving.decode(self.hits_sketch).top()
+      if key == 'hitters':
+        return hitters
+      return dict((value, count) for value, count, error in hitters)
+    elif key in self.histograms:
+      return self.get_histograms([key])[0]
+    elif key == 'quantiles' and 'digest' in self.dynamic_properties():
+      return self.get_quantiles()
+    elif self.PERCENTILE.match(key) and 'digest' in self.dynamic_properties():
+      return TDigest.decode(self.digest).quantile(float(key[1:]) / 100)
+    elif key in self.MOMENTS and 'moments' in self.dynamic_properties():
+      return getattr(Moments.decode(self.moments), key)
+    elif key == 'distinct' and 'hll' in self.dynamic_properties():
+      return len(HyperLogLog.decode(self.hll))
     else:
       return super(Statistics, self).__getattr__(key)
+  
+  def get_calendar(self, name = 'calendar'):
+    '''The counts of a datetime bucket (or all of them), from the calendar of the
+    statistic and any histogram of that bucket written before the calendar'''
+    counts = self.get_calendar_counts()
+    if name == 'calendar':
+      return counts.to_dict()
+    counts = Counts(counts.bucket(name))
+    if name in self.histograms:
+      hist = self.get_histograms([name])[0]
+      counts.merge(hist and hist.counts or {})
+    return dict(counts)
+    
+  def get_quantiles(self):
+    digest = TDigest.decode(self.digest)
+    return dict((name, digest.quantile(q)) for name, q in self.QUANTILES.iteritems())
     
   def to_dict(self):
     entity = super(Statistics, self).to_dict()    
-    key = self.key()
-    hists = Histogram.get_by_key_name(['%s.%s' % (key, hist) for hist in self.histograms])
+    if 'digest' in self.dynamic_properties():
+      entity['quantiles'] = self.get_quantiles()
+    if 'moments' in self.dynamic_properties():
+      moments = Moments.decode(self.moments)
+      for name in self.MOMENTS:
+        entity[name] = getattr(moments, name)
+    if 'hll' in self.dynamic_properties():
+      entity['distinct'] = len(HyperLogLog.decode(self.hll))
+    names = [hist for hist in self.histograms if hist != 'calendar']
+    hists = self.get_histograms(names)
     logging.info(hists)
     for hist in hists:
       if hist:
         entity[hist.name] = hist.to_dict()
+    if 'calendar' in self.histograms:
+      for name, counts in self.get_calendar_counts().to_dict().iteritems():
+        entity[name] = dict(Counts(entity.get(name, {})).merge(counts))
+    if self.topk and 'hits_sketch' in self.dynamic_properties():
+      entity['hits'] = self.hits
     return entity
 
+class StatisticsShard(SerializableExpando):
+  '''One slice of the counters (count, sum, min, max) of a sharded Statistics.
+  
+  Each shard is its own entity group, so concurrent writers that pick random
+  shards do not contend with each other. The shard keeps its slice of the
+  histograms, calendar and rollups in child entities of the same kinds and key
+  names as the unsharded ones. Readers merge the shards back together with
+  Statistics.merge_shards, get_histograms, get_calendar_counts and
+  Rollup.get_series.'''
+  statistic = db.ReferenceProperty(Statistics, collection_name = 'statistic_shards')
+  count = db.IntegerProperty(default = 0)
+  
+  @classmethod
+  def kind(cls):
+    return 'StatisticsShard'
+    
+  def counters(self):
+    values = dict((name, getattr(self, name)) for name in self.dynamic_properties())
+    values['count'] = self.count
+    return values
+  
+  @classmethod
+  def increment(cls, stats, values, counts = {}, series = None):
+    '''Transactionally folds the counter values into a random shard of the statistic, with
+    the counts by histogram name (or 'calendar') and the series (a sketch.TimeSeries) into
+    the children of the shard'''
+    shard_key = db.Key.from_path(cls.kind(), '%s.shard%d' % (stats.key().name(), random.randint(0, max(stats.shards, 1) - 1)))
+    stats_key = stats.key()
+    children = []
+    for name, value in counts.iteritems():
+      if name == 'calendar':
+        children.append((Calendar, '%s.calendar' % stats_key, dict(statistic = stats_key), value))
+      else:
+        children.append((Histogram, '%s.%s' % (stats_key, name), dict(statistic = stats_key, name = name), value))
+    for (resolution, period), buckets in (series or {}).iteritems():
+      children.append((Rollup, Rollup.key_name(stats_key, resolution, period),
+        dict(statistic = stats_key, resolution = resolution, period = period), buckets))
+    
+    def txn():
+      entities = db.get([shard_key] + [db.Key.from_path(Kind.kind(), name, parent = shard_key) for Kind, name, kwds, value in children])
+      shard = entities[0] or cls(key_name = shard_key.name(), statistic = stats_key)
+      fold_counters(shard, values)
+      models = [shard]
+      for (Kind, name, kwds, value), child in zip(children, entities[1:]):
+        child = child or Kind(parent = shard_key, key_name = name, **kwds)
+        child.merge(value)
+        models.append(child)
+      db.put(models)
+    db.run_in_transaction(txn)
+
 class Histogram(SerializableExpando):
-  json_does_not_include = ['statistic', 'name']
+  '''The counts by index of a statistic, packed in one unindexed blob (see sketch.Counts).
+  
+  Histograms written before the counts were packed keep one dynamic property per
+  index. Those are folded into the counts when they are first read, and dropped
+  from the entity the next time it is put.'''
+  json_does_not_include = ['statistic', 'name', 'version', 'packed']
   
   statistic = db.ReferenceProperty(Statistics, collection_name = 'statistic')
   name = db.StringProperty(required = True)
+  version = db.IntegerProperty(default = 0)
+  packed = db.BlobProperty()
+  
+  _counts = None
   
   @classmethod
   def kind(cls):
     return 'Histogram'
+  
+  @property
+  def counts(self):
+    '''The counts by index, decoded once per entity'''
+    if self._counts is None:
+      counts = Counts.decode(self.packed)
+      for index in self.dynamic_properties():
+        counts[index] = counts.get(index, 0) + getattr(self, index)
+        delattr(self, index)
+      self._counts = counts
+    return self._counts
+  
+  def pack(self):
+    '''Encodes the counts back into the blob, before a put'''
+    self.packed = db.Blob(self.counts.encode())
+  
+  def merge(self, counts):
+    '''Adds the counts (by index) and packs them. The indexes become strings, as they are
+    once decoded.'''
+    for index, count in counts.iteritems():
+      index = isinstance(index, unicode) and index.encode('utf-8') or str(index)
+      self.counts[index] = self.counts.get(index, 0) + count
+    self.pack()
+  
+  def __getattr__(self, key):
+    if not key.startswith('_') and key in self.counts:
+      return self.counts[key]
+    return super(Histogram, self).__getattr__(key)
+  
+  def to_dict(self):
+    return dict(self.counts)
+
+class Calendar(SerializableExpando):
+  '''Every datetime bucket of a statistic (years, months, hour.weekday, ...) packed
+  in one unindexed blob (see sketch.CalendarCounts), so that a datetime costs one
+  entity write instead of one per bucket, and the calendar is read with one get.'''
+  json_does_not_include = ['statistic', 'version', 'packed']
+  
+  statistic = db.ReferenceProperty(Statistics, collection_name = 'calendars')
+  version = db.IntegerProperty(default = 0)
+  packed = db.BlobProperty()
+  
+  _counts = None
+  
+  @classmethod
+  def kind(cls):
+    return 'Calendar'
+  
+  @property
+  def counts(self):
+    if self._counts is None:
+      self._counts = CalendarCounts.decode(self.packed)
+    return self._counts
+  
+  def pack(self):
+    self.packed = db.Blob(self.counts.encode())
+  
+  def merge(self, counts):
+    self.counts.merge(counts)
+    self.pack()
+  
+  def to_dict(self):
+    return self.counts.to_dict()
+
+class Rollup(db.Model):
+  '''Count, sum, min and max of the values of a statistic by minute of a day, hour of a
+  month or day of a year (the resolution and period), packed in one unindexed blob
+  (see sketch.SeriesBuckets), so that a series over months is a handful of gets.'''
+  MAX_PERIODS = 100 # per series
+  PERIOD_DAYS = {'minute': 1, 'hour': 31, 'day': 366} # at most
+  MAX_FOLDS = 20
+  
+  statistic = db.ReferenceProperty(Statistics, collection_name = 'rollups')
+  resolution = db.StringProperty()
+  period = db.StringProperty()
+  version = db.IntegerProperty(default = 0)
+  packed = db.BlobProperty()
+  folds = db.StringListProperty(indexed = False) # the last folds of pruned Storage, see tasks.fold
+  
+  _buckets = None
+  
+  get_by_key_names_or_insert = classmethod(get_by_key_names_or_insert)
+  
+  @classmethod
+  def kind(cls):
+    return 'Rollup'
+  
+  @staticmethod
+  def key_name(stats, resolution, period):
+    return '%s.%s.%s' % (stats, resolution, period)
+  
+  @property
+  def buckets(self):
+    if self._buckets is None:
+      self._buckets = SeriesBuckets.decode(self.packed)
+    return self._buckets
+  
+  def pack(self):
+    self.packed = db.Blob(self.buckets.encode())
+  
+  def merge(self, buckets):
+    self.buckets.merge(buckets)
+    self.pack()
+  
+  @classmethod
+  def get_series(cls, stats, resolution, since, until, shards = []):
+    '''The buckets of the statistic (a key) from the datetime since to until, as
+    (datetime, count, sum, min, max) in order, with the buckets of the shards (keys)
+    added. Costs one batch get.'''
+    try: # before the labels are made, since is whatever the request had
+      since = max(since, until - datetime.timedelta(days = cls.PERIOD_DAYS[resolution] * cls.MAX_PERIODS))
+    except OverflowError:
+      pass
+    labels = periods(resolution, since, until)[-cls.MAX_PERIODS:]
+    keys = []
+    for label in labels:
+      name = cls.key_name(stats, resolution, label)
+      keys.append(db.Key.from_path(cls.kind(), name))
+      keys.extend([db.Key.from_path(cls.kind(), name, parent = shard) for shard in shards])
+    rollups = keys and db.get(keys) or []
+    n = len(shards) + 1
+    series = []
+    for i, label in enumerate(labels):
+      buckets = SeriesBuckets()
+      for rollup in rollups[i * n:(i + 1) * n]:
+        if rollup:
+          buckets.merge(rollup.buckets)
+      series.extend([bucket for bucket in buckets.series(label, resolution) if since <= bucket[0] <= until])
+    return series
+
+class RollupState(db.Model):
+  '''What the rollups of a statistic (the key name is that of the Statistics) hold: whether
+  every Storage is in them (after a recompute), since when Storage is pruned, and the
+  fold of pruned Storage under way (see tasks.prune). Kept apart from the Statistics so
+  that the writes of the measure path cannot undo it.'''
+  rolled_up = db.BooleanProperty(default = False, indexed = False)
+  pruned_on = db.DateTimeProperty(indexed = False)
+  folding = db.StringProperty(indexed = False)
+  pending = db.ListProperty(db.Key, indexed = False)
+  
+  @classmethod
+  def kind(cls):
+    return 'RollupState'
+  
+  @classmethod
+  def update(cls, key_name, **values):
+    '''Sets the values transactionally, so that concurrent updates do not undo each other'''
+    def txn():
+      state = cls.get_by_key_name(key_name) or cls(key_name = key_name)
+      for name, value in values.iteritems():
+        setattr(state, name, value)
+      state.put()
+      return state
+    return db.run_in_transaction(txn)
+
+class RetentionPolicy(db.Model):
+  '''How many days the raw Storage and the rollups of every resolution are kept, for a
+  campaign or for one of its namespaces (the key name is that of their Statistics),
+  None keeping them for good. See tasks.PruneNamespaceTask.'''
+  RESOLUTIONS = ['minute', 'hour', 'day']
+  
+  campaign = db.ReferenceProperty(Campaign, collection_name = 'retention_policies')
+  namespace = db.StringProperty()
+  raw = db.IntegerProperty()
+  minute = db.IntegerProperty()
+  hour = db.IntegerProperty()
+  day = db.IntegerProperty()
+  updated_on = db.DateTimeProperty(auto_now = 1)
+  
+  @classmethod
+  def kind(cls):
+    return 'RetentionPolicy'
+  
+  @staticmethod
+  def key_name(campaign, namespace = None):
+    return namespace and '%s.%s' % (campaign, namespace) or str(campaign)
+  
+  @classmethod
+  def of(cls, stats):
+    '''The policy of the namespace of the statistic, else the one of its campaign'''
+    campaign = Statistics.campaign.get_value_for_datastore(stats)
+    for policy in cls.get_by_key_name([cls.key_name(campaign, stats.namespace), cls.key_name(campaign)]):
+      if policy:
+        return policy
+
+class Recompute(db.Model):
+  '''A rebuild of the statistics of a campaign, or of one of its namespaces, from its
+  Storage (see myapp.recompute). Only written in transactions, since the splitter and
+  every partition update it concurrently.'''
+  campaign = db.ReferenceProperty(Campaign, collection_name = 'recomputes')
+  namespace = db.StringProperty()
+  partitions = db.IntegerProperty(default = 0) # started so far
+  done = db.ListProperty(int, indexed = False) # indexes of the partitions done
+  split = db.BooleanProperty(default = False) # every partition is started
+  splits = db.IntegerProperty(default = 0) # tasks of the splitter
+  cursor = db.TextProperty() # of the splitter
+  boundary = db.StringProperty() # last key of the last partition
+  pending = db.IntegerProperty(default = 0) # keys after the boundary
+  namespaces = db.StringListProperty(indexed = False) # to merge, in order
+  merged = db.IntegerProperty(default = 0) # namespaces merged so far
+  merges = db.IntegerProperty(default = 0) # tasks of the merge
+  created_on = db.DateTimeProperty(auto_now_add = 1)
+  merged_on = db.DateTimeProperty()
+  
+  @classmethod
+  def kind(cls):
+    return 'Recompute'
+  
+class RecomputePartition(db.Model):
+  '''One key range of a Recompute, (start, end], with its checkpoint: the cursor of its
+  query and the namespaces aggregated so far, whose partial states are its RecomputeState
+  children. Both are written in one transaction.'''
+  job = db.ReferenceProperty(Recompute, collection_name = 'recompute_partitions')
+  index = db.IntegerProperty()
+  start = db.StringProperty()
+  end = db.StringProperty()
+  cursor = db.TextProperty()
+  namespaces = db.StringListProperty(indexed = False)
+  steps = db.IntegerProperty(default = 0)
+  done = db.BooleanProperty(default = False)
+  
+  @classmethod
+  def kind(cls):
+    return 'RecomputePartition'
+
+class RecomputeState(db.Model):
+  '''The partial state of one namespace in a RecomputePartition (its parent), keyed by the
+  namespace, so that no checkpoint holds more than one namespace'''
+  data = db.BlobProperty() # pickled type, topk and state
+  
+  @classmethod
+  def kind(cls):
+    return 'RecomputeState'
+  
+  @staticmethod
+  def key_for(partition, namespace):
+    return db.Key.from_path('RecomputeState', namespace, parent = partition)
 
 class TaskModel(db.Expando):
+  '''A background task on an object (see myapp.tasks). The scheduler claims the tasks
+  whose lease has expired, and a runner holds the lease while it works on one.'''
   object = db.ReferenceProperty(required = True)
   task = db.StringProperty(required = True)
+  lease = db.StringProperty() # token of the runner holding the lease
+  leased_until = db.DateTimeProperty() # a new task is claimable at once
   
   @classmethod
   def kind(cls):
@@ -0,0 +1,241 @@
+'''Datastore adapter of the stat pipeline.
+
+The summaries of myapp.stat only compute and merge partial states, in memory.
+This module folds those states into the Statistics, Histogram, Calendar and
+Rollup entities of a namespace, keeps the entities it touched cached between requests,
+and writes them: directly, or, for a sharded statistic, through its pending Delta
+into one of its shards.
+'''
+import logging
+from google.appengine.ext import db
+from models import Statistics, Histogram, Calendar, Rollup, RollupState, StatisticsShard, SKETCHES
+from sketch import SpaceSaving, merge_states
+import stat, cache, commit
+
+_Hists = cache.EntityCache(max_size = 2000)
+_Dirty = {}
+_Deltas = {}
+SHARD_ATTEMPTS = 2 # random shards a delta is tried on before it waits for the next flush
+
+def mark_dirty(entity):
+  '''Remembers that the entity was modified so that the next flush writes it'''
+  _Dirty[str(entity.key())] = entity
+
+def pop_dirty():
+  '''Returns the entities modified since the last call and forgets them'''
+  models = _Dirty.values()
+  _Dirty.clear()
+  return models
+
+class Delta(object):
+  '''Partial state accumulated for a sharded statistic until it is committed to one of its shards'''
+  COUNTS = ['calendar', 'series']
+  
+  def __init__(self, stats, Summary):
+    self.stats = stats
+    self.counts = Summary.histogram_names + self.COUNTS
+    self.state = {}
+
+  def counters(self):
+    '''The state with its sketches encoded, as StatisticsShard.increment folds it'''
+    return dict((name, db.Blob(value.encode()) if name in SKETCHES else value)
+      for name, value in self.state.iteritems() if name not in self.counts)
+  
+  def commit(self):
+    '''Folds the delta into a random shard, in one transaction'''
+    counts = dict((name, self.state[name]) for name in self.counts if name in self.state and name != 'series')
+    StatisticsShard.increment(self.stats, self.counters(), counts, self.state.get('series'))
+
+def commit_deltas():
+  '''Applies the pending deltas of sharded statistics, one small transaction per statistic.
+  A delta whose transaction fails is tried on another random shard, then kept for the
+  next flush.'''
+  for key, delta in _Deltas.items():
+    for attempt in range(SHARD_ATTEMPTS):
+      try:
+        delta.commit()
+        del _Deltas[key]
+        break
+      except db.TransactionFailedError, err:
+        logging.warning('Could not commit shard delta for %s: %s' % (key, err))
+    else:
+      logging.critical('Keeping the shard delta for %s until the next flush' % key)
+
+def flush(models = []):
+  '''Commits the deltas, then writes the models and every dirty entity through the commit
+  engine (see myapp.commit), which spills to the task queue the Storage it cannot write
+  now. The aggregates it cannot write stay dirty, for the next flush to write their
+  state as it is then. Returns the models that were written and those that were not,
+  the spilled Storage among them.'''
+  commit_deltas()
+  models = models + pop_dirty()
+  cache.stamp(models)
+  written, unwritten = commit.put(models)
+  cache.publish(written)
+  for model in unwritten:
+    if cache.is_versioned(model):
+      mark_dirty(model)
+  return written, unwritten
+
+def calculate(Summary, datum):
+  calculate_many(Summary, [datum])
+
+def calculate_many(Summary, datums):
+  '''Folds the state of a batch of prepared datums into their Statistics (datum.stats)'''
+  apply(Summary, datums[0].stats, Summary.state(datums))
+
+def apply(Summary, stats, state):
+  '''Folds a partial state into the statistic: the counts into its histograms and calendar,
+  the series into its rollups, the counters and sketches into the statistic itself. For a
+  sharded statistic all of it goes into its pending Delta instead.'''
+  state = dict(state)
+  if (stats.shards):
+    for name in Summary.histogram_names + ['calendar']:
+      if name in state and name not in stats.histograms:
+        stats.histograms.append(name)
+        mark_dirty(stats)
+    key = str(stats.key())
+    if not _Deltas.has_key(key):
+      _Deltas[key] = Delta(stats, Summary)
+    merge_states(_Deltas[key].state, state)
+    return
+  
+  for name in Summary.histogram_names:
+    if name in state:
+      tally_many(stats, name, state.pop(name))
+  if 'calendar' in state:
+    tally_calendar(stats, state.pop('calendar'))
+  if 'series' in state:
+    tally_series(stats, state.pop('series'))
+
+  if stats.topk and 'hits_sketch' in state: # a lower topk takes effect at once
+    sketch(stats, 'hits_sketch', SpaceSaving).k = stats.topk
+  current = {}
+  for name in state:
+    if name in SKETCHES:
+      current[name] = sketch(stats, name, SKETCHES[name])
+    else:
+      current[name] = getattr(stats, name, None)
+  for name, value in merge_states(current, state).iteritems():
+    setattr(stats, name, db.Blob(value.encode()) if name in SKETCHES else value)
+  if stats.count and getattr(stats, 'sum', None) is not None:
+    stats.mean = float(stats.sum) / stats.count
+  mark_dirty(stats)
+
+def tally_many(stats, name, counts):
+  '''Adds the counts (by index) to the histogram of the statistic'''
+  if name not in stats.histograms:
+    stats.histograms.append(name)
+    mark_dirty(stats)
+
+  key = '%s.%s' % (stats.key(), name)
+  hist = _Hists.get(key)
+  if hist is None:
+    hist = _Hists.set(key, Histogram.get_by_key_name_or_insert(key, statistic = stats, name = name))
+
+  buckets = hist.counts
+  for index, count in counts.iteritems():
+    if (not isinstance(index, str)):
+      try:
+        index = str(index)
+      except:
+        logging.critical('Could not str(%s)' % index)
+        continue
+    buckets[index] = buckets.get(index, 0) + count
+  hist.pack()
+  mark_dirty(hist)
+
+def tally_calendar(stats, counts):
+  '''Adds the counts (a sketch.CalendarCounts) to the calendar of the statistic'''
+  if 'calendar' not in stats.histograms:
+    stats.histograms.append('calendar')
+    mark_dirty(stats)
+
+  key = '%s.calendar' % stats.key()
+  calendar = _Hists.get(key)
+  if calendar is None:
+    calendar = _Hists.set(key, Calendar.get_by_key_name_or_insert(key, statistic = stats))
+  calendar.counts.merge(counts)
+  calendar.pack()
+  mark_dirty(calendar)
+
+def tally_series(stats, series):
+  '''Adds the series (a sketch.TimeSeries) to the rollups of the statistic'''
+  for (resolution, period), buckets in series.iteritems():
+    key = Rollup.key_name(stats.key(), resolution, period)
+    rollup = _Hists.get(key)
+    if rollup is None:
+      rollup = _Hists.set(key, Rollup.get_or_insert(key, statistic = stats, resolution = resolution, period = period))
+    rollup.buckets.merge(buckets)
+    rollup.pack()
+    mark_dirty(rollup)
+
+def sketch(stats, name, Sketch):
+  '''The named sketch of the statistic, decoded once and kept on it between requests'''
+  attr = '_%s' % name
+  if getattr(stats, attr, None) is None:
+    setattr(stats, attr, Sketch.decode(getattr(stats, name, None)))
+  return getattr(stats, attr)
+
+def save(campaign, aggregates, replace = False):
+  '''Folds in-memory aggregates (see stat.aggregate) into the Statistics of the campaign,
+  or replaces what the statistics had with them. The rollups of a statistic whose Storage
+  was pruned (see RetentionPolicy) are kept as they are. The entities are left dirty,
+  for the next flush.'''
+  stats = Statistics.get_by_key_names_or_insert(dict(('%s.%s' % (campaign, ns),
+    dict(campaign = campaign, namespace = ns, type = record.type)) for ns, record in aggregates.iteritems()))
+  if replace:
+    names = stats.keys()
+    states = dict(zip(names, RollupState.get_by_key_name(names)))
+  for name, target in stats.iteritems():
+    record = aggregates[target.namespace]
+    state = record.state
+    if replace:
+      rollups = states[name] or RollupState(key_name = name)
+      pruned = bool(rollups.pruned_on) # the rollups are then all that is left of the deleted Storage
+      reset(target, rollups = not pruned)
+      target.type = record.type
+      if pruned:
+        state = dict(state)
+        state.pop('series', None)
+      elif not rollups.rolled_up:
+        RollupState.update(name, rolled_up = True)
+    apply(stat.get(record.type), target, state)
+
+def reset(stats, rollups = True):
+  '''Empties the statistic, its histograms, its calendar and, unless told otherwise, its
+  rollups, and deletes its shards. Those are emptied rather than deleted, so that the new versions they are written
+  with evict the copies cached by other instances. The shards are emptied instead when
+  the rollups are kept, since they hold their slice of them.'''
+  for name in stats.dynamic_properties():
+    delattr(stats, name)
+  for name in SKETCHES:
+    stats.__dict__.pop('_%s' % name, None)
+  stats.count = 0
+  stats.histograms = []
+  mark_dirty(stats)
+  
+  shards = StatisticsShard.all().filter('statistic =', stats).fetch(1000)
+  slices = []
+  for Kind in (Histogram, Calendar) + (rollups and (Rollup,) or ()):
+    for entity in Kind.all().filter('statistic =', stats):
+      if entity.parent_key(): # the slice of a shard
+        slices.append(entity.key())
+        continue
+      if isinstance(entity, db.Expando):
+        for name in entity.dynamic_properties():
+          delattr(entity, name)
+      entity.packed = None
+      entity._counts = entity._buckets = None
+      _Hists.set(entity.key().name(), entity)
+      mark_dirty(entity)
+  if rollups:
+    db.delete(slices + [shard.key() for shard in shards])
+    stats._shard_keys = []
+  else:
+    for shard in shards:
+      for name in shard.dynamic_properties():
+        delattr(shard, name)
+      shard.count = 0
+    db.put(shards)
+    db.delete(slices)
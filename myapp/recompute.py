@@ -0,0 +1,232 @@
+'''Recompute (backfill) of the statistics of a campaign from its raw Storage.
+
+A Recompute job runs entirely in the task queue, in three steps:
+  split - walks the keys of the Storage (keys only, which is cheap) and starts a
+    partition for every PARTITION_SIZE keys, as soon as its key range is known
+  work - aggregates the Storage of one key range in memory (see stat.aggregate),
+    then checkpoints the query cursor together with the partial states of the
+    namespaces it touched, one RecomputeState each, in a single transaction, and
+    continues in a new task before the request deadline
+  merge - once the last partition is done, merges the partial states of every
+    partition one namespace at a time, and writes them over the Statistics,
+    Histograms, Calendars and Rollups. Every namespace written is checkpointed,
+    and the merge continues in a new task before the request deadline
+
+A partition is counted as done by its index in the job, so that a retried task does not
+count it twice.
+
+The statistics are replaced, not added to: measurements that arrive while a
+recompute runs may be left out of the recomputed statistics.
+'''
+import time, logging, pickle, datetime
+from google.appengine.ext import db, webapp
+from models import Storage, Statistics, Recompute, RecomputePartition, RecomputeState
+from util import BUDGET, add_task
+import stat, persist
+
+URL = '/measure/_tasks/recompute/'
+PARTITION_SIZE = 5000 # keys per partition
+SPLIT_BATCH = 1000 # keys per fetch of the splitter
+BATCH = 200 # datums per fetch of a partition
+MERGE_BATCH = 10 # partial states per fetch of the merge
+
+def start(campaign, namespace = None):
+  '''Starts recomputing the statistics of the campaign, or of one of its namespaces'''
+  job = Recompute(campaign = campaign, namespace = namespace)
+  job.put()
+  enqueue('split', 'recompute-%s-split-0' % job.key().id(), job = job.key(), step = 0)
+  return job
+
+def enqueue(step, name, **params):
+  add_task(name, url = URL + step, params = dict((k, str(v)) for k, v in params.iteritems()))
+
+def update(job, **values):
+  '''Sets values on the job, transactionally since its steps update it concurrently'''
+  def txn():
+    current = Recompute.get(job.key())
+    for name, value in values.iteritems():
+      setattr(current, name, value)
+    current.put()
+    return current
+  return db.run_in_transaction(txn)
+
+def campaign(job):
+  '''The key of the campaign of the job, without fetching the campaign'''
+  return Recompute.campaign.get_value_for_datastore(job)
+
+def query(job, keys_only = False, start = None, end = None):
+  '''The Storage of the job, in key order, optionally within a key range (start, end]'''
+  q = Storage.all(keys_only = keys_only).filter('campaign =', campaign(job))
+  if job.namespace:
+    q.filter('namespace =', job.namespace)
+  if start:
+    q.filter('__key__ >', db.Key(start))
+  if end:
+    q.filter('__key__ <=', db.Key(end))
+  return q.order('__key__')
+
+def split(job, step):
+  '''Starts a partition for every PARTITION_SIZE keys, for as long as the budget lasts'''
+  deadline = time.time() + BUDGET
+  cursor, boundary, pending, partitions = job.cursor, job.boundary, job.pending, job.partitions
+  while True:
+    q = query(job, keys_only = True)
+    if cursor:
+      q.with_cursor(cursor)
+    keys = q.fetch(SPLIT_BATCH)
+    cursor = q.cursor()
+    pending += len(keys)
+    if len(keys) < SPLIT_BATCH:
+      start_partition(job, partitions, boundary, None)
+      job = update(job, partitions = partitions + 1, split = True, cursor = cursor, pending = 0)
+      return finish(job)
+    if pending >= PARTITION_SIZE:
+      start_partition(job, partitions, boundary, str(keys[-1]))
+      partitions, boundary, pending = partitions + 1, str(keys[-1]), 0
+      job = update(job, partitions = partitions, boundary = boundary, cursor = cursor, pending = 0)
+    if time.time() > deadline:
+      update(job, partitions = partitions, boundary = boundary, cursor = cursor, pending = pending, splits = step + 1)
+      return enqueue('split', 'recompute-%s-split-%s' % (job.key().id(), step + 1), job = job.key(), step = step + 1)
+
+def start_partition(job, i, start, end):
+  key_name = '%s.%s' % (job.key().id(), i)
+  RecomputePartition.get_or_insert(key_name, job = job, index = i, start = start, end = end)
+  enqueue('work', 'recompute-%s-work-%s-0' % (job.key().id(), i), partition = key_name, step = 0)
+
+def work(partition, step):
+  '''Aggregates the key range of the partition from its last checkpoint, for as long as the budget lasts'''
+  job = partition.job
+  aggregates = {}
+  deadline = time.time() + BUDGET
+  cursor = partition.cursor
+  while True:
+    q = query(job, start = partition.start, end = partition.end)
+    if cursor:
+      q.with_cursor(cursor)
+    data = q.fetch(BATCH)
+    cursor = q.cursor()
+    aggregate(job, partition, data, aggregates)
+
+    if len(data) < BATCH:
+      if checkpoint(partition, step, cursor, aggregates, done = True):
+        complete(job, partition.index)
+      return
+    if time.time() > deadline:
+      if checkpoint(partition, step, cursor, aggregates):
+        enqueue('work', 'recompute-%s-work-%s' % (partition.key().name().replace('.', '-'), step + 1),
+          partition = partition.key().name(), step = step + 1)
+      return
+
+def checkpoint(partition, step, cursor, aggregates, done = False):
+  '''Writes the cursor of the partition together with the states of the namespaces aggregated
+  by this step, in one transaction. Returns False if another run of the step got there first.'''
+  states = [RecomputeState(key = RecomputeState.key_for(partition.key(), ns), data = db.Blob(encode(record)))
+    for ns, record in aggregates.iteritems()]
+  def txn():
+    current = RecomputePartition.get(partition.key())
+    if current.steps != step:
+      return False
+    current.cursor = cursor
+    current.namespaces = sorted(set(current.namespaces) | set(aggregates))
+    current.steps = step + 1
+    current.done = done
+    db.put([current] + states)
+    return True
+  return db.run_in_transaction(txn)
+
+def complete(job, index):
+  '''Counts the partition as done, once however often it is retried, and merges if it is the last'''
+  def txn():
+    current = Recompute.get(job.key())
+    if index not in current.done:
+      current.done.append(index)
+      current.put()
+    return current
+  finish(db.run_in_transaction(txn))
+
+def aggregate(job, partition, data, aggregates):
+  '''Adds the Storage to the aggregates by namespace. A namespace new to this step starts from
+  its checkpointed state in the partition, else from the type and topk of its Statistics.'''
+  missing = set([datum.namespace for datum in data if datum.namespace not in aggregates])
+  if missing:
+    names = list(missing)
+    for ns, state in zip(names, RecomputeState.get([RecomputeState.key_for(partition.key(), ns) for ns in names])):
+      if state:
+        aggregates[ns] = decode(ns, state.data)
+    names = [ns for ns in names if ns not in aggregates]
+    for ns, stats in zip(names, Statistics.get_by_key_name(['%s.%s' % (campaign(job), ns) for ns in names])):
+      if stats:
+        aggregates[ns] = stat.Aggregate(ns, stats.type or 'number', stats.topk)
+  stat.aggregate([{'namespace': datum.namespace, 'type': datum.type, 'value': getattr(datum, 'value', None),
+    'created_on': datum.created_on} for datum in data], aggregates)
+
+def finish(job):
+  '''Merges the partitions once every one of them is done'''
+  if job.split and len(job.done) >= job.partitions:
+    enqueue('merge', 'recompute-%s-merge-0' % job.key().id(), job = job.key(), step = 0)
+
+def merge(job, step):
+  '''Merges the partial states of the partitions and replaces the statistics with them, one
+  namespace at a time from the last one merged, for as long as the budget lasts. Only the
+  states of one namespace are decoded at a time, MERGE_BATCH of them at once.'''
+  deadline = time.time() + BUDGET
+  keys = [db.Key.from_path('RecomputePartition', '%s.%s' % (job.key().id(), i)) for i in range(job.partitions)]
+  if not job.merged:
+    namespaces = set()
+    for partition in RecomputePartition.get(keys):
+      if partition:
+        namespaces.update(partition.namespaces)
+    job = update(job, namespaces = sorted(namespaces))
+  first = job.merged
+  for i in range(first, len(job.namespaces)):
+    if i > first and time.time() > deadline: # one namespace at least, so that every task moves on
+      update(job, merges = step + 1)
+      return enqueue('merge', 'recompute-%s-merge-%s' % (job.key().id(), step + 1), job = job.key(), step = step + 1)
+    ns = job.namespaces[i]
+    states = [RecomputeState.key_for(key, ns) for key in keys]
+    record = None
+    for j in range(0, len(states), MERGE_BATCH):
+      for state in RecomputeState.get(states[j:j + MERGE_BATCH]):
+        if state:
+          other = decode(ns, state.data)
+          record = record and record.merge(other) or other
+    if record:
+      persist.save(campaign(job), {ns: record}, replace = True)
+      persist.flush()
+    job = update(job, merged = i + 1)
+    db.delete(states)
+  update(job, merged_on = datetime.datetime.now())
+  db.delete(keys)
+  logging.info('Recomputed %s namespaces of %s' % (len(job.namespaces), campaign(job)))
+
+def encode(record):
+  return pickle.dumps((record.type, record.topk, record.state), 2)
+
+def decode(ns, data):
+  '''The aggregate of the namespace in a checkpoint'''
+  kind, topk, state = pickle.loads(data)
+  record = stat.Aggregate(ns, kind, topk)
+  record.state = state
+  return record
+
+class RecomputePage(webapp.RequestHandler):
+  '''Runs the steps of a recompute for the task queue. A step whose checkpoint has
+  moved on already (a retried task) does nothing.'''
+  def post(self, name):
+    step = int(self.request.get('step', 0))
+    if name == 'split':
+      job = Recompute.get(self.request.get('job'))
+      if job and not job.split and job.splits == step:
+        split(job, step)
+    elif name == 'work':
+      partition = RecomputePartition.get_by_key_name(self.request.get('partition'))
+      if partition and partition.done:
+        complete(partition.job, partition.index) # in case the task failed after its checkpoint
+      elif partition and partition.steps == step:
+        work(partition, step)
+    elif name == 'merge':
+      job = Recompute.get(self.request.get('job'))
+      if job and not job.merged_on and job.merges == step:
+        merge(job, step)
+    else:
+      self.error(404)
@@ -1,8 +1,9 @@
-import os, logging, math, re, urlparse
+import os, logging, math, re, urlparse, datetime, calendar
 from django.utils import simplejson
 from operator import itemgetter
 
-from models import Storage, Statistics, Histogram
+from models import Storage, Statistics, Histogram, Rollup
+from sketch import RESOLUTIONS
 import util, visualize
 
 DEBUG = os.environ['SERVER_SOFTWARE'].startswith('Dev')
@@ -33,6 +34,10 @@ class NoRenderer(object):
   @classmethod
   def get_statistics(cls, campaign, ns, path = ''):
     return {}
+  
+  @classmethod
+  def get_series(cls, campaign, ns, resolution, since, until):
+    return []
     
   @classmethod
   def render_values(cls, page):
@@ -41,6 +46,8 @@ class NoRenderer(object):
       
   @classmethod
   def render_stats(cls, page):
+    if page.path == 'series':
+      return cls.render_series(page)
     stats = cls.get_statistics(page.campaign, page.namespace, page.path)
     order = page.request.get('order', '').lower()
     if order:
@@ -48,6 +55,22 @@ class NoRenderer(object):
         stats = sorted(stats.items(), key=itemgetter(1), reverse = order == 'desc')
     return cls.render(page, stats)
   
+  @classmethod
+  def render_series(cls, page):
+    '''The rollups of the namespace: resolution is minute, hour (default) or day, since and
+    until are seconds since the epoch (UTC), by default the last 30 buckets and now.'''
+    resolution = page.request.get('resolution', 'hour')
+    if resolution not in RESOLUTIONS:
+      return page.error(400)
+    try:
+      until = datetime.datetime.utcfromtimestamp(float(page.request.get('until') or calendar.timegm(datetime.datetime.utcnow().timetuple())))
+      since = page.request.get('since')
+      since = since and datetime.datetime.utcfromtimestamp(float(since)) or until - datetime.timedelta(seconds = 30 * RESOLUTIONS[resolution][2])
+    except (ValueError, OverflowError):
+      return page.error(400)
+    series = cls.get_series(page.campaign, page.namespace, resolution, since, until)
+    return cls.render(page, {'resolution': resolution, 'series': series})
+  
   @classmethod
   def render(cls, page, data = None):
     page.response.headers.add_header('Content-Type', MIMETYPES.get(page.format, 'text/plain'))
@@ -66,6 +89,21 @@ class Renderer(NoRenderer):
     if (data and path):
       data = util.getattr_by_path(data, path)
     return data
+  
+  @classmethod
+  def get_series(cls, campaign, ns, resolution, since, until):
+    '''The buckets from since to until, as dicts of time (seconds since the epoch), count,
+    and for numbers sum, min, max and mean'''
+    stats = Statistics.get_by_key_name('%s.%s' % (campaign, ns))
+    if not stats:
+      return []
+    series = []
+    for when, count, total, low, high in Rollup.get_series(stats.key(), resolution, since, until, stats.shard_keys()):
+      bucket = {'time': calendar.timegm(when.timetuple()), 'count': count}
+      if total is not None:
+        bucket.update({'sum': total, 'min': low, 'max': high, 'mean': float(total) / count})
+      series.append(bucket)
+    return series
 
 class JSONRenderer(Renderer):
   match_formats = ['json']
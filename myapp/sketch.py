@@ -0,0 +1,597 @@
+'''Compact, mergeable summaries of a stream of values.
+
+Every sketch can be updated one batch at a time, merged with another sketch of
+the same kind, and encoded to a small string that is stored as an unindexed
+db.Blob on the Statistics (or the Histogram) of a namespace.
+'''
+import struct, math, hashlib, datetime
+from array import array
+
+class TDigest(object):
+  '''Streaming quantiles (t-digest, merging variant).
+
+  Values are kept as weighted centroids, small near the tails and larger around
+  the median (the arcsine scale function), so the extreme quantiles (p95, p99)
+  stay accurate. There are at most about `compression` centroids, whatever the
+  number of values.'''
+  HEADER = '!H'
+  CENTROID = '!dd'
+
+  def __init__(self, compression = 200, centroids = None):
+    self.compression = compression
+    self.centroids = centroids or []
+    self.buffer = []
+
+  def __len__(self):
+    return int(sum([weight for mean, weight in self.centroids + self.buffer]))
+
+  def update(self, values):
+    self.buffer.extend([(float(value), 1.0) for value in values])
+    if len(self.buffer) > 5 * self.compression:
+      self.compress()
+    return self
+
+  def merge(self, other):
+    self.buffer.extend(other.centroids + other.buffer)
+    self.compress()
+    return self
+
+  def compress(self):
+    points = sorted(self.centroids + self.buffer)
+    self.buffer = []
+    total = sum([weight for mean, weight in points])
+    centroids = []
+    cumulative = start = 0.0
+    for mean, weight in points:
+      if centroids and self.scale((cumulative + weight) / total) - self.scale(start / total) <= 1:
+        last_mean, last_weight = centroids[-1]
+        merged = last_weight + weight
+        centroids[-1] = (last_mean + (mean - last_mean) * weight / merged, merged)
+      else:
+        start = cumulative
+        centroids.append((mean, weight))
+      cumulative += weight
+    self.centroids = centroids
+    return self
+
+  def scale(self, q):
+    return self.compression / (2 * math.pi) * math.asin(2 * min(max(q, 0.0), 1.0) - 1)
+
+  def quantile(self, q):
+    '''The value below which a fraction q (0 to 1) of the values fall, or None when empty'''
+    self.compress()
+    centroids = self.centroids
+    if not centroids:
+      return None
+    q = min(max(q, 0.0), 1.0)
+    target = q * sum([weight for mean, weight in centroids])
+    cumulative = 0.0
+    for i, (mean, weight) in enumerate(centroids):
+      center = cumulative + weight / 2.0
+      if center >= target:
+        if i == 0:
+          return mean
+        prev_mean, prev_weight = centroids[i - 1]
+        prev_center = cumulative - prev_weight / 2.0
+        return prev_mean + (target - prev_center) * (mean - prev_mean) / (center - prev_center)
+      cumulative += weight
+    return centroids[-1][0]
+
+  def encode(self):
+    self.compress()
+    data = [struct.pack(self.HEADER, self.compression)]
+    data.extend([struct.pack(self.CENTROID, mean, weight) for mean, weight in self.centroids])
+    return ''.join(data)
+
+  @classmethod
+  def decode(cls, data):
+    if not data:
+      return cls()
+    header = struct.calcsize(cls.HEADER)
+    size = struct.calcsize(cls.CENTROID)
+    compression, = struct.unpack(cls.HEADER, data[:header])
+    centroids = [struct.unpack(cls.CENTROID, data[i:i + size]) for i in range(header, len(data), size)]
+    return cls(compression, centroids)
+
+class Moments(object):
+  '''Count, mean and central moments (M2, M3, M4) of a stream of values.
+
+  Batches are folded in with the pairwise update of Welford/Pebay, which stays
+  numerically stable and makes two Moments mergeable in O(1), so the variance,
+  standard deviation, skew and kurtosis never need another pass over the values.'''
+  FORMAT = '!5d'
+
+  def __init__(self, n = 0.0, mean = 0.0, m2 = 0.0, m3 = 0.0, m4 = 0.0):
+    self.n, self.mean, self.m2, self.m3, self.m4 = n, mean, m2, m3, m4
+
+  def update(self, values):
+    values = [float(value) for value in values]
+    if not values:
+      return self
+    n = float(len(values))
+    mean = sum(values) / n
+    deviations = [value - mean for value in values]
+    return self.merge(Moments(n, mean,
+      sum([d * d for d in deviations]),
+      sum([d * d * d for d in deviations]),
+      sum([d * d * d * d for d in deviations])))
+
+  def merge(self, other):
+    na, nb = self.n, other.n
+    if not nb:
+      return self
+    if not na:
+      self.n, self.mean, self.m2, self.m3, self.m4 = other.n, other.mean, other.m2, other.m3, other.m4
+      return self
+    n = na + nb
+    delta = other.mean - self.mean
+    m2 = self.m2 + other.m2 + delta ** 2 * na * nb / n
+    m3 = (self.m3 + other.m3 + delta ** 3 * na * nb * (na - nb) / n ** 2
+      + 3 * delta * (na * other.m2 - nb * self.m2) / n)
+    m4 = (self.m4 + other.m4 + delta ** 4 * na * nb * (na * na - na * nb + nb * nb) / n ** 3
+      + 6 * delta ** 2 * (na * na * other.m2 + nb * nb * self.m2) / n ** 2
+      + 4 * delta * (na * other.m3 - nb * self.m3) / n)
+    self.n, self.mean, self.m2, self.m3, self.m4 = n, self.mean + delta * nb / n, m2, m3, m4
+    return self
+
+  @property
+  def variance(self):
+    '''Sample variance'''
+    return self.n > 1 and self.m2 / (self.n - 1) or 0.0
+
+  @property
+  def stddev(self):
+    return self.variance ** 0.5
+
+  @property
+  def skew(self):
+    if not self.m2:
+      return None
+    return self.n ** 0.5 * self.m3 / self.m2 ** 1.5
+
+  @property
+  def kurtosis(self):
+    '''Excess kurtosis (0 for a normal distribution)'''
+    if not self.m2:
+      return None
+    return self.n * self.m4 / self.m2 ** 2 - 3
+
+  def encode(self):
+    return struct.pack(self.FORMAT, self.n, self.mean, self.m2, self.m3, self.m4)
+
+  @classmethod
+  def decode(cls, data):
+    if not data:
+      return cls()
+    return cls(*struct.unpack(cls.FORMAT, data))
+
+class HyperLogLog(object):
+  '''Approximate number of distinct values (HyperLogLog).
+
+  Keeps 2 ** precision one byte registers (4KB by default) whatever the number
+  of values, with a standard error of about 1.04 / sqrt(2 ** precision), 1.6%
+  by default. Two sketches of the same precision merge register by register.'''
+  def __init__(self, precision = 12, registers = None):
+    self.precision = precision
+    self.size = 1 << precision
+    self.registers = registers or array('B', [0] * self.size)
+
+  def update(self, values):
+    p, registers = self.precision, self.registers
+    width = 64 - p
+    for value in values:
+      if isinstance(value, unicode):
+        value = value.encode('utf-8')
+      h = long(hashlib.sha1(str(value)).hexdigest()[:16], 16)
+      index = h >> width
+      rank = 1 # position of the first 1 bit after the index bits
+      while rank <= width and not h & (1 << (width - rank)):
+        rank += 1
+      if rank > registers[index]:
+        registers[index] = rank
+    return self
+
+  def merge(self, other):
+    for i, rank in enumerate(other.registers):
+      if rank > self.registers[i]:
+        self.registers[i] = rank
+    return self
+
+  def __len__(self):
+    m = float(self.size)
+    alpha = 0.7213 / (1 + 1.079 / m)
+    estimate = alpha * m * m / sum([2.0 ** -rank for rank in self.registers])
+    zeros = self.registers.count(0)
+    if estimate <= 2.5 * m and zeros:
+      estimate = m * math.log(m / zeros)
+    return int(round(estimate))
+
+  def encode(self):
+    return chr(self.precision) + self.registers.tostring()
+
+  @classmethod
+  def decode(cls, data):
+    if not data:
+      return cls()
+    registers = array('B')
+    registers.fromstring(data[1:])
+    return cls(ord(data[0]), registers)
+
+class SpaceSaving(object):
+  '''The k most frequent values of a stream (Space-Saving).
+
+  Keeps at most k counters. A value without a counter takes over the smallest
+  one, inheriting its count as the error bound of its own, so every count is an
+  overestimate by at most its error, and any value more frequent than the
+  smallest counter is guaranteed to be kept.
+
+  Values are cut to their first MAX_VALUE bytes, so that a sketch of the largest k
+  (Statistics.MAX_TOPK) encodes well within an entity.'''
+  HEADER = '!H'
+  ENTRY = '!IIH'
+  MAX_VALUE = 500 # bytes
+
+  def __init__(self, k = 100, counters = None):
+    self.k = k
+    self.counters = counters or {} # value: [count, error]
+
+  def update(self, values):
+    counts = {}
+    for value in values:
+      if isinstance(value, unicode):
+        value = value.encode('utf-8')
+      value = str(value)[:self.MAX_VALUE] # values are kept as the strings they are encoded to
+      counts[value] = counts.get(value, 0) + 1
+    for value, count in counts.iteritems():
+      self.add(value, count)
+    return self
+
+  def add(self, value, count, error = 0):
+    counters = self.counters
+    if value in counters:
+      counters[value][0] += count
+      counters[value][1] += error
+    elif len(counters) < self.k:
+      counters[value] = [count, error]
+    else:
+      smallest = min(counters, key = lambda v: counters[v][0])
+      floor = counters.pop(smallest)[0]
+      counters[value] = [floor + count, floor + error]
+
+  def merge(self, other):
+    '''Merges the counters of both sketches, charging a value missing from a full sketch
+    with the smallest count of that sketch, then keeps the k largest'''
+    mine, theirs = self.floor(), other.floor()
+    merged = {}
+    for value in set(self.counters) | set(other.counters):
+      count, error = self.counters.get(value, [mine, mine])
+      other_count, other_error = other.counters.get(value, [theirs, theirs])
+      merged[value] = [count + other_count, error + other_error]
+    k = max(self.k, other.k)
+    self.k = k
+    self.counters = dict(sorted(merged.items(), key = lambda item: item[1][0], reverse = True)[:k])
+    return self
+
+  def floor(self):
+    '''The count that any value without a counter may have reached'''
+    if len(self.counters) < self.k:
+      return 0
+    return min([count for count, error in self.counters.itervalues()])
+
+  def top(self, n = None):
+    '''[(value, count, error)] by decreasing count'''
+    items = sorted(self.counters.items(), key = lambda item: item[1][0], reverse = True)[:n or self.k]
+    return [(value, count, error) for value, (count, error) in items]
+
+  def __len__(self):
+    return len(self.counters)
+
+  def encode(self):
+    data = [struct.pack(self.HEADER, self.k)]
+    for value, count, error in self.top():
+      value = value[:self.MAX_VALUE]
+      data.append(struct.pack(self.ENTRY, count, error, len(value)) + value)
+    return ''.join(data)
+
+  @classmethod
+  def decode(cls, data):
+    if not data:
+      return cls()
+    k, = struct.unpack(cls.HEADER, data[:2])
+    size = struct.calcsize(cls.ENTRY)
+    counters = {}
+    i = 2
+    while i < len(data):
+      count, error, length = struct.unpack(cls.ENTRY, data[i:i + size])
+      i += size
+      counters[data[i:i + length]] = [count, error]
+      i += length
+    return cls(k, counters)
+
+class Counts(dict):
+  '''Counts by index (a histogram), encoded as the sorted indexes, each followed by
+  its count as a varint, so that a histogram is one small unindexed blob instead
+  of one indexed property per bucket.'''
+  def update(self, counts):
+    for index, count in counts.iteritems():
+      self[index] = self.get(index, 0) + count
+    return self
+
+  def merge(self, other):
+    return self.update(other)
+
+  def encode(self):
+    data = []
+    for index in sorted(self):
+      value = isinstance(index, unicode) and index.encode('utf-8') or str(index)
+      data.append(varint(len(value)) + value + varint(self[index]))
+    return ''.join(data)
+
+  @classmethod
+  def decode(cls, data):
+    counts = cls()
+    i, size = 0, len(data or '')
+    while i < size:
+      length, i = read_varint(data, i)
+      index = data[i:i + length]
+      count, i = read_varint(data, i + length)
+      counts[index] = count
+    return counts
+
+def varint(n):
+  '''The non-negative integer n in 7 bits per byte, lowest bits first'''
+  n = int(n)
+  data = []
+  while n > 0x7F:
+    data.append(chr(n & 0x7F | 0x80))
+    n >>= 7
+  data.append(chr(n))
+  return ''.join(data)
+
+def read_varint(data, i):
+  '''The varint at position i of data, and the position after it'''
+  n = shift = 0
+  while True:
+    byte = ord(data[i])
+    i += 1
+    n |= (byte & 0x7F) << shift
+    if not byte & 0x80:
+      return n, i
+    shift += 7
+
+class CalendarCounts(object):
+  '''Counts of datetimes by month, day, hour, minute, second, weekday, day and
+  week of the year, and by pairs of those (hour of the weekday, ...), each in a
+  fixed-shape array of counters, plus the counts by year.
+
+  All the arrays live in one flat list of cells, encoded as varints after the
+  years, so a whole calendar is a couple of KB whatever the number of values.'''
+  FIELDS = { # name: (lowest, highest)
+    'month': (1, 12), 'day': (1, 31), 'hour': (0, 23), 'minute': (0, 59), 'second': (0, 59),
+    'weekday': (0, 6), 'yday': (1, 366), 'week': (0, 53)}
+  BUCKETS = [
+    ('months', ('month',)),
+    ('days', ('day',)),
+    ('hours', ('hour',)),
+    ('minutes', ('minute',)),
+    ('seconds', ('second',)),
+    ('weekdays', ('weekday',)),
+    ('dayth', ('yday',)),
+    ('weekdayth', ('week',)),
+    ('hour.weekday', ('hour', 'weekday')),
+    ('day.hour', ('day', 'hour')),
+    ('weekday.month', ('weekday', 'day')),
+  ]
+  NAMES = ['years'] + [name for name, fields in BUCKETS]
+  LAYOUT = [] # (name, fields, offset of the first cell)
+  SIZE = 0
+  for name, fields in BUCKETS:
+    LAYOUT.append((name, fields, SIZE))
+    size = 1
+    for field in fields:
+      size *= FIELDS[field][1] - FIELDS[field][0] + 1
+    SIZE += size
+  del name, fields, field, size
+
+  def __init__(self, cells = None, years = None):
+    self.cells = cells or [0] * self.SIZE
+    self.years = years or Counts()
+
+  def update(self, datetimes):
+    cells, years, layout, ranges = self.cells, self.years, self.LAYOUT, self.FIELDS
+    for value in datetimes:
+      t = value.timetuple()
+      sunday_first = (t[6] + 1) % 7
+      fields = {'month': t[1], 'day': t[2], 'hour': t[3], 'minute': t[4], 'second': min(t[5], 59),
+        'weekday': t[6], 'yday': t[7], 'week': (t[7] + 6 - sunday_first) / 7} # week as in strftime('%U')
+      years.update({str(t[0]): 1})
+      for name, names, offset in layout:
+        cell = 0
+        for field in names:
+          low, high = ranges[field]
+          cell = cell * (high - low + 1) + fields[field] - low
+        cells[offset + cell] += 1
+    return self
+
+  def merge(self, other):
+    self.cells = [a + b for a, b in zip(self.cells, other.cells)]
+    self.years.merge(other.years)
+    return self
+
+  def bucket(self, name):
+    '''The counts of one bucket by index, as the separate histograms had them: '5',
+    '23.6' (the 23rd hour of a sunday), weeks as '00' to '53'. Zeros are left out.'''
+    if name == 'years':
+      return dict(self.years)
+    for bucket, names, offset in self.LAYOUT:
+      if bucket == name:
+        break
+    else:
+      raise KeyError(name)
+    sizes = [self.FIELDS[field][1] - self.FIELDS[field][0] + 1 for field in names]
+    counts = {}
+    for cell in range(reduce(lambda a, b: a * b, sizes)):
+      count = self.cells[offset + cell]
+      if not count:
+        continue
+      indexes, rest = [], cell
+      for field, size in reversed(zip(names, sizes)):
+        indexes.insert(0, rest % size + self.FIELDS[field][0])
+        rest /= size
+      counts[name == 'weekdayth' and '%02d' % indexes[0] or '.'.join(map(str, indexes))] = count
+    return counts
+
+  def to_dict(self):
+    return dict((name, self.bucket(name)) for name in self.NAMES)
+
+  def encode(self):
+    years = self.years.encode()
+    return varint(len(years)) + years + ''.join([varint(count) for count in self.cells])
+
+  @classmethod
+  def decode(cls, data):
+    if not data:
+      return cls()
+    length, i = read_varint(data, 0)
+    years = Counts.decode(data[i:i + length])
+    i += length
+    cells = []
+    while i < len(data):
+      count, i = read_varint(data, i)
+      cells.append(count)
+    return cls(cells, years)
+
+RESOLUTIONS = { # name: (period of a timetuple, bucket of a timetuple, seconds per bucket)
+  'minute': (lambda t: '%04d-%02d-%02d' % t[:3], lambda t: t[3] * 60 + t[4], 60),
+  'hour': (lambda t: '%04d-%02d' % t[:2], lambda t: (t[2] - 1) * 24 + t[3], 3600),
+  'day': (lambda t: '%04d' % t[0], lambda t: t[7] - 1, 86400),
+}
+
+def period_start(period):
+  '''The datetime a period ('2010', '2010-03' or '2010-03-14') starts at'''
+  return datetime.datetime(*([int(part) for part in period.split('-')] + [1, 1])[:3])
+
+def periods(resolution, since, until):
+  '''The periods of the resolution from the datetime since to until, in order'''
+  period = RESOLUTIONS[resolution][0]
+  labels = []
+  t = datetime.datetime(since.year, resolution == 'day' and 1 or since.month, resolution == 'minute' and since.day or 1)
+  while t <= until:
+    labels.append(period(t.timetuple()))
+    if resolution == 'minute':
+      t += datetime.timedelta(days = 1)
+    elif resolution == 'hour':
+      t = datetime.datetime(t.year + t.month / 12, t.month % 12 + 1, 1)
+    else:
+      t = datetime.datetime(t.year + 1, 1, 1)
+  return labels
+
+class SeriesBuckets(dict):
+  '''Count, sum, min and max of the values of one period (the minutes of a day, the
+  hours of a month or the days of a year) by bucket. Encoded as the sorted buckets
+  that are not empty: bucket and count as varints, a flag, and when the values were
+  numbers their sum, min and max as doubles.'''
+  NUMBERS = struct.Struct('<ddd')
+
+  def add(self, bucket, value):
+    cell = self.get(bucket)
+    if cell is None:
+      cell = self[bucket] = [0, None, None, None]
+    cell[0] += 1
+    if isinstance(value, (int, long, float)):
+      self.fold(cell, value, value, value)
+    return self
+
+  @staticmethod
+  def fold(cell, total, low, high):
+    if cell[1] is None:
+      cell[1:] = [total, low, high]
+    else:
+      cell[1:] = [cell[1] + total, min(cell[2], low), max(cell[3], high)]
+
+  def merge(self, other):
+    for bucket, (count, total, low, high) in other.iteritems():
+      cell = self.get(bucket)
+      if cell is None:
+        self[bucket] = [count, total, low, high]
+        continue
+      cell[0] += count
+      if total is not None:
+        self.fold(cell, total, low, high)
+    return self
+
+  def series(self, period, resolution):
+    '''The buckets as (datetime, count, sum, min, max), in order'''
+    start, seconds = period_start(period), RESOLUTIONS[resolution][2]
+    return [(start + datetime.timedelta(seconds = bucket * seconds),) + tuple(self[bucket]) for bucket in sorted(self)]
+
+  def encode(self):
+    data = []
+    for bucket in sorted(self):
+      count, total, low, high = self[bucket]
+      numbers = total is not None
+      data.append(varint(bucket) + varint(count) + chr(numbers) + (numbers and self.NUMBERS.pack(total, low, high) or ''))
+    return ''.join(data)
+
+  @classmethod
+  def decode(cls, data):
+    buckets = cls()
+    i, size = 0, len(data or '')
+    while i < size:
+      bucket, i = read_varint(data, i)
+      count, i = read_varint(data, i)
+      numbers = ord(data[i])
+      i += 1
+      if numbers:
+        buckets[bucket] = [count] + list(cls.NUMBERS.unpack(data[i:i + cls.NUMBERS.size]))
+        i += cls.NUMBERS.size
+      else:
+        buckets[bucket] = [count, None, None, None]
+    return buckets
+
+class TimeSeries(dict):
+  '''SeriesBuckets by (resolution, period), for every resolution: the partial state of
+  the rollups of a namespace, which myapp.persist folds into its Rollup entities'''
+  def update(self, values):
+    '''Adds the (datetime, value) pairs. A value that is not a number is only counted.'''
+    for when, value in values:
+      t = when.timetuple()
+      for resolution, (period, bucket, seconds) in RESOLUTIONS.iteritems():
+        key = (resolution, period(t))
+        if key not in self:
+          self[key] = SeriesBuckets()
+        self[key].add(bucket(t), value)
+    return self
+
+  def merge(self, other):
+    for key, buckets in other.iteritems():
+      if key in self:
+        self[key].merge(buckets)
+      else:
+        self[key] = buckets
+    return self
+
+def merge_states(a, b):
+  '''Merges the partial aggregate b into a, both dicts of name: value, and returns a.
+
+  count and sum add up, min.* and max.* keep the lowest and highest values, and
+  sketches (and Counts) are merged. The merge is associative and commutative, so
+  partial aggregates of any split of the data (bulk chunks, shards, workers)
+  combine into the aggregate of the whole. Sketches of b may be reused in a.'''
+  for name, value in b.iteritems():
+    if value is None:
+      continue
+    current = a.get(name)
+    if current is None:
+      a[name] = value
+    elif name in ('count', 'sum'):
+      a[name] = current + value
+    elif name.startswith('min'):
+      a[name] = min(current, value)
+    elif name.startswith('max'):
+      a[name] = max(current, value)
+    elif hasattr(current, 'merge'):
+      a[name] = current.merge(value)
+    else:
+      a[name] = value
+  return a
@@ -1,7 +1,99 @@
+'''Summaries of the datums of a namespace, by type.
+
+A summary prepares datums (parses their values) and computes the partial state of a
+batch of them, which merges with any other partial state of the same namespace. It
+runs in memory, on any object with the attributes it reads, without a datastore:
+Aggregate and Datum are the records of the in-memory engine (see aggregate), and
+myapp.persist folds the same states into the Statistics entities.
+'''
 import urllib, logging, math, re
-from models import Histogram
+from sketch import TDigest, Moments, HyperLogLog, SpaceSaving, Counts, CalendarCounts, TimeSeries, merge_states
+
+QUANTILES = {'p50': 0.5, 'p90': 0.9, 'p95': 0.95, 'p99': 0.99}
+MOMENTS = ['variance', 'stddev', 'skew', 'kurtosis']
+
+class Aggregate(object):
+  '''The statistics of a namespace in memory: the partial state of the summary of its
+  type (see NoSummary.state), with its counters readable as attributes (count, sum, ...)'''
+  __slots__ = ('namespace', 'type', 'topk', 'state')
+  
+  def __init__(self, namespace, type = 'number', topk = 0):
+    self.namespace = namespace
+    self.type = type
+    self.topk = topk
+    self.state = {}
+  
+  def __getattr__(self, name):
+    if name != 'state' and name in self.state:
+      return self.state[name]
+    raise AttributeError(name)
+  
+  def update(self, values, times = None):
+    '''Aggregates the values, skipping the invalid ones. With their times (datetimes,
+    see Storage.created_on) the values are rolled up as well.'''
+    Summary = get(self.type)
+    times = times or [None] * len(values)
+    valid = Summary.prepare_many([Datum(value, self, created_on = when) for value, when in zip(values, times)])
+    if valid:
+      Summary.calculate_many(valid)
+    return self
+  
+  def merge(self, other):
+    get(self.type).merge(self.state, other.state)
+    return self
+  
+  def to_dict(self):
+    '''The statistics as Statistics.to_dict has them'''
+    entity = {'type': self.type}
+    for name, value in self.state.iteritems():
+      if name == 'digest':
+        entity['quantiles'] = dict((q, value.quantile(QUANTILES[q])) for q in QUANTILES)
+      elif name == 'moments':
+        entity.update(dict((moment, getattr(value, moment)) for moment in MOMENTS))
+      elif name == 'hll':
+        entity['distinct'] = len(value)
+      elif name == 'hits_sketch':
+        entity['hits'] = dict((hit, count) for hit, count, error in value.top())
+      elif name == 'calendar':
+        entity.update(value.to_dict())
+      elif name == 'series': # kept in the Rollup entities
+        continue
+      elif isinstance(value, Counts):
+        entity[name] = dict(value)
+      else:
+        entity[name] = value
+    if entity.get('count') and entity.get('sum') is not None:
+      entity['mean'] = float(entity['sum']) / entity['count']
+    return entity
 
-_Hists = {}
+class Datum(object):
+  '''A datum in memory, with the attributes that the summaries read and set'''
+  __slots__ = ('value', 'type', 'stats', 'created_on', 'timestamp', 'datetime', 'longitude', 'latitude', '_invalid')
+  
+  def __init__(self, value, stats, type = None, created_on = None):
+    self.value = value
+    self.stats = stats
+    self.type = type or stats.type
+    self.created_on = created_on
+
+def aggregate(data, aggregates = None):
+  '''Aggregates datums given as dicts of namespace, type, value and optionally created_on
+  (a bulk payload of measure.py) in memory, into Aggregate records by namespace, which
+  are returned'''
+  if aggregates is None:
+    aggregates = {}
+  values, times = {}, {}
+  for datum in data:
+    ns = datum.get('namespace')
+    if not ns:
+      continue
+    if ns not in aggregates:
+      aggregates[ns] = Aggregate(ns, datum.get('type', 'number'))
+    values.setdefault(ns, []).append(datum.get('value'))
+    times.setdefault(ns, []).append(datum.get('created_on'))
+  for ns, batch in values.iteritems():
+    aggregates[ns].update(batch, times[ns])
+  return aggregates
 
 def get(prop):
   glbs = globals()
@@ -15,6 +107,9 @@ def get(prop):
 
 class NoSummary(object):
   match_type = ['off', 'none']
+  histogram_names = []
+  calendar = False
+  series_values = False # whether the rollups keep the sum, min and max of the values
   
   @classmethod
   def prepare(cls, datum):
@@ -22,20 +117,50 @@ class NoSummary(object):
     if (not hasattr(datum, 'value') or datum.value is None or datum.value is '' or datum.value is u''):
       return cls.invalidate(datum, 'No value provided')
   
+  @classmethod
+  def prepare_many(cls, datums):
+    '''Prepares every datum and returns the valid ones'''
+    valid = []
+    for datum in datums:
+      cls.prepare(datum)
+      if not hasattr(datum, '_invalid'):
+        valid.append(datum)
+    return valid
+  
   @classmethod
   def calculate(cls, datum):
-    '''Decorates the statistic with additional attributes.
-    For example, the first and last datum and increment the count of data in the system
+    '''Decorates the statistic with additional attributes (see calculate_many)'''
+    cls.calculate_many([datum])
+  
+  @classmethod
+  def calculate_many(cls, datums):
+    '''Merges the partial state of a batch of prepared datums of the same namespace into
+    their in-memory statistics (datum.stats, an Aggregate). See myapp.persist for the
+    Statistics entities.'''
+    stats = datums[0].stats
+    stats.state = cls.merge(stats.state, cls.state(datums))
+  
+  @classmethod
+  def state(cls, datums):
+    '''The partial aggregate of a batch of prepared datums of the same namespace: a dict
+    of counters (count, sum, min.*, max.*), sketches and histogram Counts that merges
+    with the state of any other batch (see merge). For example, the count of data in the system
     '''
-    stats = datum.stats
     # The datum is not yet saved, and referencing it is not possible. Need to come up with a workaround. Perhaps Key.from_path().
     #if (not stats.head):
     #  stats.head = datum
     #stats.tail = datum
-    
-    if (not stats.count):
-      stats.count = 0
-    stats.count += 1
+    state = {'count': len(datums)}
+    times = [(datum.created_on, datum.value if cls.series_values else None)
+      for datum in datums if getattr(datum, 'created_on', None)]
+    if times:
+      state['series'] = TimeSeries().update(times)
+    return state
+  
+  @classmethod
+  def merge(cls, a, b):
+    '''Merges the partial state b into a (see sketch.merge_states)'''
+    return merge_states(a, b)
   
   @classmethod
   def invalidate(cls, datum, msg = ''):
@@ -48,32 +173,19 @@ class NoSummary(object):
     logging.critical(msg)
     return False
     
-  @classmethod
-  def tally(cls, stats, name, index):
-    if (not isinstance(index, str)):
-      try:
-        index = str(index)
-      except:
-        return cls.critical('Could not str(%s)' % index)
-        
-    if name not in stats.histograms:
-      stats.histograms.append(name)
-      
-    key = '%s.%s' % (stats.key(), name)
-    if not _Hists.has_key(key):
-      hist = _Hists[key] = Histogram.get_by_key_name_or_insert(key, statistic = stats, name = name)
-    else:
-      hist = _Hists[key]
-      
-    try:
-      value = getattr(hist, index)
-    except:
-      value = 0
-    setattr(hist, index, value + 1)     
+  @staticmethod
+  def count(indexes):
+    '''Counts the occurrences of every index, for a histogram'''
+    counts = {}
+    for index in indexes:
+      counts[index] = counts.get(index, 0) + 1
+    return counts
         
 class Summary(NoSummary):
+  histogram_names = ['hits']
+  
   @classmethod
-  def calculate(cls, datum):    
+  def state(cls, datums):    
     '''The simplest summary by creating a histogram of all the 'hits' for the exact value.
     For example: input = ['a', 'b', 'a', 'c']
       hits = {
@@ -81,12 +193,21 @@ class Summary(NoSummary):
         'b': ['b'.key()],
         'c': ['c'.key()]
       }
+    With stats.topk, the hits are counted in a Space-Saving sketch of the topk most
+    frequent values instead of the unbounded hits histogram.
     '''
-    super(Summary, cls).calculate(datum)
-    cls.tally(stats = datum.stats, name = 'hits', index = datum.value)
+    state = super(Summary, cls).state(datums)
+    values = [datum.value for datum in datums]
+    topk = datums[0].stats.topk
+    if topk:
+      state['hits_sketch'] = SpaceSaving(topk).update(values)
+    else:
+      state['hits'] = Counts(cls.count(values))
+    return state
   
 class NumberSummary(Summary):
   match_type = ['number', 'float', 'int', 'integer', 'long']
+  series_values = True
   @classmethod
   def prepare(cls, datum):
     if super(NumberSummary, cls).prepare(datum) is False:
@@ -97,25 +218,23 @@ class NumberSummary(Summary):
         datum.value = float(x) if '.' in x else long(x) if 'L' in x else int(x)
       else:
         datum.value = x
-    except TypeError, err:
+    except (TypeError, ValueError), err:
       return cls.invalidate(datum, 'Could not number(%s): %s' % (datum.value, err))
     
   @classmethod
-  def calculate(cls, datum):
-    '''Adds to the statistics the min, max, sum, mean, and other standard numerical statistics'''
-    super(NumberSummary, cls).calculate(datum)
-      
-    stats = datum.stats
-    if (not hasattr(stats, 'min') or datum.value < stats.min):
-      stats.min = datum.value
-    if (not hasattr(stats, 'max') or datum.value > stats.max):
-      stats.max = datum.value
-    if (not hasattr(stats, 'sum')):
-      stats.sum = 0
-    stats.sum = stats.sum + datum.value
-    if (not hasattr(stats, 'mean')):
-      stats.mean = 0
-    stats.mean = stats.sum / stats.count
+  def state(cls, datums):
+    '''Adds to the statistics the min, max, sum (and so the mean), the moments behind the
+    variance, standard deviation, skew and kurtosis, and the quantile sketch'''
+    state = super(NumberSummary, cls).state(datums)
+    values = [datum.value for datum in datums]
+    state.update({
+      'min': min(values),
+      'max': max(values),
+      'sum': sum(values),
+      'moments': Moments().update(values),
+      'digest': TDigest().update(values)
+    })
+    return state
     
 class StringSummary(Summary):
   match_type = ['str', 'string', 'text']
@@ -129,11 +248,20 @@ class StringSummary(Summary):
       datum.value = str(datum.value)
     except:
       return cls.invalidate(datum, 'Could not str(%s)' % datum.value)
+  
+  @classmethod
+  def state(cls, datums):
+    '''Adds to the statistics the HyperLogLog sketch behind the count of distinct values'''
+    state = super(StringSummary, cls).state(datums)
+    state['hll'] = HyperLogLog().update([datum.value for datum in datums])
+    return state
 
 
 import datetime, time
 class DatetimeSummary(Summary):
   match_type = ['date', 'datetime', 'timestamp']
+  histogram_names = []
+  calendar = True
   DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S'
   
   @classmethod
@@ -165,21 +293,14 @@ class DatetimeSummary(Summary):
       return cls.invalidate(datum, 'Unexpected type: %s for calc_date_statistics' % datum.type)
   
   @classmethod
-  def calculate(cls, datum):
+  def state(cls, datums):
     '''Adds to the statistic various histograms/buckets for the years, months,
-    days, and so forth (see datetime.datetime.timetuple for other histograms).
+    days, and so forth (see datetime.datetime.timetuple for other histograms),
+    all kept in the one calendar of the statistic (see sketch.CalendarCounts).
     Datetime statistics do not include the 'hits' histogram.'''
-    NoSummary.calculate(datum) # No need for hits histogram
-    
-    timetuple = datum.datetime.timetuple()
-    for i, bucket in enumerate(['year%s', 'month%s', 'day%s', 'hour%s', 'minute%s', 'second%s', 'weekday%s']):
-      cls.tally(stats = datum.stats, name = bucket % 's', index = timetuple[i])
-    
-    cls.tally(stats = datum.stats, name = 'dayth', index = timetuple[7])
-    cls.tally(stats = datum.stats, name = 'weekdayth', index = datum.datetime.strftime('%U'))
-    cls.tally(stats = datum.stats, name = 'hour.weekday', index = '%s.%s' % (timetuple[3], timetuple[6]))
-    cls.tally(stats = datum.stats, name = 'day.hour', index = '%s.%s' % (timetuple[2], timetuple[3]))
-    cls.tally(stats = datum.stats, name = 'weekday.month', index = '%s.%s' % (timetuple[6], timetuple[2]))
+    state = NoSummary.state(datums) # No need for hits histogram
+    state['calendar'] = CalendarCounts().update([datum.datetime for datum in datums])
+    return state
 
 '''
 ### Location
@@ -193,6 +314,7 @@ class DatetimeSummary(Summary):
 '''
 class LocationSummary(Summary):
   match_type = ['gps', 'location']
+  histogram_names = ['geotudes']
   non_alpha = re.compile(r'[^a-zA-Z0-9\-\.]+')
   
   @classmethod
@@ -214,24 +336,23 @@ class LocationSummary(Summary):
       return cls.invalidate(datum, 'Could not convert latitude %s to a float' % latitude)  
     
   @classmethod
-  def calculate(cls, datum):
-    NoSummary.calculate(datum)
+  def state(cls, datums):
+    state = NoSummary.state(datums)
     
-    stats = datum.stats 
-    tude = cls.geotude(datum.longitude, datum.latitude)
-    key = ''
-    while len(tude):
-      key += tude.pop(0)
-      cls.tally(stats = datum.stats, name = 'geotudes', index = key)
-      key += '.'
+    geotudes = []
+    for datum in datums:
+      tude = cls.geotude(datum.longitude, datum.latitude) or []
+      key = ''
+      while len(tude):
+        key += tude.pop(0)
+        geotudes.append(key)
+        key += '.'
+    state['geotudes'] = Counts(cls.count(geotudes))
 
     for limit, fn in {'min': min, 'max': max}.iteritems():
       for axis in ['longitude', 'latitude']:
-        attr = '%s.%s' % (limit, axis)
-        if (not hasattr(stats, attr)):
-          setattr(stats, attr, getattr(datum, axis))
-          continue
-        setattr(stats, attr, fn(getattr(stats, attr), getattr(datum, axis)))
+        state['%s.%s' % (limit, axis)] = fn([getattr(datum, axis) for datum in datums])
+    return state
           
   @staticmethod
   def geotude(lon, lat):
@@ -1,6 +1,33 @@
-import logging
+'''Background tasks, recorded as TaskModel entities (see TaskModel.execute).
+
+The scheduler claims a batch of pending tasks, leasing each of them to a runner
+in the task queue, and re-enqueues itself for as long as tasks are left. A runner
+works on its task for a while, then renews its lease and continues in a new task
+queue task, until the task is finished. A task whose runner died is claimed again
+once its lease expires.
+
+Deleting a campaign fans out into one task per namespace (Statistics), which run
+in parallel. Every task deletes keys only, BATCH keys per RPC, for as long as its
+budget lasts, and reports whether it is finished. Applying the retention policies
+fans out the same way.
+'''
+import re, time, datetime, random, logging
 from google.appengine.ext import db
-from models import Storage, Histogram, TaskModel
+from google.appengine.api import memcache
+from google.appengine.api.labs import taskqueue
+from models import Storage, Statistics, Histogram, Calendar, Rollup, RollupState, StatisticsShard, TaskModel, Tombstone, RetentionPolicy
+from sketch import RESOLUTIONS
+from util import BUDGET, add_task
+import stat, cache
+
+BATCH = 500 # keys per delete
+FOLD_BATCH = 200 # Storage entities per fetch, when they are folded into the rollups
+LEASE = 60 # seconds a runner has to execute its task and renew the lease
+CLAIM = 50 # tasks claimed per run of the scheduler
+RUN_URL = '/tasks/run'
+SCHEDULE_URL = '/tasks/schedule'
+COUNTER_PREFIX = 'tasks:'
+COUNTERS = ('runs', 'finished', 'failed', 'ms')
 
 def get(task):
   for cls_name in globals().keys():
@@ -10,34 +37,282 @@ def get(task):
       return globals()[cls_name].execute
   return lambda x,y: None
 
+def schedule(task, objects, **properties):
+  '''Creates the TaskModel of the task for every object that does not have one yet, and
+  starts the scheduler. A TaskModel is named after its task and object, so the names
+  double as the set of what was scheduled already: scheduling again is a no-op.'''
+  names = ['%s:%s' % (task, obj) for obj in objects]
+  existing = TaskModel.get_by_key_name(names)
+  now = datetime.datetime.now()
+  missing = [TaskModel(key_name = name, object = obj, task = task, leased_until = now, **properties)
+    for name, obj, model in zip(names, objects, existing) if model is None]
+  if missing:
+    db.put(missing)
+    start()
+  return missing
+
+def start(countdown = 0, step = 0):
+  '''Runs the scheduler. The task is named after the 5 seconds it runs in and its step
+  in the chain, so that concurrent starts add a single scheduler while the scheduler
+  can always continue itself.'''
+  name = 'schedule-%d-%d' % (int(time.time() + countdown) / 5, step)
+  try:
+    add_task(name, url = SCHEDULE_URL, countdown = countdown, params = {'step': step})
+  except taskqueue.Error, err:
+    logging.warning('Could not start the scheduler, the cron will: %s' % err)
+
+def claim(limit = CLAIM):
+  '''Leases up to limit tasks whose lease has expired. Returns the claimed tasks.'''
+  now = datetime.datetime.now()
+  claimed = []
+  for key in TaskModel.all(keys_only = True).filter('leased_until <=', now).order('leased_until').fetch(limit):
+    def txn():
+      task = TaskModel.get(key)
+      if task is None or task.leased_until is None or task.leased_until > now:
+        return None # finished, or claimed by another scheduler meanwhile
+      task.lease = '%x' % random.getrandbits(64)
+      task.leased_until = now + datetime.timedelta(seconds = LEASE)
+      task.put()
+      return task
+    try:
+      task = db.run_in_transaction(txn)
+    except db.TransactionFailedError:
+      continue
+    if task:
+      claimed.append(task)
+  return claimed
+
+def run_scheduler(step = 0):
+  '''Claims a batch of tasks and hands each to a runner. Continues at once while the
+  batch was full, and later while leased tasks are left, in case their runners die.'''
+  claimed = claim()
+  for task in claimed:
+    kick(task)
+  if len(claimed) == CLAIM:
+    start(step = step + 1)
+  elif claimed or TaskModel.all(keys_only = True).filter('leased_until >', datetime.datetime.now()).get():
+    start(countdown = LEASE, step = step + 1)
+  return len(claimed)
+
+def backfill(deadline):
+  '''Gives the tasks written before there were leases an expired lease, so that they
+  are claimed. Returns True once every task was looked at.'''
+  cursor = None
+  while time.time() < deadline:
+    query = TaskModel.all()
+    if cursor:
+      query.with_cursor(cursor)
+    tasks = query.fetch(BATCH)
+    legacy = [task for task in tasks if task.leased_until is None]
+    for task in legacy:
+      task.leased_until = datetime.datetime.now()
+    if legacy:
+      db.put(legacy)
+      logging.info('Gave a lease to %s tasks' % len(legacy))
+    if len(tasks) < BATCH:
+      return True
+    cursor = query.cursor()
+  return False
+
+def renew(task):
+  '''Extends the lease of the runner. Returns the task, or None if the lease was lost.'''
+  def txn():
+    current = TaskModel.get(task.key())
+    if current is None or current.lease != task.lease:
+      return None
+    current.leased_until = datetime.datetime.now() + datetime.timedelta(seconds = LEASE)
+    current.put()
+    return current
+  return db.run_in_transaction(txn)
+
+def kick(task):
+  '''Runs the leased task through the task queue'''
+  try:
+    taskqueue.add(url = RUN_URL, params = {'task': str(task.key()), 'lease': task.lease})
+  except taskqueue.Error, err:
+    logging.warning('Could not run %s, it will be claimed again: %s' % (task.key(), err))
+
+def run(key, lease):
+  '''Executes the task if the runner still holds its lease. A task returns True once it is
+  finished, False to continue in a new runner at once, or None to wait until its lease
+  expires and it is claimed again. Counts the runs by task type (see throughput).'''
+  task = key and TaskModel.get(key)
+  if not task or task.lease != lease:
+    return
+  started = time.time()
+  finished = failed = False
+  try:
+    finished = task.execute()
+  except Exception, err:
+    failed = True
+    logging.exception('Task %s failed, it will be claimed again: %s' % (task.key(), err))
+  count(task.task, runs = 1, finished = int(bool(finished)), failed = int(failed), ms = int((time.time() - started) * 1000))
+  if finished is False:
+    task = renew(task)
+    if task:
+      kick(task)
+
+def count(task_type, **counters):
+  memcache.offset_multi(counters, key_prefix = '%s%s:' % (COUNTER_PREFIX, task_type), initial_value = 0)
+
+def throughput():
+  '''Counters by task type: runs, finished tasks, failed runs, and ms spent in runs'''
+  counters = {}
+  for cls_name in globals().keys():
+    if cls_name.endswith('Task'):
+      task_type = ' '.join(re.findall('[A-Z][a-z]*', cls_name[:-4])).lower()
+      values = memcache.get_multi(COUNTERS, key_prefix = '%s%s:' % (COUNTER_PREFIX, task_type))
+      counters[task_type] = dict((counter, values.get(counter, 0)) for counter in COUNTERS)
+  return counters
+
+def delete_all(query, deadline):
+  '''Deletes what a keys only query matches, BATCH keys per RPC. Returns True once
+  nothing is left, False if the deadline came first.'''
+  while time.time() < deadline:
+    keys = query.fetch(BATCH)
+    if keys:
+      db.delete(keys)
+    if len(keys) < BATCH:
+      return True
+  return False
 
 class DeleteHistogramTask(object):
+  '''Deletes a namespace: its Storage, Histograms, Calendar, Rollups and shards, then its Statistics'''
   @staticmethod
   def execute(task, stat):
-    hists_query = Histogram.all(keys_only = True).filter('statistic =', stat)
-    if (hists_query.count(limit = 1)):
-      for hist in hists_query.fetch(100):
-        db.delete(hist)
-    else:
-      logging.info('Nothing left of histograms with statistic: %s' % stat)
-      db.delete(stat)
-      task.delete()
-      return True
+    deadline = time.time() + BUDGET
+    for Kind, reference in ((Storage, 'stats'), (Histogram, 'statistic'), (Calendar, 'statistic'), (Rollup, 'statistic'), (StatisticsShard, 'statistic')):
+      if not delete_all(Kind.all(keys_only = True).filter('%s =' % reference, stat), deadline):
+        return False
+    logging.info('Nothing left of histograms with statistic: %s' % stat)
+    db.delete([stat, db.Key.from_path('RollupState', stat.name())])
+    task.delete()
+    return True
 
-class DeleteCampaignTask(object):  
+class DeleteCampaignTask(object):
+  '''Schedules the deletion of every namespace of the campaign, then deletes what is
+  left of its Storage once those are done. The Tombstone of the campaign is kept.'''
   @staticmethod
   def execute(task, campaign):
-    storage_query = Storage.all().filter('campaign =', campaign)
-    if (storage_query.count(limit = 1)):
-      for datum in storage_query.fetch(100):
-        logging.info('checking for stats: %s' % datum.stats.key())
-        if (Histogram.has(datum.stats) and not TaskModel.has(datum.stats)): #perhaps use a pickled dictionary instead of count queries
-          if (not TaskModel(object = datum.stats, task = 'delete histogram').put()):
-            logging.critical('Could not create delete histogram task for %s' % datum.stats)
-        else:
-          datum.stat.delete()
-        datum.delete()
-    else:
+    deadline = time.time() + BUDGET
+    Tombstone.publish(str(campaign))
+    while not getattr(task, 'fanned_out', False) and time.time() < deadline:
+      query = Statistics.all(keys_only = True).filter('campaign =', campaign)
+      if getattr(task, 'cursor', None):
+        query.with_cursor(task.cursor)
+      keys = query.fetch(BATCH)
+      schedule('delete histogram', keys, campaign = campaign)
+      task.cursor = db.Text(query.cursor())
+      task.fanned_out = len(keys) < BATCH
+      task.put()
+    
+    if not getattr(task, 'fanned_out', False):
+      return False
+    if TaskModel.all(keys_only = True).filter('task =', 'delete histogram').filter('campaign =', campaign).count(1):
+      return None # the namespaces are still being deleted, look again later
+    if delete_all(Storage.all(keys_only = True).filter('campaign =', campaign), deadline):
       task.delete()
       logging.info('Nothing left in storage to clean up for campaign %s' % campaign)
-      return True
\ No newline at end of file
+      return True
+    return False
+
+class ApplyRetentionTask(object):
+  '''Schedules the pruning of every namespace that the RetentionPolicy applies to'''
+  @staticmethod
+  def execute(task, policy):
+    policy = RetentionPolicy.get(policy)
+    if policy and policy.namespace:
+      schedule('prune namespace', [db.Key.from_path('Statistics', policy.key().name())])
+    elif policy:
+      deadline = time.time() + BUDGET
+      while time.time() < deadline:
+        query = Statistics.all(keys_only = True).filter('campaign =', RetentionPolicy.campaign.get_value_for_datastore(policy))
+        if getattr(task, 'cursor', None):
+          query.with_cursor(task.cursor)
+        keys = query.fetch(BATCH)
+        schedule('prune namespace', keys)
+        task.cursor = db.Text(query.cursor())
+        task.put()
+        if len(keys) < BATCH:
+          break
+      else:
+        return False
+    task.delete()
+    return True
+
+class PruneNamespaceTask(object):
+  '''Deletes the Storage and rollups of a namespace that its RetentionPolicy (or the one
+  of its campaign) no longer keeps. Storage that is not in the rollups yet, measured
+  before the namespace was rolled up, is folded into them before it is deleted.'''
+  @staticmethod
+  def execute(task, stats):
+    deadline = time.time() + BUDGET
+    stats = Statistics.get(stats)
+    policy = stats and RetentionPolicy.of(stats)
+    if policy:
+      now = datetime.datetime.now()
+      if policy.raw is not None and not prune(stats, now - datetime.timedelta(days = policy.raw), deadline):
+        return False
+      for resolution in RetentionPolicy.RESOLUTIONS:
+        days = getattr(policy, resolution)
+        if days is None:
+          continue
+        period = RESOLUTIONS[resolution][0]((now - datetime.timedelta(days = days)).timetuple())
+        query = Rollup.all(keys_only = True).filter('statistic =', stats).filter('resolution =', resolution).filter('period <', period)
+        if not delete_all(query, deadline):
+          return False
+    task.delete()
+    return True
+
+def prune(stats, cutoff, deadline):
+  '''Deletes the Storage of the statistic measured before cutoff, after folding what is
+  not in the rollups yet into them. Returns True once none is left.'''
+  state = RollupState.get_by_key_name(stats.key().name())
+  if state is None or state.pruned_on is None: # before anything is deleted, see persist.save
+    state = RollupState.update(stats.key().name(), pruned_on = datetime.datetime.now())
+  query = Storage.all(keys_only = state.rolled_up).filter('stats =', stats).filter('created_on <', cutoff)
+  if state.rolled_up:
+    return delete_all(query, deadline)
+  if state.folding: # the last run stopped in the middle of a fold
+    data = [datum for datum in Storage.get(state.pending) if datum]
+    fold(stats, state.folding, data)
+    db.delete(data)
+    state = RollupState.update(stats.key().name(), folding = None, pending = [])
+  while time.time() < deadline:
+    data = query.fetch(FOLD_BATCH)
+    missing = [datum for datum in data if not datum.rolled_up]
+    if missing:
+      state = RollupState.update(stats.key().name(), folding = '%x' % random.getrandbits(64),
+        pending = [datum.key() for datum in missing])
+      fold(stats, state.folding, missing)
+    if data:
+      db.delete(data)
+    if missing:
+      state = RollupState.update(stats.key().name(), folding = None, pending = [])
+    if len(data) < FOLD_BATCH:
+      return True
+  return False
+
+def fold(stats, fold, data):
+  '''Adds the Storage to the rollups of the statistic, each rollup in a transaction that
+  records the fold, so that the rollups it was added to already are left alone when a
+  fold is done again after a failure.'''
+  if not data:
+    return
+  record = stat.Aggregate(stats.namespace, stats.type or 'number').update(
+    [getattr(datum, 'value', None) for datum in data], [datum.created_on for datum in data])
+  for (resolution, period), buckets in record.state.get('series', {}).iteritems():
+    key = Rollup.key_name(stats.key(), resolution, period)
+    def txn():
+      rollup = Rollup.get_by_key_name(key) or Rollup(key_name = key, statistic = stats, resolution = resolution, period = period)
+      if fold in rollup.folds:
+        return None
+      rollup.buckets.merge(buckets)
+      rollup.pack()
+      rollup.folds = (rollup.folds + [fold])[-Rollup.MAX_FOLDS:]
+      cache.stamp([rollup])
+      rollup.put()
+      return rollup
+    rollup = db.run_in_transaction(txn)
+    if rollup:
+      cache.publish([rollup])
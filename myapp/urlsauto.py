@@ -2,10 +2,16 @@ from django.conf.urls.defaults import *
 
 urlpatterns = patterns('myapp.views',
     (r'^tasks/clean_up_campaigns/?', 'clean_up_campaigns'),
+    (r'^tasks/run/?$', 'run_task'),
+    (r'^tasks/schedule/?$', 'schedule_tasks'),
+    (r'^tasks/stats/?$', 'task_stats'),
+    (r'^tasks/retention/?$', 'apply_retention'),
         
     (r'^campaign/?$', 'list_campaigns'),
     (r'^campaign/create/?$', 'add_campaign'),
     (r'^campaign/show/(?P<key>.+)$', 'show_campaign'),
     (r'^campaign/edit/(?P<key>.+)$', 'edit_campaign'),
     (r'^campaign/delete/(?P<key>.+)$', 'delete_campaign'),
+    (r'^campaign/recompute/(?P<key>.+)$', 'recompute_campaign'),
+    (r'^campaign/retention/(?P<key>.+)$', 'retention_campaign'),
 )
\ No newline at end of file
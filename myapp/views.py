@@ -1,16 +1,21 @@
 from django.core.urlresolvers import reverse
-from django.http import HttpResponse
+from django.http import HttpResponse, HttpResponseRedirect, Http404
 from django.views.generic.list_detail import object_list, object_detail
 from django.views.generic.create_update import create_object, delete_object, update_object, redirect
 
 from ragendja.template import render_to_response
 
-import logging, renderer
+import logging, time, renderer, recompute, tasks
+from google.appengine.ext import db
+from google.appengine.api import memcache
+from django.utils import simplejson
 from forms import CampaignForm
-from models import Campaign, TaskModel
+from models import Campaign, Tombstone, RetentionPolicy
 
 from django.contrib.auth.decorators import login_required
 
+BACKFILLED = 'tasks:backfilled'
+
 @login_required
 def list_campaigns(request):
   return object_list(request, Campaign.all().filter('organizer =', request.user), paginate_by = 10, template_name = 'campaign_list.html')
@@ -38,15 +43,82 @@ def edit_campaign(request, key):
   
 @login_required
 def delete_campaign(request, key):
-    return delete_object(request, Campaign, object_id = key, post_delete_redirect = reverse('myapp.views.list_campaigns'), template_name = 'campaign_confirm_delete.html')
+    response = delete_object(request, Campaign, object_id = key, post_delete_redirect = reverse('myapp.views.list_campaigns'), template_name = 'campaign_confirm_delete.html')
+    if request.method == 'POST':
+      Tombstone.bury(key)
+      tasks.schedule('delete campaign', [db.Key(key)])
+    return response
+    
+@login_required
+def recompute_campaign(request, key):
+  '''Rebuilds the statistics of the campaign (or of the posted namespace) from its Storage'''
+  try:
+    campaign = Campaign.all(keys_only = True).filter('organizer =', request.user).filter('__key__ =', db.Key(key)).get()
+  except db.BadKeyError:
+    campaign = None
+  if not campaign:
+    raise Http404
+  if request.method == 'POST':
+    recompute.start(campaign, request.POST.get('namespace', '').strip('/').replace('/', '.') or None)
+  return HttpResponseRedirect(reverse('myapp.views.show_campaign', kwargs = dict(key = key)))
+    
+@login_required
+def retention_campaign(request, key):
+  '''Sets how many days the measurements and the rollups of the campaign (or of the posted
+  namespace) are kept. Empty fields keep them for good, and a policy without limits is removed.'''
+  try:
+    campaign = Campaign.all(keys_only = True).filter('organizer =', request.user).filter('__key__ =', db.Key(key)).get()
+  except db.BadKeyError:
+    campaign = None
+  if not campaign:
+    raise Http404
+  if request.method == 'POST':
+    namespace = request.POST.get('namespace', '').strip('/').replace('/', '.') or None
+    days = {}
+    for name in ['raw'] + RetentionPolicy.RESOLUTIONS:
+      value = request.POST.get(name, '').strip()
+      try:
+        days[name] = max(int(value), 0) if value else None
+      except ValueError:
+        return HttpResponse(status = 400)
+    key_name = RetentionPolicy.key_name(campaign, namespace)
+    if [value for value in days.values() if value is not None]:
+      RetentionPolicy(key_name = key_name, campaign = campaign, namespace = namespace, **days).put()
+    else:
+      db.delete(db.Key.from_path('RetentionPolicy', key_name))
+  return HttpResponseRedirect(reverse('myapp.views.show_campaign', kwargs = dict(key = key)))
+    
+def apply_retention(request):
+  '''Cron: prunes what every RetentionPolicy no longer keeps (see tasks.ApplyRetentionTask)'''
+  cursor = None
+  while True:
+    query = RetentionPolicy.all(keys_only = True)
+    if cursor:
+      query.with_cursor(cursor)
+    keys = query.fetch(1000)
+    tasks.schedule('apply retention', keys)
+    if len(keys) < 1000:
+      return HttpResponse()
+    cursor = query.cursor()
+
+def run_task(request):
+  '''Runs a leased TaskModel for the task queue (see tasks.run)'''
+  tasks.run(request.POST.get('task'), request.POST.get('lease'))
+  return HttpResponse()
+
+def schedule_tasks(request):
+  '''Hands the pending TaskModels to runners, for the task queue (see tasks.run_scheduler)'''
+  tasks.run_scheduler(int(request.POST.get('step', 0)))
+  return HttpResponse()
+
+def task_stats(request):
+  '''Throughput counters of the tasks, by task type'''
+  return HttpResponse(simplejson.dumps(tasks.throughput()), mimetype = 'application/json')
     
 def clean_up_campaigns(request):
-  status = 200
-  task = TaskModel.all().get()
-  if task:
-    task_key = task.key()
-    logging.info('Executing clean up campaign task: %s' % task_key)
-    if (task.execute()):
-      logging.info('Finished clean up campaign task: %s' % task_key)
-      stats = 201
-  return HttpResponse(status = status)
\ No newline at end of file
+  '''Cron fallback: restarts the scheduler in case its chain of tasks was broken, after
+  leasing the tasks written before the scheduler, once a day'''
+  if not memcache.get(BACKFILLED) and tasks.backfill(time.time() + tasks.BUDGET):
+    memcache.set(BACKFILLED, True, time = 24 * 3600)
+  tasks.start()
+  return HttpResponse()
@@ -0,0 +1,135 @@
+'''Write-behind buffer of raw datums, kept in memcache per campaign.
+
+Appending costs two memcache calls: `incr` reserves the next slot of the
+campaign and `set` stores the datums in it. A named task drains the buffer
+at most FLUSH_DELAY seconds later (see measure.FlushPage), so statistics lag
+by about that much. Memcache can evict slots before they are drained, which
+is the price of the async mode; clients that cannot lose data should keep
+posting synchronously. It can evict the head and tail counters too: each is
+then seeded again from the other, or from the slots that are left.
+'''
+import time, logging
+from google.appengine.api import memcache
+from google.appengine.api.labs import taskqueue
+
+FLUSH_DELAY = 10
+FLUSH_URL = '/measure/_tasks/flush'
+MAX_SLOTS = 200
+SCAN = 1000 # slots per get when looking for the head again
+PREFIX = 'buffer:'
+
+_Scheduled = set()
+
+def slot_key(campaign, slot):
+  return '%s%s:%d' % (PREFIX, campaign, slot)
+
+def head_key(campaign):
+  return '%shead:%s' % (PREFIX, campaign)
+
+def tail_key(campaign):
+  return '%stail:%s' % (PREFIX, campaign)
+
+def gap_key(campaign):
+  return '%sgap:%s' % (PREFIX, campaign)
+
+def lock_key(campaign):
+  return '%slock:%s' % (PREFIX, campaign)
+
+def append(campaign, datums):
+  '''Stores the raw datums (dicts like the elements of a bulk post) in the buffer of the
+  campaign and makes sure a flush is scheduled. Returns False if memcache refused them.'''
+  key = tail_key(campaign)
+  slot = memcache.incr(key)
+  if slot is None: # evicted, continue after the slots that are not drained yet
+    memcache.add(key, find_tail(campaign, memcache.get(head_key(campaign)) or 0))
+    slot = memcache.incr(key)
+  if slot is None or not memcache.set(slot_key(campaign, slot), datums):
+    logging.warning('Could not buffer %s datums for %s' % (len(datums), campaign))
+    return False
+  schedule(campaign)
+  return True
+
+def schedule(campaign, delay = FLUSH_DELAY):
+  '''Adds the flush task of the campaign for the current window, once per window'''
+  window = int(time.time() / delay)
+  if (campaign, window) in _Scheduled:
+    return
+  try:
+    taskqueue.add(name = 'flush-%s-%d' % (campaign, window), url = FLUSH_URL,
+      params = {'campaign': str(campaign)}, countdown = delay)
+  except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+    pass
+  if len(_Scheduled) > 1000:
+    _Scheduled.clear()
+  _Scheduled.add((campaign, window))
+
+def acquire(campaign, timeout = 60):
+  return memcache.add(lock_key(campaign), 1, time = timeout)
+
+def release(campaign):
+  memcache.delete(lock_key(campaign))
+
+def peek(campaign, limit = MAX_SLOTS):
+  '''Reads up to `limit` slots of the buffer of the campaign, oldest first, without
+  removing them. Hold the lock (see acquire) while draining.
+
+  Returns the buffered datums, the last slot read (pass it to advance once the
+  datums are safely written) and whether slots remain. A missing slot is either
+  being written right now or was evicted: the drain stops in front of it, and
+  the next drain skips every slot that was already missing then.'''
+  tail = memcache.get(tail_key(campaign)) or 0
+  head = memcache.get(head_key(campaign))
+  if head is None or head > tail: # evicted, or the tail was
+    head = find_head(campaign, tail)
+    memcache.set(head_key(campaign), head)
+  slots = range(head + 1, min(tail, head + limit) + 1)
+  if not slots:
+    return [], head, False
+
+  batches = memcache.get_multi([slot_key(campaign, slot) for slot in slots])
+  gap = memcache.get(gap_key(campaign)) or 0
+  datums = []
+  last = head
+  for slot in slots:
+    key = slot_key(campaign, slot)
+    if key not in batches:
+      if slot > gap:
+        memcache.set(gap_key(campaign), slots[-1], time = 6 * FLUSH_DELAY)
+        break
+      logging.critical('Lost buffered slot %s of %s' % (slot, campaign))
+    else:
+      datums.extend(batches[key])
+    last = slot
+  return datums, last, last < tail
+
+def find_head(campaign, tail = None):
+  '''The slot before the oldest slot that is not drained yet, found from the slots that
+  are left, since the drained ones are deleted. Scans down from the tail, SCAN slots
+  per get, until a whole scan finds none.'''
+  if tail is None:
+    tail = memcache.get(tail_key(campaign)) or 0
+  head = tail
+  while head > 0:
+    slots = range(max(head - SCAN, 0) + 1, head + 1)
+    found = memcache.get_multi([slot_key(campaign, slot) for slot in slots])
+    if not found:
+      break
+    head = min([slot for slot in slots if slot_key(campaign, slot) in found]) - 1
+  return head
+
+def find_tail(campaign, head):
+  '''The last slot that is left after the head. Scans up from the head, SCAN slots per
+  get, until a whole scan finds none.'''
+  tail = head
+  while True:
+    slots = range(tail + 1, tail + SCAN + 1)
+    found = memcache.get_multi([slot_key(campaign, slot) for slot in slots])
+    if not found:
+      return tail
+    tail = max([slot for slot in slots if slot_key(campaign, slot) in found])
+
+def advance(campaign, last):
+  '''Removes the slots up to and including `last` from the buffer of the campaign'''
+  head = memcache.get(head_key(campaign)) or 0
+  memcache.set(head_key(campaign), last)
+  memcache.delete_multi([slot_key(campaign, slot) for slot in range(head + 1, last + 1)])
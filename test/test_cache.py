@@ -0,0 +1,84 @@
+import unittest, time
+from myapp import cache
+from test_writebehind import MemcacheStub
+
+class Entity(object):
+  def __init__(self, name, version):
+    self.name, self.version = name, version
+  
+  def key(self):
+    return self.name
+
+class LRUCacheTest (unittest.TestCase):
+  def test_evicts_least_recently_used(self):
+    lru = cache.LRUCache(max_size = 2)
+    lru.set('a', 1)
+    lru.set('b', 2)
+    self.assertEqual(1, lru.get('a'))
+    lru.set('c', 3)
+    self.assertEqual(2, len(lru))
+    self.assertEqual(None, lru.get('b'))
+    self.assertEqual(1, lru.get('a'))
+    self.assertEqual(3, lru.get('c'))
+    
+  def test_replaces_value(self):
+    lru = cache.LRUCache(max_size = 2)
+    lru.set('a', 1)
+    lru.set('a', 2)
+    self.assertEqual(1, len(lru))
+    self.assertEqual(2, lru.get('a'))
+    
+  def test_ttl(self):
+    lru = cache.LRUCache(ttl = 60)
+    lru.set('a', 1)
+    lru.entries['a'][cache.LRUCache.STORED_ON] -= 61
+    self.assertEqual('gone', lru.get('a', 'gone'))
+    self.assertEqual(0, len(lru))
+    
+  def test_discard_and_clear(self):
+    lru = cache.LRUCache()
+    lru.set('a', 1)
+    lru.set('b', 2)
+    lru.discard('a')
+    self.assertEqual([2], lru.values())
+    lru.clear()
+    self.assertEqual(0, len(lru))
+
+class EntityCacheTest (unittest.TestCase):
+  def setUp(self):
+    self.memcache, cache.memcache = cache.memcache, MemcacheStub()
+    
+  def tearDown(self):
+    cache.memcache = self.memcache
+    
+  def test_publishes_version_when_cached(self):
+    entities = cache.EntityCache(recheck = 0)
+    entities.set('a', Entity('a', 1))
+    self.assertEqual(1, cache.memcache.get(cache.VERSION_PREFIX + 'a'))
+    cache.memcache.set(cache.VERSION_PREFIX + 'a', 2)
+    entities.set('a', Entity('a', 1))
+    self.assertEqual(2, cache.memcache.get(cache.VERSION_PREFIX + 'a'))
+    
+  def test_drops_superseded_entity(self):
+    entities = cache.EntityCache(recheck = 0)
+    entities.set('a', Entity('a', 1))
+    cache.memcache.set(cache.VERSION_PREFIX + 'a', 2)
+    time.sleep(0.01)
+    self.assertEqual(None, entities.get('a'))
+    
+  def test_drops_entity_when_version_is_evicted(self):
+    entities = cache.EntityCache(recheck = 0)
+    entity = entities.set('a', Entity('a', 1))
+    time.sleep(0.01)
+    self.assertEqual(entity, entities.get('a'))
+    cache.memcache.delete(cache.VERSION_PREFIX + 'a')
+    time.sleep(0.01)
+    self.assertEqual(None, entities.get('a'))
+    
+  def test_get_multi(self):
+    entities = cache.EntityCache(recheck = 0)
+    a, b = entities.set('a', Entity('a', 1)), entities.set('b', Entity('b', 1))
+    cache.memcache.set(cache.VERSION_PREFIX + 'b', 2)
+    time.sleep(0.01)
+    self.assertEqual({'a': a}, entities.get_multi(['a', 'b', 'c']))
+    self.assertEqual(None, entities.get('b'))
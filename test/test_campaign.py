@@ -0,0 +1,89 @@
+import unittest, time
+from google.appengine.ext import db
+from google.appengine.api import memcache
+
+import measure
+from myapp import models
+from myapp.models import Campaign, Tombstone
+
+class LookupTest (unittest.TestCase):
+  def setUp(self):
+    self.campaign = Campaign(title = 'Cached campaign')
+    self.campaign.put()
+    self.key = str(self.campaign.key())
+    models._Campaigns.clear()
+    memcache.delete(Campaign.CACHE_PREFIX + self.key)
+    
+  def test_known(self):
+    self.assertEqual(self.campaign.key(), Campaign.lookup(self.key))
+    self.assertEqual(True, memcache.get(Campaign.CACHE_PREFIX + self.key))
+    self.assertEqual(True, models._Campaigns.get(self.key))
+    
+  def test_cached(self):
+    Campaign.lookup(self.key)
+    db.delete(self.campaign) # without invalidating: the instance cache answers
+    self.assertEqual(self.campaign.key(), Campaign.lookup(self.key))
+    models._Campaigns.clear() # then memcache
+    self.assertEqual(self.campaign.key(), Campaign.lookup(self.key))
+    
+  def test_invalidate(self):
+    Campaign.lookup(self.key)
+    db.delete(self.campaign)
+    Campaign.invalidate(self.key)
+    self.assertEqual(None, memcache.get(Campaign.CACHE_PREFIX + self.key))
+    self.assertEqual(None, Campaign.lookup(self.key))
+    
+  def test_unknown(self):
+    db.delete(self.campaign)
+    self.assertEqual(None, Campaign.lookup(self.key))
+    self.assertEqual(False, memcache.get(Campaign.CACHE_PREFIX + self.key))
+    
+  def test_malformed(self):
+    self.assertEqual(None, Campaign.lookup('not a key'))
+    self.assertEqual(False, memcache.get(Campaign.CACHE_PREFIX + 'not a key'))
+
+class TombstoneTest (unittest.TestCase):
+  def setUp(self):
+    self.campaign = Campaign(title = 'Buried campaign')
+    self.campaign.put()
+    self.key = str(self.campaign.key())
+    
+  def forget(self, since = 0):
+    '''Makes this instance forget the tombstone, as another instance would never have known of it'''
+    models._Tombstones.set(self.key, since)
+    
+  def test_alive(self):
+    self.assertFalse(Tombstone.exists(self.key))
+    self.assertTrue(Campaign.lookup(self.key))
+    
+  def test_bury(self):
+    Campaign.lookup(self.key)
+    Tombstone.bury(self.key)
+    self.assertTrue(Tombstone.exists(self.key))
+    self.assertTrue(Tombstone.get_by_key_name(self.key))
+    self.assertEqual(None, models._Campaigns.get(self.key))
+    
+  def test_other_instances(self):
+    Tombstone.bury(self.key)
+    self.forget(time.time()) # an absence looked up just now is trusted for RECHECK seconds
+    self.assertFalse(Tombstone.exists(self.key))
+    self.forget(time.time() - Tombstone.RECHECK - 1)
+    self.assertTrue(Tombstone.exists(self.key))
+    
+  def test_publish(self):
+    Tombstone.bury(self.key)
+    memcache.delete(Tombstone.CACHE_PREFIX + self.key) # evicted
+    self.forget()
+    self.assertFalse(Tombstone.exists(self.key))
+    Tombstone.publish(self.key)
+    self.forget()
+    self.assertTrue(Tombstone.exists(self.key))
+    
+  def test_rejected(self):
+    Tombstone.bury(self.key)
+    page = measure.MainPage()
+    errors = []
+    page.error = errors.append
+    page.get(self.key, 'visitor', None)
+    page.post(self.key, 'visitor', None)
+    self.assertEqual([410, 410], errors)
@@ -0,0 +1,89 @@
+import unittest, logging
+from google.appengine.ext import db
+from google.appengine.runtime import apiproxy_errors
+from myapp import commit
+
+class Model(object):
+  def __init__(self, name, versioned = False):
+    self.name, self.versioned = name, versioned
+  
+  def properties(self):
+    return self.versioned and {'version': None} or {}
+  
+  def __repr__(self):
+    return self.name
+
+class DbStub(object):
+  '''Stands in for db.put, raising the queued errors one call at a time'''
+  def __init__(self, errors):
+    self.errors = list(errors)
+    self.calls = 0
+  
+  def put(self, models):
+    self.calls += 1
+    if self.errors:
+      error = self.errors.pop(0)
+      if error:
+        raise error
+
+class CommitTest (unittest.TestCase):
+  def setUp(self):
+    logging.disable(logging.CRITICAL)
+    self.attempt, self.enqueue, self.db = commit.attempt, commit.enqueue, commit.db
+    self.spilled = []
+    commit.enqueue = self.spilled.extend
+    
+  def tearDown(self):
+    logging.disable(logging.NOTSET)
+    commit.attempt, commit.enqueue, commit.db = self.attempt, self.enqueue, self.db
+    
+  def test_is_retryable(self):
+    for error in (db.Timeout(), db.TransactionFailedError(), db.InternalError(),
+        apiproxy_errors.DeadlineExceededError(), apiproxy_errors.CapabilityDisabledError()):
+      self.assertTrue(commit.is_retryable(error), error)
+    for error in (db.BadValueError(), db.BadRequestError(), ValueError(), TypeError()):
+      self.assertFalse(commit.is_retryable(error), error)
+    
+  def test_attempt_retries_transient_errors(self):
+    commit.db = DbStub([db.Timeout(), db.Timeout(), None])
+    self.assertEqual(None, commit.attempt(['a'], 3, 0))
+    self.assertEqual(3, commit.db.calls)
+    
+  def test_attempt_gives_up(self):
+    commit.db = DbStub([db.Timeout()] * 5)
+    self.assertTrue(isinstance(commit.attempt(['a'], 2, 0), db.Timeout))
+    self.assertEqual(3, commit.db.calls)
+    
+  def test_attempt_does_not_retry_permanent_errors(self):
+    commit.db = DbStub([db.BadValueError(), None])
+    self.assertTrue(isinstance(commit.attempt(['a'], 3, 0), db.BadValueError))
+    self.assertEqual(1, commit.db.calls)
+    
+  def test_put_isolates_bad_models(self):
+    batches = []
+    def attempt(batch, retries, backoff):
+      batches.append(len(batch))
+      if [model for model in batch if model.name.startswith('bad')]:
+        return db.BadValueError()
+    commit.attempt = attempt
+    models = [Model('m%s' % i) for i in range(8)]
+    models[5] = Model('bad')
+    written, unwritten = commit.put(models)
+    self.assertEqual(set(models) - set([models[5]]), set(written))
+    self.assertEqual([], unwritten)
+    self.assertEqual([8, 4, 4, 2, 2, 1, 1], batches)
+    self.assertEqual([], self.spilled)
+    
+  def test_put_hands_back_transient_failures(self):
+    commit.attempt = lambda batch, retries, backoff: db.Timeout()
+    storage, stats = Model('storage'), Model('stats', versioned = True)
+    written, unwritten = commit.put([storage, stats])
+    self.assertEqual([], written)
+    self.assertEqual([storage, stats], unwritten)
+    self.assertEqual([storage], self.spilled)
+    
+  def test_put_without_spill(self):
+    commit.attempt = lambda batch, retries, backoff: db.Timeout()
+    written, unwritten = commit.put([Model('storage')], spill = False)
+    self.assertEqual(1, len(unwritten))
+    self.assertEqual([], self.spilled)
@@ -0,0 +1,62 @@
+import unittest
+from google.appengine.api import memcache
+
+import measure
+from myapp.models import Campaign, Storage
+
+class DedupeTest (unittest.TestCase):
+  def setUp(self):
+    campaign = Campaign(title = 'Dedupe campaign')
+    campaign.put()
+    self.campaign = str(campaign.key())
+    
+  def marker(self, datum_id):
+    return memcache.get(measure.DEDUPE_PREFIX + measure.datum_key_name(self.campaign, datum_id))
+    
+  def drop(self, data):
+    return measure.drop_duplicates(self.campaign, data)
+    
+  def test_reserve(self):
+    data = [{'namespace': 'a', 'id': 1}, {'namespace': 'a', 'id': 2}, {'namespace': 'a'}]
+    unique, reserved = self.drop(data)
+    self.assertEqual(data, unique)
+    self.assertEqual(2, len(reserved))
+    self.assertEqual(measure.PENDING, self.marker(1))
+    
+  def test_pending_is_in_flight(self):
+    self.drop([{'namespace': 'a', 'id': 1}])
+    self.assertRaises(measure.InFlight, self.drop, [{'namespace': 'a', 'id': 1}, {'namespace': 'a', 'id': 2}])
+    self.assertEqual(None, self.marker(2)) # released along with the failed payload
+    
+  def test_done_is_dropped(self):
+    unique, reserved = self.drop([{'namespace': 'a', 'id': 1}])
+    measure.remember_ids([Storage(key_name = name, namespace = 'a', type = 'number') for name in reserved])
+    self.assertEqual(measure.DONE, self.marker(1))
+    unique, reserved = self.drop([{'namespace': 'a', 'id': 1}, {'namespace': 'a', 'id': 2}])
+    self.assertEqual([{'namespace': 'a', 'id': 2}], unique)
+    self.assertEqual([measure.datum_key_name(self.campaign, 2)], reserved)
+    
+  def test_forget(self):
+    unique, reserved = self.drop([{'namespace': 'a', 'id': 1}])
+    measure.forget_ids(reserved)
+    self.assertEqual(None, self.marker(1))
+    unique, reserved = self.drop([{'namespace': 'a', 'id': 1}])
+    self.assertEqual(1, len(unique))
+    
+  def test_written_storage(self):
+    Storage(key_name = measure.datum_key_name(self.campaign, 1), namespace = 'a', type = 'number').put()
+    unique, reserved = self.drop([{'namespace': 'a', 'id': 1}])
+    self.assertEqual([], unique)
+    self.assertEqual([], reserved)
+    
+  def test_zero_and_repeated_ids(self):
+    unique, reserved = self.drop([{'namespace': 'a', 'id': 0}, {'namespace': 'a', 'id': 0}, {'namespace': 'a', 'id': ''}])
+    self.assertEqual([{'namespace': 'a', 'id': 0}, {'namespace': 'a', 'id': ''}], unique)
+    self.assertEqual([measure.datum_key_name(self.campaign, 0)], reserved)
+    
+  def test_columnar(self):
+    self.drop([{'namespace': 'a', 'id': 2}])
+    measure.remember_ids([Storage(key_name = measure.datum_key_name(self.campaign, 2), namespace = 'a', type = 'number')])
+    unique, reserved = self.drop([{'namespace': 'a', 'values': [1, 2, 3], 'timestamps': [10, 20, 30], 'ids': [1, 2, 3]}])
+    self.assertEqual([{'namespace': 'a', 'values': [1, 3], 'timestamps': [10, 30], 'ids': [1, 3]}], unique)
+    self.assertEqual(2, len(reserved))
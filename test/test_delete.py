@@ -0,0 +1,75 @@
+import unittest, logging
+from google.appengine.ext import db
+
+from myapp import tasks
+from myapp.models import *
+
+class DeleteTestCase (unittest.TestCase):
+  def setUp(self):
+    logging.disable(logging.INFO)
+    self.saved = tasks.BATCH, tasks.start
+    tasks.BATCH = 3 # several batches per kind
+    tasks.start = lambda *args, **kwds: None # the tasks are run by the tests
+    
+    self.campaign = Campaign(title = 'Deleted campaign')
+    self.campaign.put()
+    self.stats = [self.namespace(ns) for ns in ('a', 'b')]
+    
+  def tearDown(self):
+    logging.disable(logging.NOTSET)
+    tasks.BATCH, tasks.start = self.saved
+    
+  def namespace(self, ns):
+    stats = Statistics(key_name = '%s.%s' % (self.campaign.key(), ns), campaign = self.campaign, namespace = ns, type = 'string')
+    stats.put()
+    shard = StatisticsShard(key_name = '%s.shard0' % stats.key().name(), statistic = stats)
+    db.put([Storage(campaign = self.campaign, stats = stats, namespace = ns, type = 'string', value = 'x') for i in range(7)] +
+      [Histogram(key_name = '%s.hits' % stats.key(), statistic = stats, name = 'hits'),
+       Calendar(key_name = '%s.calendar' % stats.key(), statistic = stats), shard,
+       Histogram(parent = shard, key_name = '%s.hits' % stats.key(), statistic = stats, name = 'hits'),
+       Rollup(key_name = Rollup.key_name(stats.key(), 'day', '2010'), statistic = stats, resolution = 'day', period = '2010')])
+    return stats
+    
+  def left(self, stats):
+    return [Kind.all().filter('%s =' % reference, stats).count() for Kind, reference in
+      ((Storage, 'stats'), (Histogram, 'statistic'), (Calendar, 'statistic'), (Rollup, 'statistic'), (StatisticsShard, 'statistic'))]
+
+class DeleteHistogramTest(DeleteTestCase):
+  def test_execute(self):
+    task = tasks.schedule('delete histogram', [self.stats[0].key()])[0]
+    self.assertEqual(True, task.execute())
+    self.assertEqual([0] * 5, self.left(self.stats[0]))
+    self.assertEqual(None, Statistics.get(self.stats[0].key()))
+    self.assertEqual(None, TaskModel.get(task.key()))
+    self.assertEqual([7, 2, 1, 1, 1], self.left(self.stats[1]))
+    
+  def test_deadline(self):
+    task = tasks.schedule('delete histogram', [self.stats[0].key()])[0]
+    budget, tasks.BUDGET = tasks.BUDGET, -1
+    try:
+      self.assertEqual(False, task.execute()) # continues in the next run
+    finally:
+      tasks.BUDGET = budget
+    self.assertTrue(Statistics.get(self.stats[0].key()))
+    self.assertEqual(True, task.execute())
+    self.assertEqual([0] * 5, self.left(self.stats[0]))
+
+class DeleteCampaignTest(DeleteTestCase):
+  def test_execute(self):
+    Storage(campaign = self.campaign, namespace = 'c', type = 'string', value = 'x').put() # without statistics
+    Tombstone.bury(str(self.campaign.key()))
+    task = tasks.schedule('delete campaign', [self.campaign.key()])[0]
+    self.assertEqual(None, task.execute()) # waits for its namespaces
+    self.assertTrue(task.fanned_out)
+    namespaces = TaskModel.all().filter('task =', 'delete histogram').filter('campaign =', self.campaign.key()).fetch(10)
+    self.assertEqual(2, len(namespaces))
+    for namespace in namespaces:
+      self.assertEqual(True, namespace.execute())
+    self.assertEqual(True, task.execute())
+    self.assertEqual(0, Storage.all().filter('campaign =', self.campaign).count())
+    self.assertEqual(0, Statistics.all().filter('campaign =', self.campaign).count())
+    self.assertTrue(Tombstone.exists(str(self.campaign.key())))
+    
+  def test_schedule_once(self):
+    self.assertEqual(1, len(tasks.schedule('delete campaign', [self.campaign.key()])))
+    self.assertEqual(0, len(tasks.schedule('delete campaign', [self.campaign.key()])))
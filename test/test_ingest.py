@@ -0,0 +1,67 @@
+import unittest, gzip, StringIO, logging
+import util, measure
+
+def gzipped(text):
+  buf = StringIO.StringIO()
+  f = gzip.GzipFile(fileobj = buf, mode = 'wb')
+  f.write(text)
+  f.close()
+  return buf.getvalue()
+
+class ReadLinesTest (unittest.TestCase):
+  def test_lines_across_blocks(self):
+    stream = StringIO.StringIO('first\nsecond line\nthird')
+    self.assertEqual(['first', 'second line', 'third'], list(util.read_lines(stream, block_size = 4)))
+    
+  def test_trailing_newline(self):
+    stream = StringIO.StringIO('a\nb\n')
+    self.assertEqual(['a', 'b', ''], list(util.read_lines(stream, block_size = 1)))
+    
+  def test_empty(self):
+    self.assertEqual([''], list(util.read_lines(StringIO.StringIO(''))))
+    
+  def test_gzipped(self):
+    text = '\n'.join(['line %s' % i for i in range(1000)])
+    stream = StringIO.StringIO(gzipped(text))
+    self.assertEqual(text.split('\n'), list(util.read_lines(stream, gzipped = True, block_size = 64)))
+
+  def test_rejects_long_lines(self):
+    stream = StringIO.StringIO('short\n' + 'x' * 100)
+    lines = util.read_lines(stream, block_size = 16, max_line = 50)
+    self.assertEqual('short', lines.next())
+    self.assertRaises(util.LineTooLong, list, lines)
+    
+  def test_inflates_by_bounded_blocks(self):
+    stream = StringIO.StringIO(gzipped('x' * 100000))
+    self.assertTrue(max([len(block) for block in util.read_blocks(stream, gzipped = True, block_size = 1024)]) <= 1024)
+    
+  def test_rejects_long_inflated_lines(self):
+    stream = StringIO.StringIO(gzipped('x' * 100000))
+    self.assertRaises(util.LineTooLong, list, util.read_lines(stream, gzipped = True, block_size = 1024, max_line = 10000))
+
+class ReadNdjsonTest (unittest.TestCase):
+  def setUp(self):
+    logging.disable(logging.WARNING)
+    
+  def tearDown(self):
+    logging.disable(logging.NOTSET)
+    
+  def test_datums(self):
+    stream = StringIO.StringIO('{"namespace": "a", "value": 1}\n{"namespace": "b", "value": 2}')
+    self.assertEqual([{'namespace': 'a', 'value': 1}, {'namespace': 'b', 'value': 2}], list(measure.read_ndjson(stream)))
+    
+  def test_skips_blank_lines(self):
+    stream = StringIO.StringIO('\n{"value": 1}\n  \n\r\n{"value": 2}\n')
+    self.assertEqual([{'value': 1}, {'value': 2}], list(measure.read_ndjson(stream)))
+    
+  def test_skips_invalid_lines(self):
+    stream = StringIO.StringIO('{"value": 1}\n{"value": \nnot json\n[1, 2]\n"text"\n{"value": 2}')
+    self.assertEqual([{'value': 1}, {'value': 2}], list(measure.read_ndjson(stream)))
+    
+  def test_partial_last_line(self):
+    stream = StringIO.StringIO('{"value": 1}\n{"value": 2}\n{"val')
+    self.assertEqual([{'value': 1}, {'value': 2}], list(measure.read_ndjson(stream)))
+    
+  def test_gzipped(self):
+    stream = StringIO.StringIO(gzipped('{"value": 1}\n\n{"value": 2}\n'))
+    self.assertEqual([{'value': 1}, {'value': 2}], list(measure.read_ndjson(stream, gzipped = True)))
@@ -0,0 +1,99 @@
+import unittest, logging
+from google.appengine.ext import db
+
+from myapp import recompute
+from myapp.models import *
+
+class Request(object):
+  def __init__(self, params):
+    self.params = params
+  
+  def get(self, name, default = ''):
+    return self.params.get(name, default)
+
+class RecomputeTest (unittest.TestCase):
+  def setUp(self):
+    logging.disable(logging.INFO)
+    self.saved = recompute.PARTITION_SIZE, recompute.SPLIT_BATCH, recompute.BATCH, recompute.BUDGET, recompute.enqueue
+    recompute.PARTITION_SIZE, recompute.SPLIT_BATCH, recompute.BATCH = 10, 5, 4
+    self.tasks = []
+    recompute.enqueue = lambda step, name, **params: self.tasks.append((step, dict((k, str(v)) for k, v in params.iteritems())))
+    
+    self.campaign = Campaign(title = 'Recomputed campaign')
+    self.campaign.put()
+    db.put([Storage(campaign = self.campaign, namespace = 'a', type = 'number', value = i) for i in range(1, 26)] +
+      [Storage(campaign = self.campaign, namespace = 'b', type = 'string', value = 'x') for i in range(7)])
+    
+  def tearDown(self):
+    logging.disable(logging.NOTSET)
+    recompute.PARTITION_SIZE, recompute.SPLIT_BATCH, recompute.BATCH, recompute.BUDGET, recompute.enqueue = self.saved
+    
+  def run_tasks(self, times = 1, until = None):
+    '''Runs the added tasks in order, each one `times` times like a retrying queue, up to the first of step `until`'''
+    while self.tasks and self.tasks[0][0] != until:
+      step, params = self.tasks.pop(0)
+      for i in range(times):
+        page = recompute.RecomputePage()
+        page.request = Request(params)
+        page.post(step)
+    
+  def stats(self, ns):
+    return Statistics.get_by_key_name('%s.%s' % (self.campaign.key(), ns))
+    
+  def assertRecomputed(self, job):
+    job = Recompute.get(job.key())
+    self.assertTrue(job.merged_on)
+    self.assertTrue(job.partitions > 1)
+    self.assertEqual(range(job.partitions), sorted(job.done))
+    self.assertEqual(['a', 'b'], job.namespaces)
+    self.assertEqual(25, self.stats('a').count)
+    self.assertEqual(325, self.stats('a').sum)
+    self.assertEqual(7, self.stats('b').count)
+    self.assertEqual(0, RecomputePartition.all().filter('job =', job).count())
+    self.assertEqual(0, RecomputeState.all().count())
+    
+  def test_recompute(self):
+    job = recompute.start(self.campaign.key())
+    self.run_tasks()
+    self.assertRecomputed(job)
+    
+  def test_continuations(self):
+    recompute.BUDGET = -1 # every task continues in a new one after its first batch
+    job = recompute.start(self.campaign.key())
+    self.run_tasks()
+    self.assertEqual(1, Recompute.get(job.key()).merges) # one namespace per task
+    self.assertRecomputed(job)
+    
+  def test_retried_tasks(self):
+    recompute.BUDGET = -1
+    job = recompute.start(self.campaign.key())
+    self.run_tasks(times = 2)
+    self.assertRecomputed(job)
+    
+  def test_namespace(self):
+    job = recompute.start(self.campaign.key(), 'b')
+    self.run_tasks()
+    self.assertEqual(['b'], Recompute.get(job.key()).namespaces)
+    self.assertEqual(7, self.stats('b').count)
+    self.assertEqual(None, self.stats('a'))
+    
+  def test_checkpoint_per_namespace(self):
+    job = recompute.start(self.campaign.key())
+    self.run_tasks(until = 'merge')
+    for partition in RecomputePartition.all().filter('job =', job):
+      self.assertTrue(partition.done)
+      states = RecomputeState.all().ancestor(partition).fetch(10)
+      self.assertEqual(partition.namespaces, sorted([state.key().name() for state in states]))
+    
+  def test_stale_checkpoint(self):
+    job = recompute.start(self.campaign.key())
+    self.run_tasks(until = 'work')
+    partition = RecomputePartition.get_by_key_name('%s.0' % job.key().id())
+    self.assertTrue(recompute.checkpoint(partition, 0, None, {}))
+    self.assertFalse(recompute.checkpoint(partition, 0, None, {})) # the step moved on already
+    
+  def test_complete_once(self):
+    job = recompute.start(self.campaign.key())
+    recompute.complete(job, 0)
+    recompute.complete(job, 0)
+    self.assertEqual([0], Recompute.get(job.key()).done)
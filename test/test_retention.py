@@ -0,0 +1,70 @@
+import unittest, logging, datetime, time
+from google.appengine.ext import db
+
+from myapp import tasks
+from myapp.models import *
+
+class RetentionTest (unittest.TestCase):
+  def setUp(self):
+    logging.disable(logging.INFO)
+    self.campaign = Campaign(title = 'Retained campaign')
+    self.campaign.put()
+    self.stats = Statistics(key_name = '%s.visitor' % self.campaign.key(), campaign = self.campaign, namespace = 'visitor', type = 'number')
+    self.stats.put()
+    
+  def tearDown(self):
+    logging.disable(logging.NOTSET)
+    
+  def measure(self, day, count = 3):
+    data = [Storage(campaign = self.campaign, stats = self.stats, namespace = 'visitor', type = 'number', value = i,
+      created_on = datetime.datetime(2010, 1, day, 12)) for i in range(count)]
+    db.put(data)
+    return data
+    
+  def rolled_up(self):
+    '''The count of the values in the daily rollups of January 2010'''
+    series = Rollup.get_series(self.stats.key(), 'day', datetime.datetime(2010, 1, 1), datetime.datetime(2010, 1, 31, 23))
+    return sum([bucket[1] for bucket in series])
+    
+  def test_fold_once(self):
+    data = self.measure(5)
+    tasks.fold(self.stats, 'a', data)
+    tasks.fold(self.stats, 'a', data) # retried after a failure
+    self.assertEqual(3, self.rolled_up())
+    tasks.fold(self.stats, 'b', data)
+    self.assertEqual(6, self.rolled_up())
+    
+  def test_folds_bounded(self):
+    data = self.measure(5, 1)
+    for i in range(Rollup.MAX_FOLDS + 5):
+      tasks.fold(self.stats, 'fold%s' % i, data)
+    rollup = Rollup.all().filter('statistic =', self.stats).get()
+    self.assertEqual(Rollup.MAX_FOLDS, len(rollup.folds))
+    self.assertEqual('fold%s' % (Rollup.MAX_FOLDS + 4), rollup.folds[-1])
+    
+  def test_prune(self):
+    self.measure(5)
+    kept = self.measure(20)
+    self.assertTrue(tasks.prune(self.stats, datetime.datetime(2010, 1, 10), time.time() + 10))
+    self.assertEqual(sorted([str(datum.key()) for datum in kept]), sorted([str(key) for key in Storage.all(keys_only = True).filter('stats =', self.stats)]))
+    self.assertEqual(3, self.rolled_up())
+    state = RollupState.get_by_key_name(self.stats.key().name())
+    self.assertTrue(state.pruned_on)
+    self.assertEqual(None, state.folding)
+    self.assertEqual([], state.pending)
+    
+  def test_prune_resumes_fold(self):
+    data = self.measure(5)
+    tasks.fold(self.stats, 'a', data) # the last run stopped before deleting the data
+    RollupState.update(self.stats.key().name(), pruned_on = datetime.datetime.now(), folding = 'a', pending = [datum.key() for datum in data])
+    self.assertTrue(tasks.prune(self.stats, datetime.datetime(2010, 1, 10), time.time() + 10))
+    self.assertEqual(0, Storage.all().filter('stats =', self.stats).count())
+    self.assertEqual(3, self.rolled_up())
+    self.assertEqual(None, RollupState.get_by_key_name(self.stats.key().name()).folding)
+    
+  def test_prune_rolled_up(self):
+    self.measure(5)
+    RollupState.update(self.stats.key().name(), rolled_up = True)
+    self.assertTrue(tasks.prune(self.stats, datetime.datetime(2010, 1, 10), time.time() + 10))
+    self.assertEqual(0, Storage.all().filter('stats =', self.stats).count())
+    self.assertEqual(0, self.rolled_up()) # in the rollups already, nothing is folded
@@ -0,0 +1,104 @@
+import unittest, logging, datetime, time
+from google.appengine.ext import db
+
+from myapp import tasks
+from myapp.models import Campaign, TaskModel
+
+class EchoTask(object):
+  '''Returns what the test sets as the result of a run'''
+  result = True
+  
+  @staticmethod
+  def execute(task, obj):
+    return EchoTask.result
+
+class SchedulerTest (unittest.TestCase):
+  def setUp(self):
+    logging.disable(logging.INFO)
+    self.saved = tasks.start, tasks.kick
+    self.started, self.kicked = [], []
+    tasks.start = lambda countdown = 0, step = 0: self.started.append(countdown)
+    tasks.kick = self.kicked.append
+    tasks.EchoTask = EchoTask
+    EchoTask.result = True
+    for task in TaskModel.all():
+      task.delete()
+    
+    self.campaigns = [Campaign(title = 'Campaign %s' % i) for i in range(3)]
+    db.put(self.campaigns)
+    
+  def tearDown(self):
+    logging.disable(logging.NOTSET)
+    tasks.start, tasks.kick = self.saved
+    del tasks.EchoTask
+    
+  def schedule(self):
+    return tasks.schedule('echo', [campaign.key() for campaign in self.campaigns])
+    
+  def expire(self, task):
+    task = TaskModel.get(task.key())
+    task.leased_until = datetime.datetime.now() - datetime.timedelta(seconds = 1)
+    task.put()
+    
+  def test_schedule(self):
+    self.assertEqual(3, len(self.schedule()))
+    self.assertEqual([0], self.started)
+    self.assertEqual([], self.schedule())
+    
+  def test_claim(self):
+    self.schedule()
+    claimed = tasks.claim()
+    self.assertEqual(3, len(claimed))
+    self.assertEqual(3, len(set([task.lease for task in claimed])))
+    for task in claimed:
+      self.assertTrue(task.leased_until > datetime.datetime.now())
+    self.assertEqual([], tasks.claim())
+    
+  def test_claim_limit(self):
+    self.schedule()
+    self.assertEqual(2, len(tasks.claim(2)))
+    self.assertEqual(1, len(tasks.claim(2)))
+    
+  def test_claim_expired(self):
+    task = self.schedule()[0]
+    lease = tasks.claim()[0].lease
+    self.expire(task)
+    claimed = tasks.claim()
+    self.assertEqual([task.key()], [task.key() for task in claimed])
+    self.assertNotEqual(lease, claimed[0].lease)
+    
+  def test_backfill(self):
+    task = TaskModel(key_name = 'echo:legacy', object = self.campaigns[0], task = 'echo')
+    task.put()
+    self.assertEqual([], tasks.claim())
+    self.assertTrue(tasks.backfill(time.time() + 10))
+    self.assertEqual([task.key()], [task.key() for task in tasks.claim()])
+    
+  def test_renew(self):
+    self.schedule()
+    task = tasks.claim()[0]
+    renewed = tasks.renew(task)
+    self.assertTrue(renewed.leased_until >= task.leased_until)
+    task.lease = 'lost'
+    self.assertEqual(None, tasks.renew(task))
+    
+  def test_run_scheduler(self):
+    self.schedule()
+    self.started = []
+    self.assertEqual(3, tasks.run_scheduler())
+    self.assertEqual(3, len(self.kicked))
+    self.assertEqual([tasks.LEASE], self.started) # looks again once the leases expire
+    
+  def test_run(self):
+    self.schedule()
+    task = tasks.claim()[0]
+    tasks.run(task.key(), 'lost')
+    self.assertTrue(TaskModel.get(task.key()).leased_until > datetime.datetime.now())
+    
+    EchoTask.result = False # continues at once
+    tasks.run(task.key(), task.lease)
+    self.assertEqual([task.key()], [kicked.key() for kicked in self.kicked])
+    
+    EchoTask.result = None # waits for the lease to expire
+    tasks.run(task.key(), task.lease)
+    self.assertEqual(1, len(self.kicked))
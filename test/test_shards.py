@@ -0,0 +1,82 @@
+import unittest, logging
+from google.appengine.ext import db
+
+from myapp.models import *
+from myapp import persist, stat
+
+class ShardTestCase (unittest.TestCase):
+  def setUp(self):
+    self.campaign = Campaign(title = 'Sharded campaign')
+    self.campaign.put()
+    self.stats = Statistics(key_name = '%s.visitor' % self.campaign.key(), campaign = self.campaign,
+      namespace = 'visitor', type = 'string', shards = 4)
+    self.stats.put()
+    
+  def read(self):
+    return Statistics.get_by_campaign_and_namespace(self.campaign.key(), 'visitor')
+
+class IncrementTest(ShardTestCase):
+  def test_counters(self):
+    for i in range(10):
+      StatisticsShard.increment(self.stats, {'count': 1})
+    stats = self.read()
+    self.assertEqual(10, stats.count)
+    self.assertTrue(1 <= len(stats.shard_keys()) <= 4)
+    self.assertEqual(0, Statistics.get(self.stats.key()).count) # only the shards are written
+    
+  def test_histograms(self):
+    for i in range(6):
+      StatisticsShard.increment(self.stats, {'count': 3}, {'hits': {'a': 1, u'\xe9': 2}})
+    stats = self.read()
+    self.assertEqual(None, Histogram.get_by_key_name('%s.hits' % stats.key()))
+    hits = stats.get_histograms(['hits'])[0]
+    self.assertEqual(6, hits.counts['a'])
+    self.assertEqual(12, hits.counts[u'\xe9'.encode('utf-8')])
+    
+  def test_histograms_with_unsharded(self):
+    hist = Histogram(key_name = '%s.hits' % self.stats.key(), statistic = self.stats, name = 'hits')
+    hist.merge({'a': 5})
+    hist.put()
+    StatisticsShard.increment(self.stats, {'count': 1}, {'hits': {'a': 1}})
+    self.assertEqual(6, self.read().get_histograms(['hits'])[0].counts['a'])
+
+class DeltaTest(ShardTestCase):
+  def setUp(self):
+    super(DeltaTest, self).setUp()
+    logging.disable(logging.CRITICAL)
+    self.increment = StatisticsShard.increment
+    
+  def tearDown(self):
+    logging.disable(logging.NOTSET)
+    StatisticsShard.increment = self.increment
+    persist._Deltas.clear()
+    
+  def calculate(self, values):
+    Summary = stat.get('string')
+    persist.calculate_many(Summary, Summary.prepare_many([stat.Datum(value, self.stats) for value in values]))
+    
+  def test_flush(self):
+    self.calculate(['a', 'b', 'a'])
+    self.calculate(['a'])
+    self.assertEqual(1, len(persist._Deltas))
+    persist.flush()
+    self.assertEqual({}, persist._Deltas)
+    stats = self.read()
+    self.assertEqual(4, stats.count)
+    self.assertTrue('hits' in stats.histograms)
+    self.assertEqual(3, stats.get_histograms(['hits'])[0].counts['a'])
+    
+  def test_failed_delta_is_kept(self):
+    def fail(cls, *args, **kwds):
+      raise db.TransactionFailedError()
+    StatisticsShard.increment = classmethod(fail)
+    self.calculate(['a', 'b'])
+    persist.flush()
+    self.assertEqual(1, len(persist._Deltas))
+    self.assertEqual(0, self.read().count)
+    
+    StatisticsShard.increment = self.increment
+    self.calculate(['c'])
+    persist.flush()
+    self.assertEqual({}, persist._Deltas)
+    self.assertEqual(3, self.read().count)
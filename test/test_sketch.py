@@ -0,0 +1,176 @@
+import unittest, random, datetime
+from myapp import sketch
+
+class TDigestTest (unittest.TestCase):
+  def setUp(self):
+    generator = random.Random(42)
+    self.values = [generator.expovariate(1) for i in range(20000)]
+    self.ordered = sorted(self.values)
+    
+  def assertQuantile(self, digest, q, tolerance):
+    expected = self.ordered[int(q * len(self.ordered))]
+    self.assertTrue(abs(digest.quantile(q) - expected) <= tolerance * expected, '%s: %s != %s' % (q, digest.quantile(q), expected))
+    
+  def test_empty(self):
+    self.assertEqual(None, sketch.TDigest().quantile(0.5))
+    self.assertEqual(3.0, sketch.TDigest().update([3]).quantile(0.5))
+    
+  def test_quantiles(self):
+    digest = sketch.TDigest()
+    for i in range(0, len(self.values), 100):
+      digest.update(self.values[i:i + 100])
+    self.assertEqual(len(self.values), len(digest))
+    for q in (0.5, 0.9, 0.95, 0.99):
+      self.assertQuantile(digest, q, 0.02)
+      
+  def test_bounded(self):
+    digest = sketch.TDigest(compression = 100).update(self.values)
+    self.assertTrue(len(digest.encode()) < 2048)
+    
+  def test_merge_and_encode(self):
+    half = len(self.values) / 2
+    a = sketch.TDigest().update(self.values[:half])
+    b = sketch.TDigest.decode(sketch.TDigest().update(self.values[half:]).encode())
+    a.merge(b)
+    self.assertEqual(len(self.values), len(a))
+    self.assertQuantile(a, 0.99, 0.02)
+
+class MomentsTest (unittest.TestCase):
+  def setUp(self):
+    generator = random.Random(7)
+    self.values = [generator.gauss(1e6, 3) for i in range(5000)]
+    
+  def expected(self):
+    n = float(len(self.values))
+    mean = sum(self.values) / n
+    m2 = sum([(x - mean) ** 2 for x in self.values])
+    m3 = sum([(x - mean) ** 3 for x in self.values])
+    m4 = sum([(x - mean) ** 4 for x in self.values])
+    return mean, m2 / (n - 1), n ** 0.5 * m3 / m2 ** 1.5, n * m4 / m2 ** 2 - 3
+    
+  def assertMoments(self, moments):
+    mean, variance, skew, kurtosis = self.expected()
+    self.assertAlmostEqual(mean, moments.mean, 6)
+    self.assertAlmostEqual(variance, moments.variance, 6)
+    self.assertAlmostEqual(skew, moments.skew, 6)
+    self.assertAlmostEqual(kurtosis, moments.kurtosis, 6)
+    
+  def test_batches(self):
+    moments = sketch.Moments()
+    for i in range(0, len(self.values), 7):
+      moments.update(self.values[i:i + 7])
+    self.assertEqual(len(self.values), moments.n)
+    self.assertMoments(moments)
+    
+  def test_merge_and_encode(self):
+    a = sketch.Moments().update(self.values[:1000])
+    b = sketch.Moments.decode(sketch.Moments().update(self.values[1000:]).encode())
+    self.assertMoments(a.merge(b))
+    
+  def test_degenerate(self):
+    moments = sketch.Moments().update([4, 4])
+    self.assertEqual(0.0, moments.variance)
+    self.assertEqual(None, moments.skew)
+    self.assertEqual(0.0, sketch.Moments().update([4]).stddev)
+
+class HyperLogLogTest (unittest.TestCase):
+  def test_empty_and_small(self):
+    self.assertEqual(0, len(sketch.HyperLogLog()))
+    self.assertEqual(3, len(sketch.HyperLogLog().update(['a', 'b', 'c', 'a'])))
+    
+  def test_estimate(self):
+    hll = sketch.HyperLogLog()
+    for i in range(0, 100000, 1000):
+      hll.update(['agent %s' % j for j in range(i, i + 1000)] * 2)
+    self.assertTrue(abs(len(hll) - 100000) < 5000, len(hll))
+    self.assertEqual(4097, len(hll.encode()))
+    
+  def test_merge_and_encode(self):
+    a = sketch.HyperLogLog().update(['url %s' % i for i in range(30000)])
+    b = sketch.HyperLogLog.decode(sketch.HyperLogLog().update(['url %s' % i for i in range(20000, 50000)]).encode())
+    self.assertTrue(abs(len(a.merge(b)) - 50000) < 2500, len(a))
+
+class SpaceSavingTest (unittest.TestCase):
+  def setUp(self):
+    generator = random.Random(3)
+    self.values = ['page %s' % int(generator.paretovariate(1.2)) for i in range(20000)]
+    self.exact = {}
+    for value in self.values:
+      self.exact[value] = self.exact.get(value, 0) + 1
+    self.expected = sorted(self.exact, key = lambda v: self.exact[v], reverse = True)[:10]
+    
+  def assertTop(self, top):
+    self.assertEqual(self.expected, [value for value, count, error in top[:10]])
+    for value, count, error in top:
+      self.assertTrue(count - error <= self.exact.get(value, 0) <= count)
+    
+  def test_top(self):
+    hitters = sketch.SpaceSaving(k = 50)
+    for i in range(0, len(self.values), 100):
+      hitters.update(self.values[i:i + 100])
+    self.assertEqual(50, len(hitters))
+    self.assertTop(hitters.top())
+    
+  def test_merge_and_encode(self):
+    a = sketch.SpaceSaving(k = 50).update(self.values[:10000])
+    b = sketch.SpaceSaving.decode(sketch.SpaceSaving(k = 50).update(self.values[10000:]).encode())
+    self.assertTop(a.merge(b).top())
+    
+  def test_encode_bounded(self):
+    hitters = sketch.SpaceSaving(k = 1000).update(['%04d' % i + 'x' * 70000 for i in range(1000)])
+    self.assertEqual(sketch.SpaceSaving.MAX_VALUE, max(len(value) for value, count, error in hitters.top()))
+    self.assertTrue(len(hitters.encode()) < 1000 * 1000)
+
+class CountsTest (unittest.TestCase):
+  def test_encode(self):
+    counts = sketch.Counts({'2009': 1, 'a.b': 300, u'caf\xe9': 2 ** 40}).update({'2009': 2})
+    self.assertEqual({'2009': 3, 'a.b': 300, 'caf\xc3\xa9': 2 ** 40}, sketch.Counts.decode(counts.encode()))
+    self.assertEqual({}, sketch.Counts.decode(None))
+
+class CalendarCountsTest (unittest.TestCase):
+  def test_buckets(self):
+    generator = random.Random(5)
+    values = [datetime.datetime(2000, 1, 1) + datetime.timedelta(seconds = generator.randint(0, 10 ** 9)) for i in range(1000)]
+    calendar = sketch.CalendarCounts().update(values[:500])
+    calendar = sketch.CalendarCounts.decode(calendar.encode()).merge(sketch.CalendarCounts().update(values[500:]))
+    indexes = {
+      'years': lambda value: str(value.year),
+      'weekdayth': lambda value: value.strftime('%U'),
+      'day.hour': lambda value: '%s.%s' % (value.day, value.hour)}
+    for name, index in indexes.iteritems():
+      expected = {}
+      for value in values:
+        expected[index(value)] = expected.get(index(value), 0) + 1
+      self.assertEqual(expected, calendar.bucket(name))
+
+class TimeSeriesTest (unittest.TestCase):
+  def test_rollups(self):
+    start = datetime.datetime(2009, 12, 31, 23, 58)
+    values = [(start + datetime.timedelta(seconds = 30 * i), i) for i in range(10)] + [(start, 'not a number')]
+    series = sketch.TimeSeries().update(values[:5])
+    series.merge(sketch.TimeSeries().update(values[5:]))
+    self.assertEqual(set([('minute', '2009-12-31'), ('minute', '2010-01-01'), ('hour', '2009-12'), ('hour', '2010-01'),
+      ('day', '2009'), ('day', '2010')]), set(series.keys()))
+    buckets = sketch.SeriesBuckets.decode(series[('minute', '2009-12-31')].encode())
+    self.assertEqual([(start, 3, 1, 0, 1), (start + datetime.timedelta(minutes = 1), 2, 5, 2, 3)],
+      buckets.series('2009-12-31', 'minute'))
+    self.assertEqual([(datetime.datetime(2010, 1, 1), 6, 39, 4, 9)], series[('day', '2010')].series('2010', 'day'))
+
+  def test_periods(self):
+    self.assertEqual(['2009-11', '2009-12', '2010-01'],
+      sketch.periods('hour', datetime.datetime(2009, 11, 30, 5), datetime.datetime(2010, 1, 1)))
+    self.assertEqual(['2009-12-31', '2010-01-01'],
+      sketch.periods('minute', datetime.datetime(2009, 12, 31, 5), datetime.datetime(2010, 1, 1)))
+
+class MergeStatesTest (unittest.TestCase):
+  def state(self, values):
+    return {'count': len(values), 'sum': sum(values), 'min': min(values), 'max': max(values),
+      'moments': sketch.Moments().update(values), 'hits': sketch.Counts({str(values[0]): 1})}
+
+  def test_merge(self):
+    values = range(1, 101)
+    whole = self.state(values)
+    merged = sketch.merge_states(sketch.merge_states({}, self.state(values[50:])), self.state(values[:50]))
+    self.assertEqual((100, 5050, 1, 100), (merged['count'], merged['sum'], merged['min'], merged['max']))
+    self.assertAlmostEqual(whole['moments'].variance, merged['moments'].variance)
+    self.assertEqual({'51': 1, '1': 1}, merged['hits'])
@@ -1,22 +1,6 @@
-import unittest, logging, util, datetime
+import unittest, datetime
 from myapp import stat
 
-class Object(object):
-  def __init__(self):
-    self.data = {}
-    
-  def key(self):
-    return datetime.datetime.now()
-  
-  def __setitem__(self, key, value):
-    self.data[key] = value;
-    
-  def __getitem__(self, key):
-    return self.data[key]
-    
-  def __delete__(self, key):
-    del self.data[key]
-
 class StatTest (unittest.TestCase):
   def setUp(self):
     self.number = stat.get('number')
@@ -24,6 +8,11 @@ class StatTest (unittest.TestCase):
     self.datetime = stat.get('datetime')
     self.none = stat.get('none')
     
+  def prepare(self, summary, raw, kind):
+    datum = stat.Datum(raw, stat.Aggregate('test', kind))
+    summary.prepare(datum)
+    return datum
+    
   def test_number_prepare(self):
     tests = [
       (10.245, '10.245'),
@@ -31,67 +20,64 @@ class StatTest (unittest.TestCase):
     ]
     for test in tests:
       expected, raw = test
-      self.assertEqual(expected, self.number.prepare(raw))
+      self.assertEqual(expected, self.prepare(self.number, raw, 'number').value)
+    self.assertTrue(hasattr(self.prepare(self.number, 'ten', 'number'), '_invalid'))
       
   def test_number_calc(self):
-    datum = Object()
-    datum.value = 10
-    datum.type = 'number'
-    stats = Object()
+    stats = stat.Aggregate('test', 'number')
     
-    self.number.calculate(stats, datum)
+    self.number.calculate(stat.Datum(10, stats))
     self.assertEqual(1, stats.count)
     self.assertEqual(10, stats.sum)
     self.assertTrue(hasattr(stats, 'hits'))
     
-    self.number.calculate(stats, datum)
+    self.number.calculate(stat.Datum(10, stats))
     self.assertEqual(2, stats.count)
     self.assertEqual(20, stats.sum)
-    self.assertTrue(hasattr(stats, 'hits'))
+    self.assertEqual({10: 2}, stats.hits)
       
   def test_string_prepare(self):
     tests = [
       ('string', 'string'),
-      ('string value', 'string+value'),
-      ('string value', 'string%20value')
+      ('10', 10)
     ]
     for test in tests:
       expected, raw = test
-      self.assertEqual(expected, self.string.prepare(raw))
-      
+      self.assertEqual(expected, self.prepare(self.string, raw, 'string').value)
   
   def test_string_calc(self):
-    datum = Object()
-    datum.value = 'a string'
-    datum.type = 'string'
-    stats = Object()
-    
-    self.string.calculate(stats, datum)
-    self.assertEqual(1, stats.count)
-    self.assertTrue(hasattr(stats, 'hits'))
-    
-    self.string.calculate(stats, datum)
-    self.assertEqual(2, stats.count)
-    self.assertTrue(hasattr(stats, 'hits'))
+    stats = stat.Aggregate('test', 'string').update(['a string', 'a string', 'another'])
+    self.assertEqual(3, stats.count)
+    self.assertEqual({'a string': 2, 'another': 1}, stats.hits)
+    self.assertEqual(2, stats.to_dict()['distinct'])
     
   def test_date_prepare(self):
-    tests = [
-      ('1242257428', '1242257428'),
-      ('2009-05-13 16:31:39', '2009-05-13+16%3A31%3A39')
-    ]
-    for test in tests:
-      expected, raw = test
-      self.assertEqual(expected, self.string.prepare(raw))
+    datum = self.prepare(self.datetime, '1242257428', 'timestamp')
+    self.assertEqual(datetime.datetime.fromtimestamp(1242257428), datum.datetime)
+    datum = self.prepare(self.datetime, '2009-05-13 16:31:39', 'datetime')
+    self.assertEqual(datetime.datetime(2009, 5, 13, 16, 31, 39), datum.datetime)
       
   def test_date_calc(self):
-    datum = Object()
-    datum.value = '1242257428'
-    datum.type = 'timestamp'
-    stats = Object()
-    
-    self.datetime.calculate(stats, datum)
+    stats = stat.Aggregate('test', 'timestamp').update(['1242257428'])
     self.assertEqual(1, stats.count)
     self.assertFalse(hasattr(stats, 'hits'))
-    self.assertEqual(1, len(stats['days']))
-
-
+    self.assertEqual(1, len(stats.to_dict()['days']))
+    
+  def test_aggregate(self):
+    data = [{'namespace': 'a', 'value': i} for i in range(100)] + [{'namespace': 'b', 'type': 'string', 'value': 'x'}]
+    aggregates = stat.aggregate(data)
+    self.assertEqual(['a', 'b'], sorted(aggregates))
+    self.assertEqual(4950, aggregates['a'].sum)
+    self.assertEqual(1, aggregates['b'].count)
+    
+    half = stat.aggregate(data[:50])['a'].merge(stat.aggregate(data[50:100])['a'])
+    self.assertEqual(aggregates['a'].to_dict()['variance'], half.to_dict()['variance'])
+    self.assertEqual((0, 99, 49.5), (half.min, half.max, half.to_dict()['mean']))
+    
+  def test_series(self):
+    when = datetime.datetime(2010, 3, 14, 15, 9)
+    stats = stat.Aggregate('test', 'number').update([1, 0, 5], [when, when, None])
+    self.assertEqual([(when, 2, 1, 0, 1)], stats.series[('minute', '2010-03-14')].series('2010-03-14', 'minute'))
+    self.assertFalse('series' in stats.to_dict())
+    stats = stat.Aggregate('test', 'string').update(['a'], [when])
+    self.assertEqual([(when, 1, None, None, None)], stats.series[('minute', '2010-03-14')].series('2010-03-14', 'minute'))
\ No newline at end of file
@@ -0,0 +1,92 @@
+import unittest
+from myapp import writebehind
+
+class MemcacheStub(object):
+  '''The part of the memcache API that the buffer uses, in a dict that tests can evict from'''
+  def __init__(self):
+    self.data = {}
+  
+  def get(self, key):
+    return self.data.get(key)
+  
+  def get_multi(self, keys):
+    return dict((key, self.data[key]) for key in keys if key in self.data)
+  
+  def set(self, key, value, time = 0):
+    self.data[key] = value
+    return True
+  
+  def add(self, key, value, time = 0):
+    if key in self.data:
+      return False
+    self.data[key] = value
+    return True
+  
+  def incr(self, key):
+    if key not in self.data:
+      return None
+    self.data[key] += 1
+    return self.data[key]
+  
+  def delete(self, key):
+    self.data.pop(key, None)
+  
+  def delete_multi(self, keys):
+    for key in keys:
+      self.delete(key)
+
+class WriteBehindTest (unittest.TestCase):
+  def setUp(self):
+    self.memcache, writebehind.memcache = writebehind.memcache, MemcacheStub()
+    self.schedule, writebehind.schedule = writebehind.schedule, lambda campaign: None
+    
+  def tearDown(self):
+    writebehind.memcache, writebehind.schedule = self.memcache, self.schedule
+    
+  def append(self, count, first = 0):
+    for i in range(first, first + count):
+      self.assertTrue(writebehind.append('c', [{'value': i}]))
+    
+  def drain(self):
+    values = []
+    for i in range(20):
+      datums, last, more = writebehind.peek('c', limit = 3)
+      values.extend([datum['value'] for datum in datums])
+      writebehind.advance('c', last)
+    return values
+    
+  def test_drain(self):
+    self.append(5)
+    self.assertEqual(range(5), self.drain())
+    self.assertEqual([], writebehind.peek('c')[0])
+    
+  def test_evicted_tail(self):
+    self.append(4)
+    writebehind.peek('c', limit = 2)
+    writebehind.advance('c', 2)
+    del writebehind.memcache.data[writebehind.tail_key('c')]
+    self.append(2, 4)
+    self.assertEqual([2, 3, 4, 5], self.drain())
+    
+  def test_evicted_head(self):
+    self.append(10)
+    writebehind.advance('c', writebehind.peek('c', limit = 6)[1])
+    del writebehind.memcache.data[writebehind.head_key('c')]
+    self.assertEqual(range(6, 10), self.drain())
+    
+  def test_tail_below_head(self):
+    self.append(3)
+    writebehind.advance('c', writebehind.peek('c')[1])
+    writebehind.memcache.data[writebehind.tail_key('c')] = 0
+    self.append(2, 3)
+    self.assertEqual([3, 4], self.drain())
+    
+  def test_evicted_slots_are_skipped_at_once(self):
+    self.append(10)
+    for slot in range(2, 9):
+      del writebehind.memcache.data[writebehind.slot_key('c', slot)]
+    datums, last, more = writebehind.peek('c', limit = 20)
+    self.assertEqual(([{'value': 0}], 1), (datums, last))
+    writebehind.advance('c', last)
+    datums, last, more = writebehind.peek('c', limit = 20)
+    self.assertEqual(([{'value': 8}, {'value': 9}], 10, False), (datums, last, more))
@@ -1,5 +1,6 @@
-import re, logging
-from google.appengine.ext import db
+import re, logging, zlib, time, pickle
+from google.appengine.ext import db, webapp
+from google.appengine.api.labs import taskqueue
 
 def generateModel(name, properties = {}, base = db.Model):
   return type(name, (base, ), properties)
@@ -12,6 +13,45 @@ special_keys = re.compile(r'\.((?:stats|values).*)')
 def getParts(ns):
   x = special_keys.split(ns)
   return len(x) and x[0] or '', len(x) > 1 and x[1] or ''
+
+MAX_LINE = 1024 * 1024 # bytes
+
+class LineTooLong(ValueError):
+  pass
+
+def read_blocks(stream, gzipped = False, block_size = 64 * 1024):
+  '''Yields the data of a file-like stream by blocks of at most block_size bytes,
+  inflating it on the fly when it is gzip encoded'''
+  inflater = gzipped and zlib.decompressobj(16 + zlib.MAX_WBITS)
+  while True:
+    block = stream.read(block_size)
+    if not block:
+      break
+    if not inflater:
+      yield block
+      continue
+    while block: # a small block may inflate to a lot, so it is inflated bit by bit
+      yield inflater.decompress(block, block_size)
+      block = inflater.unconsumed_tail
+  if inflater:
+    yield inflater.flush()
+
+def read_lines(stream, gzipped = False, block_size = 64 * 1024, max_line = MAX_LINE):
+  '''Yields the lines of a file-like stream one at a time, reading it by blocks
+  and inflating it on the fly when it is gzip encoded. Raises LineTooLong as soon
+  as a line is longer than max_line, so that a body without newlines is never
+  buffered whole.'''
+  pending = ''
+  for block in read_blocks(stream, gzipped, block_size):
+    lines = (pending + block).split('\n')
+    pending = lines.pop()
+    for line in lines + [pending]:
+      if len(line) > max_line:
+        raise LineTooLong('Line longer than %s bytes' % max_line)
+    for line in lines:
+      yield line
+  for line in pending.split('\n'):
+    yield line
   
 # From: http://github.com/DocSavage/bloog/blob/346e5fb7c1fd87259dc79f2c4ae852badb6f2b79/models/__init__.py
 import datetime
@@ -97,13 +137,47 @@ def getattr_by_path(obj, attr, *default):
 
 
 
+BUDGET = 20 # seconds of work per task, before continuing in the next one
+
+def add_task(name, **kwds):
+  """Adds the named task to the queue, once: a name taken by a task added (or run) before
+  is skipped, which makes continuing in a new task safe to retry. Returns whether it was added."""
+  try:
+    taskqueue.add(name = name, **kwds)
+    return True
+  except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+    logging.info('Task %s was already added' % name)
+    return False
+
+class MapperShard(db.Model):
+  """Checkpoint and progress counters of one shard (key range) of a Mapper job"""
+  job = db.StringProperty(required = True)
+  start = db.StringProperty() # keys (start, end]
+  end = db.StringProperty()
+  cursor = db.TextProperty()
+  steps = db.IntegerProperty(default = 0)
+  processed = db.IntegerProperty(default = 0)
+  updated = db.IntegerProperty(default = 0)
+  deleted = db.IntegerProperty(default = 0)
+  done = db.BooleanProperty(default = False)
+  updated_on = db.DateTimeProperty(auto_now = 1)
+  
+  @classmethod
+  def kind(cls):
+    return 'MapperShard'
+
 class Mapper(object):
+  """Maps the entities of a kind synchronously, within the request (Mapper.run). Mappers
+  that can run in the task queue extend TaskMapper instead."""
   # Subclasses should replace this with a model class (eg, model.Person).
   KIND = None
  
   # Subclasses can replace this with a list of (property, value) tuples to filter by.
   FILTERS = []
   
+  # Subclasses that only need the keys of the entities can set this.
+  KEYS_ONLY = False
+  
   def map(self, entity):
     """Updates a single entity.
    
@@ -111,34 +185,154 @@ class Mapper(object):
     """
     return ([], [])
  
-  def get_query(self):
-    """Returns a query over the specified kind, with any appropriate filters applied."""
-    q = self.KIND.all()
+  def get_query(self, start = None, end = None, keys_only = None):
+    """Returns a query over the specified kind, with any appropriate filters applied,
+    in key order and optionally within a key range (start, end]."""
+    if keys_only is None:
+      keys_only = self.KEYS_ONLY
+    q = self.KIND.all(keys_only = keys_only)
     for prop, value in self.FILTERS:
       q.filter("%s =" % prop, value)
+    if start:
+      q.filter("__key__ >", db.Key(start))
+    if end:
+      q.filter("__key__ <=", db.Key(end))
     q.order("__key__")
     return q
  
   def run(self, batch_size=100):
-    """Executes the map procedure over all matching entities."""
+    """Executes the map procedure over all matching entities, within this request."""
     q = self.get_query()
-    entities = q.fetch(batch_size)
-    while entities:
-      to_put = []
-      to_delete = []
-      for entity in entities:
-        map_updates, map_deletes = self.map(entity)
-        to_put.extend(map_updates)
-        to_delete.extend(map_deletes)
-      if to_put:
-        db.put(to_put)
-      if to_delete:
-        db.delete(to_delete)
+    while True:
+      entities = q.fetch(batch_size)
+      self.apply(entities)
+      if len(entities) < batch_size:
+        break
+      cursor = q.cursor()
       q = self.get_query()
-      q.filter("__key__ >", entities[-1].key())
+      q.with_cursor(cursor)
+  
+  def apply(self, entities):
+    """Maps the entities and writes the updates and deletes, in one batch each.
+    Returns how many entities were updated and deleted."""
+    to_put = []
+    to_delete = []
+    for entity in entities:
+      map_updates, map_deletes = self.map(entity)
+      to_put.extend(map_updates)
+      to_delete.extend(map_deletes)
+    if to_put:
+      db.put(to_put)
+    if to_delete:
+      db.delete(to_delete)
+    return len(to_put), len(to_delete)
+
+class TaskMapper(Mapper):
+  """A Mapper that can also run in the task queue (TaskMapper.start). It is pickled into
+  every task, and its tasks may run on any instance."""
+  URL = '/measure/_tasks/mapper'
+  SPLIT_BATCH = 1000 # keys per fetch when splitting the key space
+  MAX_SAMPLES = 500 # keys kept to choose the shard boundaries from
+  
+  def start(self, shards = 1, batch_size = 100):
+    """Executes the map procedure in the task queue, over `shards` key ranges in
+    parallel, each continuing in a new task before the request deadline. Returns
+    the job id, for progress."""
+    job = '%s-%d' % (self.__class__.__name__.lower(), time.time() * 1000)
+    if shards > 1:
+      self.enqueue('%s-split-0' % job, action = 'split', job = job, shards = shards, batch_size = batch_size)
+    else:
+      self.start_shards(job, [None, None], batch_size)
+    return job
+  
+  @staticmethod
+  def progress(job):
+    """The MapperShard (counters and state) of every shard of the job"""
+    return MapperShard.all().filter('job =', job).fetch(1000)
+  
+  def split(self, job, shards, batch_size, step = 0, cursor = None, samples = None, stride = 1, fetches = 0):
+    """Walks the keys (keys only, which is cheap), keeping the key at every stride-th
+    fetch as a sample, then starts the shards between evenly spaced samples."""
+    samples = samples or []
+    deadline = time.time() + BUDGET
+    while time.time() < deadline:
+      q = self.get_query(keys_only = True)
+      if cursor:
+        q.with_cursor(cursor)
+      keys = q.fetch(self.SPLIT_BATCH)
+      cursor = q.cursor()
+      if len(keys) < self.SPLIT_BATCH:
+        boundaries = []
+        for i in range(1, shards):
+          if samples and samples[len(samples) * i / shards] not in boundaries:
+            boundaries.append(samples[len(samples) * i / shards])
+        return self.start_shards(job, [None] + boundaries + [None], batch_size)
+      fetches += 1
+      if fetches % stride == 0:
+        samples.append(str(keys[-1]))
+      if len(samples) > self.MAX_SAMPLES:
+        samples, stride = samples[1::2], stride * 2
+    self.enqueue('%s-split-%d' % (job, step + 1), action = 'split', job = job, shards = shards, batch_size = batch_size,
+      step = step + 1, cursor = cursor, samples = samples, stride = stride, fetches = fetches)
+  
+  def start_shards(self, job, boundaries, batch_size):
+    for i in range(len(boundaries) - 1):
+      MapperShard.get_or_insert('%s.%d' % (job, i), job = job, start = boundaries[i], end = boundaries[i + 1])
+      self.enqueue('%s-%d-0' % (job, i), action = 'work', shard = '%s.%d' % (job, i), batch_size = batch_size)
+    logging.info('Started %s shards of %s' % (len(boundaries) - 1, job))
+  
+  def work(self, shard, batch_size, step = 0):
+    """Maps the key range of the shard from its last checkpoint, for as long as the budget lasts"""
+    shard = MapperShard.get_by_key_name(shard)
+    if not shard or shard.done or shard.steps != step: # a retried task, which moved on already
+      return
+    deadline = time.time() + BUDGET
+    cursor = shard.cursor
+    while True:
+      q = self.get_query(shard.start, shard.end)
+      if cursor:
+        q.with_cursor(cursor)
       entities = q.fetch(batch_size)
+      cursor = q.cursor()
+      updated, deleted = self.apply(entities)
+      shard.processed += len(entities)
+      shard.updated += updated
+      shard.deleted += deleted
+      if len(entities) < batch_size:
+        shard.done = True
+        break
+      if time.time() > deadline:
+        break
+    shard.cursor = cursor
+    shard.steps = step + 1
+    shard.put()
+    if not shard.done:
+      name = shard.key().name()
+      self.enqueue('%s-%d' % (name.replace('.', '-'), step + 1), action = 'work', shard = name,
+        batch_size = batch_size, step = step + 1)
+    else:
+      logging.info('Finished shard %s: %s processed, %s updated, %s deleted' % (
+        shard.key().name(), shard.processed, shard.updated, shard.deleted))
+  
+  def enqueue(self, name, **kwds):
+    add_task(name, url = self.URL, payload = pickle.dumps((self, kwds), 2))
+  
+  @staticmethod
+  def execute(payload):
+    """Runs a task added by enqueue"""
+    mapper, kwds = pickle.loads(payload)
+    action = kwds.pop('action')
+    if action == 'split':
+      mapper.split(**kwds)
+    elif action == 'work':
+      mapper.work(**kwds)
+
+class MapperPage(webapp.RequestHandler):
+  """Runs the tasks of the mappers started with TaskMapper.start"""
+  def post(self):
+    TaskMapper.execute(self.request.body)
  
-class FixNamespace(Mapper):
+class FixNamespace(TaskMapper):
   def __init__(self, kind, filters = None):
     self.KIND = kind
     if filters:
@@ -154,6 +348,9 @@ class FixNamespace(Mapper):
 import csv
 
 class Export(Mapper):
+  """Writes the attributes of the entities to a local csv file. It is not a TaskMapper:
+  it only runs synchronously (Mapper.run), since the tasks of TaskMapper.start may run
+  on other instances, which cannot reach the file."""
   def __init__(self, filename, kind, attrs, filters = None):
     self.KIND = kind
     if filters:
@@ -166,11 +363,13 @@ class Export(Mapper):
     self.writer.writerow([getattr(entity, attr) for attr in self.ATTRS])
     return ([], [])
     
-class Delete(Mapper):
+class Delete(TaskMapper):
+  KEYS_ONLY = True
+  
   def __init__(self, kind, filters = None):
     self.KIND = kind
     if filters:
       self.FILTERS = filters
   
-  def map(self, entity):
-    return ([], [entity])
\ No newline at end of file
+  def map(self, key):
+    return ([], [key])